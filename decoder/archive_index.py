@@ -0,0 +1,227 @@
+"""Module for random access to a JSON-lines archive of Things Network HTTP Integration
+payloads, like 'lora.json', without parsing the whole file.
+
+A sidecar index is built over the archive.  It holds the device, timestamp, byte offset and
+length of every uplink in a NumPy array sorted by device and then time, stored in
+'<archive>.uplinks.npy', with the list of devices and the state of the archive in
+'<archive>.uplinks.json'.  The index array and the archive are memory-mapped, so finding the
+uplinks for a device within a time range is a binary search on the index, and only those
+uplinks are read from the archive and parsed.  The index is extended by scanning only the
+lines appended since it was last updated; if the archive was replaced by a file that is not an
+extension of the indexed file, the index is rebuilt.
+
+Requires NumPy.
+"""
+from typing import Dict, Any, List, Optional, Iterable, Iterator, Union
+from pathlib import Path
+import json
+import mmap
+import os
+import re
+
+import numpy as np
+
+from .decode_utils import rfc3339_timestamp, unix_timestamp, append_check
+
+INDEX_DTYPE = np.dtype([
+    ('device', '<u4'),      # index into the device list
+    ('ts', '<f8'),          # UNIX timestamp of the uplink
+    ('offset', '<u8'),      # byte offset of the line in the archive
+    ('length', '<u4'),      # length of the line in bytes, without the newline
+])
+
+# Finds the Device ID and the message time in a line without parsing the JSON.  Lines that
+# don't match, e.g. because of different key order, are parsed.
+_DEV_ID_RE = re.compile(rb'"dev_id"\s*:\s*"([^"]*)"')
+_TIME_RE = re.compile(rb'"metadata"\s*:\s*\{\s*"time"\s*:\s*"([^"]*)"')
+
+def _line_key(lin: bytes):
+    """Returns the Device ID and timestamp of an archive line.
+    """
+    dev_match = _DEV_ID_RE.search(lin)
+    time_match = _TIME_RE.search(lin)
+    if dev_match and time_match:
+        return dev_match.group(1).decode(), rfc3339_timestamp(time_match.group(1).decode())
+    rec = json.loads(lin)
+    return rec['dev_id'], rfc3339_timestamp(rec['metadata']['time'])
+
+class ArchiveIndex:
+    """An index of the uplinks in a JSON-lines archive by device and time.
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        """'path' is the archive file.  The index is brought up to date when it is opened.
+        """
+        self.path = Path(path)
+        self.array_path = self.path.with_name(self.path.name + '.uplinks.npy')
+        self.meta_path = self.path.with_name(self.path.name + '.uplinks.json')
+        self.devices: List[str] = []
+        self.index: np.ndarray = np.empty(0, dtype=INDEX_DTYPE)
+        self._archive: Optional[mmap.mmap] = None
+        self._file = None
+        self.update()
+
+    def update(self):
+        """Indexes the lines appended to the archive since the index was last updated.
+        """
+        self.close()
+        self._file = open(self.path, 'rb')
+        size = self._file.seek(0, 2)
+        self._archive = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        data = self._archive
+
+        meta = None
+        if self.meta_path.exists() and self.array_path.exists():
+            meta = json.loads(self.meta_path.read_text())
+            if size < meta['size'] or append_check(self._file, meta['size']) != meta['check']:
+                meta = None         # not an extension of the indexed archive
+        rebuilt = meta is None
+        if rebuilt:
+            meta = dict(size=0, devices=[])
+            index = np.empty(0, dtype=INDEX_DTYPE)
+        else:
+            index = np.load(self.array_path, mmap_mode='r')
+        self.devices = meta['devices']
+
+        if meta['size'] < size or rebuilt or not self.array_path.exists():
+            dev_codes = {dev: i for i, dev in enumerate(self.devices)}
+            new_rows = []
+            pos = meta['size']
+            while pos < size:
+                end = data.find(b'\n', pos)
+                if end < 0:
+                    break           # partial line still being written
+                if data[pos:end].strip():
+                    device_id, ts = _line_key(data[pos:end])
+                    code = dev_codes.get(device_id)
+                    if code is None:
+                        code = dev_codes[device_id] = len(self.devices)
+                        self.devices.append(device_id)
+                    new_rows.append((code, ts, pos, end - pos))
+                pos = end + 1
+
+            if new_rows or rebuilt or not self.array_path.exists():
+                index = np.concatenate([np.asarray(index), np.array(new_rows, dtype=INDEX_DTYPE)])
+                index = index[np.lexsort((index['offset'], index['ts'], index['device']))]
+                # replace the file, rather than overwriting it, as it may be memory-mapped.
+                tmp_path = self.array_path.with_name(self.array_path.name + '.tmp')
+                with open(tmp_path, 'wb') as f:
+                    np.save(f, index)
+                os.replace(tmp_path, self.array_path)
+            meta = dict(size=pos, check=append_check(self._file, pos), devices=self.devices)
+            self.meta_path.write_text(json.dumps(meta))
+            index = np.load(self.array_path, mmap_mode='r')
+
+        self.index = index
+
+    def close(self):
+        """Closes the memory-mapped archive.
+        """
+        if isinstance(self._archive, mmap.mmap):
+            self._archive.close()
+        if self._file:
+            self._file.close()
+        self._archive = self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def find(
+            self,
+            devices: Optional[Iterable[str]] = None,
+            start=None,
+            end=None,
+        ) -> np.ndarray:
+        """Returns the index rows of the uplinks from 'devices' with a time greater than or
+        equal to 'start' and less than 'end', in time order.  'devices' is a Device ID or a
+        list of them; None means all devices.  'start' and 'end' are UNIX timestamps,
+        datetimes or ISO format strings (UTC if no timezone is given); None means no limit.
+        """
+        if isinstance(devices, str):
+            devices = [devices]
+        index = self.index
+        t0 = -np.inf if start is None else unix_timestamp(start)
+        t1 = np.inf if end is None else unix_timestamp(end)
+
+        if devices is None:
+            rows = index[(index['ts'] >= t0) & (index['ts'] < t1)]
+        else:
+            parts = []
+            dev_col = index['device']
+            for device_id in devices:
+                if device_id not in self.devices:
+                    continue
+                code = self.devices.index(device_id)
+                # the rows of the device are contiguous, and sorted by time within it.
+                lo, hi = np.searchsorted(dev_col, [code, code + 1])
+                ts = index['ts'][lo:hi]
+                a, b = np.searchsorted(ts, [t0, t1])
+                parts.append(index[lo + a:lo + b])
+            rows = np.concatenate(parts) if parts else np.empty(0, dtype=INDEX_DTYPE)
+        return rows[np.argsort(rows['ts'], kind='stable')]
+
+    def iter_lines(self, devices=None, start=None, end=None) -> Iterator[bytes]:
+        """Yields the archive lines for the uplinks found by 'find()'.
+        """
+        data = self._archive
+        rows = self.find(devices, start, end)
+        for offset, length in zip(rows['offset'].tolist(), rows['length'].tolist()):
+            yield data[offset:offset + length]
+
+    def iter_uplinks(self, devices=None, start=None, end=None) -> Iterator[Dict[str, Any]]:
+        """Yields the integration payloads, as dictionaries, for the uplinks found by 'find()'.
+        """
+        for lin in self.iter_lines(devices, start, end):
+            yield json.loads(lin)
+
+def test():
+    from datetime import datetime
+    import tempfile
+    import shutil
+    debug_file = Path(__file__).parent.parent / 'lora-debug.txt'
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / 'lora.json'
+        shutil.copy(debug_file, path)
+        lines = open(path, 'rb').read().splitlines()
+        all_recs = [json.loads(lin) for lin in lines]
+
+        with ArchiveIndex(path) as idx:
+            assert len(idx) == 6 and set(idx.devices) == {r['dev_id'] for r in all_recs}
+            recs = list(idx.iter_uplinks('lht65-a8404173e1822ca4', '2020-11-12T17:39:30Z', '2020-11-12 17:40:00'))
+            assert [r['counter'] for r in recs] == [255, 256]
+            assert [r['counter'] for r in idx.iter_uplinks(start='2020-11-12T17:39:50Z')] == [256, 0, 1]
+            assert list(idx.iter_uplinks('no-such-device')) == []
+
+        # lines appended later, one with a different key order, are picked up
+        rec = dict(all_recs[1], counter=257)
+        rec['metadata'] = dict(rec['metadata'], time='2020-11-12T18:00:00Z')
+        moved = {k: rec[k] for k in reversed(list(rec))}
+        with open(path, 'ab') as f:
+            f.write(json.dumps(rec).encode() + b'\n' + json.dumps(moved).encode() + b'\n')
+        with ArchiveIndex(path) as idx:
+            assert len(idx) == 8
+            recs = list(idx.iter_uplinks(['lht65-a8404173e1822ca4'], start=datetime(2020, 11, 12, 17, 45)))
+            assert [r['counter'] for r in recs] == [257, 257]
+
+        # a replaced archive is re-indexed
+        path.write_bytes(b'\n'.join(lines[:2]) + b'\n')
+        with ArchiveIndex(path) as idx:
+            assert len(idx) == 2
+
+        # ... even when the new archive has no complete line yet
+        path.write_bytes(lines[0][:20])
+        with ArchiveIndex(path) as idx:
+            assert len(idx) == 0 and idx.devices == [] and list(idx.iter_uplinks()) == []
+        path.write_bytes(b'')
+        with ArchiveIndex(path) as idx:
+            assert len(idx) == 0
+
+if __name__ == '__main__':
+    # To run this without import error, need to run "python -m decoder.archive_index" from the top level directory.
+    test()
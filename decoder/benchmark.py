@@ -0,0 +1,281 @@
+"""Benchmarks for the payload decoders and the full integration decoding path.
+
+Synthetic payloads are generated for the Dragino LHT65, several Elsys sensor layouts
+(including the 64 value grideye and multiple 'extTemperature2' channels) and complete Things
+Network HTTP Integration posts.  For each case the throughput (messages/sec), the per-call
+latency percentiles and the memory allocated per message are measured.
+
+Results can be appended to a JSON-lines file, tagged with the git revision, so that the
+results from different versions of the code can be compared:
+
+    python -m decoder.benchmark --save benchmarks.jsonl
+    python -m decoder.benchmark --compare benchmarks.jsonl
+
+Run from the top level directory.
+"""
+from typing import Dict, Any, List, Callable, Optional, Tuple
+from pathlib import Path
+import argparse
+import base64
+import json
+import platform
+import random
+import struct
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from . import decode_elsys
+from . import decode_dragino
+from .decoder import decode
+
+# Percentiles of per-call latency that are reported
+PERCENTILES = (50, 90, 99)
+
+# A drop in throughput larger than this fraction is reported as a regression
+REGRESSION_THRESHOLD = 0.10
+
+def lht65_payloads(count: int, seed: int = 0) -> List[bytes]:
+    """Returns 'count' LHT65 payloads with an external temperature probe.
+    """
+    rng = random.Random(seed)
+    return [
+        struct.pack(
+            '>HhHBhH',
+            0xC000 | rng.randint(2900, 3100),       # battery status and voltage, mV
+            rng.randint(-2000, 3000),               # internal temperature, 0.01 deg C
+            rng.randint(200, 900),                  # humidity, 0.1 %
+            1,                                      # external sensor type: temperature
+            rng.randint(-2000, 3000),               # external temperature
+            0x7FFF)
+        for _ in range(count)
+    ]
+
+def elsys_payloads(count: int, kind: str = 'ers', seed: int = 0) -> List[bytes]:
+    """Returns 'count' Elsys payloads.  'kind' is 'ers' (temperature, humidity, light, motion
+    and battery), 'elt2' (an ELT-2 with two 'extTemperature2' channels) or 'grideye' (an ERS
+    Eye with the 64 value grideye block).
+    """
+    rng = random.Random(seed)
+    res = []
+    for _ in range(count):
+        temp = struct.pack('>Bh', 0x01, rng.randint(-100, 300))
+        hum = struct.pack('>BB', 0x02, rng.randint(10, 90))
+        vdd = struct.pack('>BH', 0x07, rng.randint(3400, 3700))
+        if kind == 'ers':
+            payload = temp + hum + struct.pack('>BHBB', 0x04, rng.randint(0, 500), 0x05, rng.randint(0, 5)) + vdd
+        elif kind == 'elt2':
+            ext = b''.join(struct.pack('>Bh', 0x19, rng.randint(-400, 400)) for _ in range(2))
+            payload = temp + hum + ext + vdd
+        elif kind == 'grideye':
+            grid = bytes([0x13, rng.randint(15, 25)] + [rng.randint(0, 255) for _ in range(64)])
+            payload = temp + hum + grid + vdd
+        else:
+            raise ValueError(f'Unknown Elsys payload kind: {kind}')
+        res.append(payload)
+    return res
+
+def integration_payloads(count: int, seed: int = 0) -> List[Dict[str, Any]]:
+    """Returns 'count' Things Network HTTP Integration posts from a mix of LHT65, Elsys ERS
+    and ELT-2 devices, each received by 1 to 3 gateways.
+    """
+    rng = random.Random(seed)
+    devices = [
+        ('lht65-a8404173e1822ca4', 'A8404173E1822CA4', 2, lambda: lht65_payloads(1, rng.random())[0]),
+        ('ers-a81758fffe04259e', 'A81758FFFE04259E', 5, lambda: elsys_payloads(1, 'ers', rng.random())[0]),
+        ('elt2-a81758fffe05368e', 'A81758FFFE05368E', 5, lambda: elsys_payloads(1, 'elt2', rng.random())[0]),
+    ]
+    gateways = ['eui-a840411d91b44150', 'eui-58a0cbfffe8015fd', 'kl4qh-mtcdt3']
+    res = []
+    for i in range(count):
+        dev_id, eui, port, make_payload = devices[i % len(devices)]
+        sec = i * 7
+        res.append({
+            'app_id': 'bench', 'dev_id': dev_id, 'hardware_serial': eui, 'port': port, 'counter': i,
+            'payload_raw': base64.b64encode(make_payload()).decode(),
+            'metadata': {
+                'time': f'2020-11-12T{sec // 3600 % 24:02d}:{sec // 60 % 60:02d}:{sec % 60:02d}.{rng.randrange(10**9):09d}Z',
+                'data_rate': 'SF7BW125',
+                'gateways': [
+                    {'gtw_id': gtw, 'snr': rng.uniform(-15, 12), 'rssi': rng.randint(-120, -40)}
+                    for gtw in rng.sample(gateways, rng.randint(1, 3))
+                ],
+            },
+        })
+    return res
+
+def cases(count: int, seed: int = 0) -> Dict[str, Tuple[Callable, List[Any]]]:
+    """Returns the benchmark cases, mapping case name to (function, list of inputs).
+    """
+    return {
+        'lht65': (decode_dragino.decode_lht65, lht65_payloads(count, seed)),
+        'elsys_ers': (decode_elsys.decode, elsys_payloads(count, 'ers', seed)),
+        'elsys_elt2': (decode_elsys.decode, elsys_payloads(count, 'elt2', seed)),
+        'elsys_grideye': (decode_elsys.decode, elsys_payloads(count, 'grideye', seed)),
+        'integration': (decode, integration_payloads(count, seed)),
+    }
+
+def measure(func: Callable, inputs: List[Any], repeat: int = 3) -> Dict[str, float]:
+    """Returns the performance of calling 'func' on each of 'inputs'.  Throughput is the best
+    of 'repeat' passes.  Latencies are timed per call, so they include a small timing overhead.
+    Memory is reported as the bytes held by each result and the median peak of the memory
+    allocated during a call, which includes temporary objects.
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for item in inputs:
+            func(item)
+        best = min(best, time.perf_counter() - start)
+
+    clock = time.perf_counter_ns
+    latencies = []
+    for item in inputs:
+        start = clock()
+        func(item)
+        latencies.append(clock() - start)
+    latencies.sort()
+
+    tracemalloc.start()
+    try:
+        base = tracemalloc.get_traced_memory()[0]
+        results = [func(item) for item in inputs]
+        held = tracemalloc.get_traced_memory()[0] - base
+        del results
+        peaks = []
+        for item in inputs[:1000]:
+            tracemalloc.reset_peak()
+            current = tracemalloc.get_traced_memory()[0]
+            func(item)
+            peaks.append(tracemalloc.get_traced_memory()[1] - current)
+        peaks.sort()
+    finally:
+        tracemalloc.stop()
+
+    res = {'messages': len(inputs), 'msgs_per_sec': len(inputs) / best}
+    for pct in PERCENTILES:
+        ix = min(len(latencies) - 1, len(latencies) * pct // 100)
+        res[f'p{pct}_usec'] = latencies[ix] / 1000
+    res['bytes_per_msg'] = held / len(inputs)
+    res['peak_bytes_per_call'] = peaks[len(peaks) // 2]
+    return res
+
+def git_revision() -> str:
+    """Returns the short git revision of the code, with '-dirty' added if there are
+    uncommitted changes, or 'unknown' if it can't be determined.
+    """
+    repo = Path(__file__).resolve().parent.parent
+    try:
+        rev = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=repo,
+                             capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=repo,
+                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return rev + '-dirty' if dirty else rev
+
+def run(count: int = 20000, seed: int = 0, names: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+    """Runs the benchmark cases in 'names' (all cases if None) with 'count' messages each and
+    returns a list of result dictionaries.
+    """
+    rev = git_revision()
+    when = time.strftime('%Y-%m-%dT%H:%M:%S')
+    results = []
+    for name, (func, inputs) in cases(count, seed).items():
+        if names and name not in names:
+            continue
+        res = {'rev': rev, 'time': when, 'python': platform.python_version(), 'case': name}
+        res.update(measure(func, inputs))
+        results.append(res)
+    return results
+
+def print_results(results: List[Dict[str, Any]]):
+    cols = ['msgs_per_sec'] + [f'p{pct}_usec' for pct in PERCENTILES] + ['bytes_per_msg', 'peak_bytes_per_call']
+    print(f'{"case":16}' + ''.join(f'{c:>20}' for c in cols))
+    for res in results:
+        print(f'{res["case"]:16}' + ''.join(f'{res[c]:20,.1f}' for c in cols))
+
+def save(results: List[Dict[str, Any]], path):
+    """Appends results to the JSON-lines file at 'path'.
+    """
+    with open(path, 'a') as f:
+        for res in results:
+            f.write(json.dumps(res) + '\n')
+
+def compare(path, base: Optional[str] = None, new: Optional[str] = None) -> List[str]:
+    """Prints the change in throughput for each case between revisions 'base' and 'new' in
+    the results file at 'path'.  By default the last two revisions in the file are compared.
+    If a revision was run more than once, its latest results are used.  Returns the list of
+    cases whose throughput dropped by more than REGRESSION_THRESHOLD.
+    """
+    by_rev: Dict[str, Dict[str, Dict[str, Any]]] = {}
+    for lin in open(path):
+        if lin.strip():
+            res = json.loads(lin)
+            by_rev.setdefault(res['rev'], {})[res['case']] = res
+            by_rev[res['rev']] = by_rev.pop(res['rev'])     # keeps revisions in order of last run
+    revs = list(by_rev)
+    if new is None:
+        new = revs[-1]
+    if base is None:
+        older = [rev for rev in revs if rev != new]
+        if not older:
+            raise ValueError('The results file has only one revision.')
+        base = older[-1]
+
+    regressions = []
+    print(f'{"case":16}{base:>16}{new:>16}{"change":>10}')
+    for case, res in by_rev[new].items():
+        if case not in by_rev[base]:
+            continue
+        old_rate, new_rate = by_rev[base][case]['msgs_per_sec'], res['msgs_per_sec']
+        change = new_rate / old_rate - 1.0
+        flag = ''
+        if change < -REGRESSION_THRESHOLD:
+            regressions.append(case)
+            flag = '  REGRESSION'
+        print(f'{case:16}{old_rate:16,.0f}{new_rate:16,.0f}{change:10.1%}{flag}')
+    return regressions
+
+def test():
+    import tempfile
+    # the synthetic payloads decode to the expected fields
+    assert 'extTemperature' in decode_dragino.decode_lht65(lht65_payloads(1)[0])
+    assert len(decode_elsys.decode(elsys_payloads(1, 'elt2')[0])['extTemperature2']) == 2
+    assert len(decode_elsys.decode(elsys_payloads(1, 'grideye')[0])['grideye']) == 64
+    rec = decode(integration_payloads(2)[1])
+    assert rec['device_id'].startswith('ers') and 'light' in rec['fields']
+
+    results = run(count=200)
+    assert [r['case'] for r in results] == list(cases(1))
+    assert all(r['msgs_per_sec'] > 0 and r['p50_usec'] <= r['p99_usec'] for r in results)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / 'bench.jsonl'
+        save(results, path)
+        slower = [dict(r, rev='next', msgs_per_sec=r['msgs_per_sec'] * 0.5) for r in results]
+        save(slower, path)
+        assert compare(path) == list(cases(1))
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Benchmark the LoRaWAN payload decoders.')
+    parser.add_argument('-n', '--count', type=int, default=20000, help='messages per case')
+    parser.add_argument('--case', action='append', help='case to run; may be repeated')
+    parser.add_argument('--save', metavar='PATH', help='append the results to this JSON-lines file')
+    parser.add_argument('--compare', metavar='PATH', help='compare the last two revisions in this results file')
+    parser.add_argument('--test', action='store_true', help='run the self test')
+    opts = parser.parse_args(args)
+
+    if opts.test:
+        test()
+        return
+    if opts.compare:
+        sys.exit(1 if compare(opts.compare) else 0)
+    results = run(opts.count, names=opts.case)
+    print_results(results)
+    if opts.save:
+        save(results, opts.save)
+
+if __name__ == '__main__':
+    # To run this without import error, need to run "python -m decoder.benchmark" from the top level directory.
+    main()
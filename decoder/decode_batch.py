@@ -0,0 +1,412 @@
+"""Module for decoding many payloads of one sensor type at once.  Instead of one dictionary
+per payload, the results are returned in columnar form:  a dictionary mapping each field name
+to a NumPy float array holding that field's value for every payload.  Payloads that don't
+include a particular field (or that could not be decoded) have a NaN value in that field's
+array.  Field names are the same as those produced by the single payload decoders, with value
+lists flattened as done by 'decoder.decode()' (e.g. 'extTemperature2_0', 'extTemperature2_1').
+
+Payloads can be given as a sequence of byte arrays, or as one concatenated buffer plus a
+sequence of offsets:  payload k is buffer[offsets[k]:offsets[k + 1]], so 'offsets' has one
+more element than the number of payloads.
+
+Requires NumPy, which is not needed by the single payload decoders.
+"""
+from typing import Dict, Sequence, Optional, List, Tuple
+import re
+from collections import defaultdict
+from functools import lru_cache
+
+import numpy as np
+
+from . import decode_elsys
+
+def _payload_list(payloads, offsets: Optional[Sequence[int]]) -> List:
+    """Returns a list of payload buffers from the 'payloads' and 'offsets' arguments
+    described in the module docstring.
+    """
+    if offsets is None:
+        return list(payloads)
+    buf = memoryview(payloads)
+    return [buf[offsets[k]:offsets[k + 1]] for k in range(len(offsets) - 1)]
+
+class _Columns:
+    """Accumulates NaN-filled float columns for a fixed number of rows.
+    """
+    def __init__(self, row_count: int):
+        self.row_count = row_count
+        self.cols: Dict[str, np.ndarray] = {}
+
+    def set(self, name: str, rows, values):
+        col = self.cols.get(name)
+        if col is None:
+            col = np.full(self.row_count, np.nan)
+            self.cols[name] = col
+        col[rows] = values
+
+# --------------------------------- Dragino LHT65 -------------------------------------
+
+# Layout of an 11 byte LHT65 payload
+LHT65_DTYPE = np.dtype([
+    ('bat', '>u2'),         # battery voltage in mV, 2 MSBits are battery status
+    ('temp', '>i2'),        # internal temperature, 0.01 deg C
+    ('hum', '>u2'),         # humidity, 0.1 %
+    ('ext_type', 'u1'),     # external sensor type; MSBit is cable status
+    ('ext', '>u2'),         # external sensor value
+    ('unused', 'V2'),
+])
+
+def decode_lht65_batch(payloads, offsets: Optional[Sequence[int]] = None) -> Dict[str, np.ndarray]:
+    """Decodes many Dragino LHT65 payloads, returning columns of values that match the
+    results of 'decode_dragino.decode_lht65()'.  If 'payloads' is a single bytes-like object
+    and 'offsets' is not given, it is treated as back-to-back 11 byte payloads.
+    """
+    if offsets is None and isinstance(payloads, (bytes, bytearray, memoryview)):
+        buf = payloads
+    else:
+        items = _payload_list(payloads, offsets)
+        if any(len(p) != LHT65_DTYPE.itemsize for p in items):
+            raise ValueError(f'LHT65 payloads must be {LHT65_DTYPE.itemsize} bytes long.')
+        buf = b''.join(items)
+    if len(buf) % LHT65_DTYPE.itemsize:
+        raise ValueError(f'LHT65 buffer length must be a multiple of {LHT65_DTYPE.itemsize} bytes.')
+    recs = np.frombuffer(buf, dtype=LHT65_DTYPE)
+
+    res = {
+        'temperature': recs['temp'] / 100 * 1.8 + 32.0,
+        'humidity': recs['hum'] / 10,
+        'vdd': (recs['bat'] & 0x3FFF) / 1000,
+    }
+
+    cols = _Columns(len(recs))
+    ext_type = recs['ext_type'] & 0x7F
+    ext = recs['ext'].astype(np.int64)
+
+    # external temperature, not present if no sensor connected (0x7FFF)
+    rows = (ext_type == 1) & (ext != 0x7FFF)
+    if rows.any():
+        temp = ext[rows]
+        temp = np.where(temp & 0x8000, temp - 0x10000, temp)
+        cols.set('extTemperature', rows, temp / 100 * 1.8 + 32.0)
+    rows = ext_type == 4
+    if rows.any():
+        cols.set('digital', rows, ext[rows] >> 8)
+        cols.set('interrupt', rows, ext[rows] & 0xFF)
+    rows = ext_type == 5
+    if rows.any():
+        cols.set('light', rows, ext[rows])
+    rows = ext_type == 6
+    if rows.any():
+        cols.set('analog', rows, ext[rows] / 1000)
+    rows = ext_type == 7
+    if rows.any():
+        cols.set('pulse', rows, ext[rows])
+
+    res.update(cols.cols)
+    return res
+
+# ------------------------------ Dragino LT-22222-L -----------------------------------
+
+# Layout of an 11 byte LT-22222-L payload in working mode 1
+LT22222_DTYPE = np.dtype([
+    ('avi1', '>i2'),        # analog voltage inputs, mV
+    ('avi2', '>i2'),
+    ('aci1', '>i2'),        # analog current inputs, uA
+    ('aci2', '>i2'),
+    ('dio', 'u1'),          # digital input, digital output and relay status bits
+    ('reserved', 'u1'),
+    ('mode', 'u1'),         # working mode in the 6 LSBits
+])
+
+def decode_lt22222_batch(payloads, offsets: Optional[Sequence[int]] = None) -> Dict[str, np.ndarray]:
+    """Decodes many Dragino LT-22222-L payloads, returning columns of values that match the
+    results of 'decode_dragino.decode_lt22222()'.  Payloads that are not in working mode 1
+    have NaN values.  'payloads' can also be a 2D uint8 array with one payload per row, or a
+    single bytes-like object holding back-to-back 11 byte payloads.
+    """
+    if isinstance(payloads, np.ndarray):
+        buf = np.ascontiguousarray(payloads, dtype=np.uint8).tobytes()
+    elif offsets is None and isinstance(payloads, (bytes, bytearray, memoryview)):
+        buf = payloads
+    else:
+        items = _payload_list(payloads, offsets)
+        if any(len(p) != LT22222_DTYPE.itemsize for p in items):
+            raise ValueError(f'LT-22222-L payloads must be {LT22222_DTYPE.itemsize} bytes long.')
+        buf = b''.join(items)
+    if len(buf) % LT22222_DTYPE.itemsize:
+        raise ValueError(f'LT-22222-L buffer length must be a multiple of {LT22222_DTYPE.itemsize} bytes.')
+    recs = np.frombuffer(buf, dtype=LT22222_DTYPE)
+
+    rows = (recs['mode'] & 0x3F) == 1
+    cols = _Columns(len(recs))
+    recs = recs[rows]
+    cols.set('analog', rows, recs['avi1'] / 1000)
+    cols.set('analog2', rows, recs['avi2'] / 1000)
+    cols.set('current', rows, recs['aci1'] / 1000)
+    cols.set('current2', rows, recs['aci2'] / 1000)
+    # the digital inputs on our units read with inverted logic
+    cols.set('digital', rows, (recs['dio'] & 0x08) == 0)
+    cols.set('digital2', rows, (recs['dio'] & 0x10) == 0)
+    return cols.cols
+
+def decode_lt22222_b64(column):
+    """Decodes a sequence (e.g. a pandas Series) of base64 encoded LT-22222-L payloads, like the
+    'payload_raw' element of an integration payload.  Returns a pandas DataFrame with a column
+    for each field and the same index as 'column' (if it has one).
+    """
+    import pandas as pd
+    cols = decode_lt22222_batch(b64decode_array(column))
+    return pd.DataFrame(cols, index=column.index if isinstance(column, pd.Series) else None)
+
+# Maps the ASCII code of a base64 character to its 6 bit value; 255 marks invalid characters.
+# The '=' padding character is given 0 value; the bytes it produces are dropped.
+_B64_VALUES = np.full(256, 255, dtype=np.uint8)
+_B64_VALUES[np.frombuffer(b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/', dtype=np.uint8)] = np.arange(64)
+_B64_VALUES[ord('=')] = 0
+
+def b64decode_array(strings: Sequence[str]) -> np.ndarray:
+    """Decodes a sequence of base64 strings that all encode the same number of bytes, returning
+    a 2D uint8 array with one row per string.  The decoding is done with array operations
+    instead of a base64.b64decode() call per string.  Raises ValueError if the strings have
+    different lengths or padding.
+    """
+    strings = list(strings)
+    if not strings:
+        return np.zeros((0, 0), dtype=np.uint8)
+    enc = ''.join(strings).encode('ascii')
+    str_len = len(strings[0])
+    if str_len % 4 or len(enc) != str_len * len(strings) or any(len(s) != str_len for s in strings):
+        raise ValueError('The base64 strings must all have the same length, a multiple of 4.')
+    # every string must end with the same padding, and have no '=' anywhere else.
+    padding = len(strings[0]) - len(strings[0].rstrip('='))
+    if padding > 2 or enc.count(b'=') != padding * len(strings) \
+            or not all(s.endswith('=' * padding) for s in strings):
+        raise ValueError('The base64 strings must all have the same padding.')
+    byte_count = str_len // 4 * 3 - padding
+
+    vals = _B64_VALUES[np.frombuffer(enc, dtype=np.uint8)]
+    if (vals == 255).any():
+        raise ValueError('Invalid base64 character.')
+    # each group of 4 characters holds 24 bits, which become 3 bytes.
+    vals = vals.reshape(len(strings), -1, 4).astype(np.uint32)
+    bits = vals[..., 0] << 18 | vals[..., 1] << 12 | vals[..., 2] << 6 | vals[..., 3]
+    out = np.stack((bits >> 16, bits >> 8, bits), axis=-1).astype(np.uint8)
+    return np.ascontiguousarray(out.reshape(len(strings), -1)[:, :byte_count])
+
+# ------------------------------------- Elsys -----------------------------------------
+
+# Data width of each Elsys sensor type code, -1 for invalid codes
+_ELSYS_WIDTHS = np.full(256, -1, dtype=np.int64)
+for _code, _sensor in decode_elsys.SENSOR_TYPES.items():
+    _ELSYS_WIDTHS[_code] = _sensor.width
+
+# Elsys type codes, plus the 0 filler used below, are less than _CODE_BASE, so this many
+# codes can be combined into one int64 key without overflow.
+_CODE_BASE = max(decode_elsys.SENSOR_TYPES) + 1
+_MAX_KEYED_CODES = int(np.log(2**63) / np.log(_CODE_BASE))
+
+# Groups of payloads with the same shape smaller than this are decoded one at a time.
+_MIN_GROUP_SIZE = 8
+
+def _numpy_types(st) -> List[str]:
+    """Returns a list of NumPy type strings, one for each value unpacked by the
+    struct.Struct 'st'.
+    """
+    fmt = st.format
+    byte_order = fmt[0]
+    types = []
+    for count, code in re.findall(r'(\d*)([a-zA-Z])', fmt[1:]):
+        np_type = np.dtype(code).newbyteorder(byte_order).str
+        types += [np_type] * int(count or 1)
+    return types
+
+@lru_cache(maxsize=1024)
+def _shape_dtype(shape: Tuple[int, ...]) -> np.dtype:
+    """Returns a structured NumPy dtype for an Elsys payload with the sensor type
+    codes in 'shape'.  Field 'sK_J' is the Jth raw value of the Kth sensor.
+    """
+    fields = []
+    for k, code in enumerate(shape):
+        fields.append((f'code{k}', 'u1'))
+        for j, np_type in enumerate(_numpy_types(decode_elsys.SENSOR_TYPES[code].struct)):
+            fields.append((f's{k}_{j}', np_type))
+    return np.dtype(fields)
+
+def _elsys_shapes(arr: np.ndarray) -> Dict[Tuple[int, ...], np.ndarray]:
+    """'arr' is a 2D uint8 array of equal length Elsys payloads, one per row.  Returns a
+    dictionary mapping a shape, the sequence of sensor type codes in a payload, to the array
+    of row numbers having that shape.  Rows with an unknown type code or that don't end on a
+    sensor boundary are left out.  All payloads of one shape have the same layout.
+    """
+    row_count, length = arr.shape
+    pos = np.zeros(row_count, dtype=np.int64)      # index of the next type code in each row
+    valid = np.ones(row_count, dtype=bool)
+    code_cols = []
+    while True:
+        active = pos < length
+        if not active.any():
+            break
+        # 0 is not a sensor type code, so it is used as filler once a row is done.
+        codes = np.zeros(row_count, dtype=np.int64)
+        codes[active] = arr[active, pos[active]]
+        widths = _ELSYS_WIDTHS[codes]
+        bad = active & (widths < 0)
+        valid &= ~bad
+        pos[bad] = length + 1       # stop walking these rows
+        good = active & ~bad
+        pos[good] += widths[good] + 1
+        code_cols.append(codes)
+    valid &= pos == length
+
+    shapes = {}
+    if not code_cols:
+        return shapes
+    valid_rows = np.flatnonzero(valid)
+    code_mat = np.stack(code_cols, axis=1)[valid_rows]
+    if len(code_cols) <= _MAX_KEYED_CODES:
+        # Combine the codes of each row into one integer key, much faster to group by than
+        # the rows of the code matrix.
+        keys = np.zeros(len(valid_rows), dtype=np.int64)
+        for codes in code_mat.T:
+            keys = keys * _CODE_BASE + codes
+        _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        uniq = code_mat[first]
+    else:
+        uniq, inverse = np.unique(code_mat, axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    order = np.argsort(inverse, kind='stable')
+    bounds = np.searchsorted(inverse[order], np.arange(len(uniq) + 1))
+    for ix, codes in enumerate(uniq):
+        shapes[tuple(int(c) for c in codes if c)] = valid_rows[order[bounds[ix]:bounds[ix + 1]]]
+    return shapes
+
+def decode_elsys_batch(payloads, offsets: Optional[Sequence[int]] = None) -> Dict[str, np.ndarray]:
+    """Decodes many Elsys payloads, returning columns of values that match the results of
+    'decode_elsys.decode()' (with value lists flattened).  Payloads are grouped by shape, the
+    sequence of sensor types they contain, and each group is decoded with array operations.
+    """
+    items = _payload_list(payloads, offsets)
+    by_length = defaultdict(list)
+    for ix, data in enumerate(items):
+        by_length[len(data)].append(ix)
+
+    cols = _Columns(len(items))
+    for length, len_rows in by_length.items():
+        if length == 0:
+            continue
+        len_rows = np.array(len_rows)
+        arr = np.frombuffer(b''.join(items[ix] for ix in len_rows), dtype=np.uint8)
+        arr = arr.reshape(len(len_rows), length)
+        for shape, shape_rows in _elsys_shapes(arr).items():
+            if len(shape_rows) < _MIN_GROUP_SIZE:
+                # not worth setting up array operations for a few payloads
+                for ix in len_rows[shape_rows]:
+                    for name, val in decode_elsys.decode(items[ix]).items():
+                        if type(val) == list:
+                            for j, v in enumerate(val):
+                                cols.set(f'{name}_{j}', ix, v)
+                        else:
+                            cols.set(name, ix, val)
+                continue
+            recs = arr[shape_rows].view(_shape_dtype(shape)).ravel()
+            _decode_elsys_shape(shape, recs, len_rows[shape_rows], cols)
+
+    return cols.cols
+
+def _decode_elsys_shape(shape: Tuple[int, ...], recs: np.ndarray, rows: np.ndarray, cols: _Columns):
+    """Decodes the Elsys payloads in the structured array 'recs', which all have the sensor
+    type codes in 'shape', putting the values into 'rows' of 'cols'.
+    """
+    # count the occurrences of each repeatable field in this shape, so they can be
+    # numbered like flattened lists.
+    repeat_counts = defaultdict(int)
+    for code in shape:
+        for name in decode_elsys.SENSOR_TYPES[code].fields:
+            if name in decode_elsys.REPEATABLE_FIELDS:
+                repeat_counts[name] += 1
+    repeat_ix = defaultdict(int)
+
+    for k, code in enumerate(shape):
+        sensor = decode_elsys.SENSOR_TYPES[code]
+        raw_count = len(_numpy_types(sensor.struct))
+        vals = tuple(recs[f's{k}_{j}'].astype(np.int64) for j in range(raw_count))
+        if sensor.convert:
+            vals = sensor.convert(vals)
+        for name, val in zip(sensor.fields, vals):
+            if type(val) == list:
+                for ix, v in enumerate(val):
+                    cols.set(f'{name}_{ix}', rows, v)
+            elif repeat_counts[name] > 1:
+                cols.set(f'{name}_{repeat_ix[name]}', rows, val)
+                repeat_ix[name] += 1
+            else:
+                cols.set(name, rows, val)
+
+def test():
+    import base64
+    from . import decode_dragino
+
+    def check(cols, expected_list):
+        for row, expected in enumerate(expected_list):
+            for name, col in cols.items():
+                if name in expected:
+                    assert col[row] == expected[name], (name, row)
+                else:
+                    assert np.isnan(col[row]), (name, row)
+
+    cases = [bytes.fromhex(h) for h in (
+        'CBF60B0D0376010ADD7FFF', 'CB040B55025A0401007FFF', 'CB060B5B02770400017FFF',
+        'CB030B2D027C0501917FFF', 'CB0B0B640272060B067FFF', 'CBD50B0502E60700067FFF',
+        'CBF6FB0D0376017FFF7FFF',
+    )]
+    expected = [decode_dragino.decode_lht65(p) for p in cases]
+    check(decode_lht65_batch(cases), expected)
+    check(decode_lht65_batch(b''.join(cases)), expected)
+
+    cases = [bytes.fromhex(h) for h in ('2E472E6E025A025A080001', 'FFF62E6E025AFF5A100041', '2E472E6E025A025A080003')]
+    expected = [decode_dragino.decode_lt22222(p) for p in cases[:2]] + [{}]
+    check(decode_lt22222_batch(cases), expected)
+    b64 = [base64.b64encode(p).decode() for p in cases]
+    assert (b64decode_array(b64) == np.array([list(p) for p in cases], dtype=np.uint8)).all()
+    check(decode_lt22222_b64(b64).to_dict('list'), expected)
+    # a 10 byte payload has the same base64 length as the 11 byte ones, but more padding
+    for bad in (b64[:1] + [base64.b64encode(cases[1][:10]).decode()], ['AAA=', 'A=A=']):
+        try:
+            b64decode_array(bad)
+            assert False, bad
+        except ValueError:
+            pass
+
+    cases = [bytes.fromhex(h) for h in (
+        '0100e202290400270506060308070d6219000119FFFF',
+        '0100e202290400270506060308070d6219000119FFFF',
+        '0100f2022a0400270506060308070d62',
+        '070d6219000119FFFF1900f0',
+        '0BFFFFFFFF09010203F1F2F3',
+        '09010203F1F2F3',
+    )] + [bytes([0x13, 20] + list(range(64)) + [0x07, 0x0D, 0x62])]
+    expected = []
+    for p in cases:
+        res = {}
+        for k, v in decode_elsys.decode(p).items():
+            if type(v) == list:
+                res.update({f'{k}_{ix}': val for ix, val in enumerate(v)})
+            else:
+                res[k] = v
+        expected.append(res)
+    cols = decode_elsys_batch(cases)
+    check(cols, expected)
+    # enough copies to use array operations for each shape
+    check(decode_elsys_batch(cases * _MIN_GROUP_SIZE), expected * _MIN_GROUP_SIZE)
+
+    # concatenated buffer with offsets, including an undecodable payload
+    cases.append(b'\xff\x01')
+    expected.append({})
+    offsets = [0]
+    for p in cases:
+        offsets.append(offsets[-1] + len(p))
+    check(decode_elsys_batch(b''.join(cases), offsets), expected)
+    print('decode_batch tests passed')
+
+if __name__ == '__main__':
+    # To run this without import error, need to run "python -m decoder.decode_batch" from the top level directory.
+    test()
@@ -1,87 +1,71 @@
-"""Module for decoding the Payload from Dragino LHT65 sensors.
+"""Module for decoding the Payload from Dragino LHT65 and LT-22222-L sensors.
 See Javascript LHT65 decoder at:  http://www.dragino.com/downloads/index.php?dir=LHT65/payload_decode/
+See Javascript LT-22222-L decoder at:  http://www.dragino.com/downloads/index.php?dir=LT_LoRa_IO_Controller/LT22222-L/Decoder/
 """
 from typing import Dict, Any
-from .decode_utils import bin16dec
-
-def decode_lht65(data: bytes) -> Dict[str, Any]:
-    """Returns a dictionary of enginerring values decoded from a Dragino LHT65 Uplink Payload.
-    The payload 'data' is a byte array.
+import struct
+from .decode_utils import byte_view
+from .spec import Field, Block, FixedSpec, compile_fixed
+
+# LHT65 payload:  battery status & voltage, internal temperature, humidity and the external
+# sensor type, followed by 2 bytes of external sensor data starting at byte 7.
+# The MSBit of the external sensor type indicates whether the cable is OK:  0 = cable OK,
+# 1 = not connected.  It is masked off and not reported.  External sensor types other than
+# those listed are not decoded.
+LHT65_SPEC = FixedSpec(
+    Block((
+        Field('temperature', 2, 2, signed=True, divisor=100, unit='degF'),
+        Field('humidity', 4, 2, divisor=10),
+        Field('vdd', 0, 2, mask=0x3FFF, divisor=1000),
+        Field('_ext_sensor', 6, 1, mask=0x7F),
+    )),
+    select='_ext_sensor',
+    variants={
+        # if there is no external temperature sensor connected, the value is 0x7FFF.
+        # Don't set an output in this case.
+        1: (7, Block((Field('extTemperature', 0, 2, signed=True, divisor=100, unit='degF', missing=0x7FFF),))),
+        # 'interrupt' indicates if transmission was due to an interrupt on the external
+        # digital input.
+        4: (7, Block((Field('digital', 0), Field('interrupt', 1)))),
+        5: (7, Block((Field('light', 0, 2),))),
+        6: (7, Block((Field('analog', 0, 2, divisor=1000),))),
+        7: (7, Block((Field('pulse', 0, 2),))),
+    },
+)
+
+decode_lht65 = compile_fixed(LHT65_SPEC, 'decode_lht65', """Returns a dictionary of enginerring values decoded from a Dragino LHT65 Uplink Payload.
+    The payload 'data' is a byte array, or any object supporting the buffer protocol.
     Converts temperatures to Fahrenheit instead of Celsius like the original Dragino decoder.
     Kept naming of results elements consistent with the Elsys decoder.
+    """)
+
+# LT-22222-L payload:  two analog voltages, two analog currents, the digital input status,
+# a byte not used here, and the working mode.
+_LT22222 = struct.Struct('>hhhhBxB')
+
+def decode_lt22222(data: bytes) -> Dict[str, Any]:
+    """Returns a dictionary of engineering values decoded from a Dragino LT-22222-L Uplink
+    Payload.  The payload 'data' is a byte array, or any object supporting the buffer protocol.
+    Only the default working mode (MOD=1: two analog voltage inputs, two analog current inputs
+    and two digital inputs) is supported; a ValueError is raised for other modes.
+    Voltages are in Volts and currents in milliamps.
     """
-
-    # holds the dictionary of results
-    res = {}
-
-    def int16(ix: int) -> int:
-        """Returns a 16-bit integer from the 2 bytes starting at index 'ix' in data byte array.
-        """
-        return (data[ix] << 8) | (data[ix + 1])
-
-    # Each of the functions below decodes one sensor type.  The function access the 'data' byte
-    # array parameter from the enclosing 'decode' function.  The following functions also add
-    # key/value elements to the 'res' results dictionary.
-    
-    def temp_int():
-        temp = int16(2)
-        temp = bin16dec(temp) / 100
-        res['temperature'] = temp * 1.8 + 32.0
-
-    def humidity():
-        res['humidity'] = int16(4) / 10
-
-    def vdd():
-        res['vdd'] = (int16(0) & 0x3FFF) / 1000
-
-    def temp_ext():
-        temp = int16(7)
-        # if there is no external temperature sensor connected, the above will return 0x7FFF.
-        # Don't set an output in this case.
-        if temp == 0x7FFF:
-            return
-        temp = bin16dec(temp) / 100
-        res['extTemperature'] = temp * 1.8 + 32.0
-
-    def digital():
-        res['digital'] = data[7]
-        # indicates if transmission was due to an interrupt on the external digital input.
-        res['interrupt'] = data[8]
-
-    def light():
-        res['light'] = int16(7)
-
-    def analog():
-        res['analog'] = int16(7) / 1000
-
-    def pulse():
-        res['pulse'] = int16(7)
-
-    # Always decode the internal sensors
-    temp_int()
-    humidity()
-    vdd()
-
-    # Get the type of external sensor
-    # The MSBit indicates whether the cable is OK:  0 = cable OK, 1 = not connected
-    # We're masking it here and not transmitting it.
-    ext_sensor = data[6] & 0x7F    
-
-    if ext_sensor == 0:
-        # no external sensor
-        pass
-    elif ext_sensor == 1:
-        temp_ext()
-    elif ext_sensor == 4:
-        digital()
-    elif ext_sensor == 5:
-        light()
-    elif ext_sensor == 6:
-        analog()
-    elif ext_sensor == 7:
-        pulse()
-
-    return res
+    if type(data) is not bytes:
+        data = byte_view(data)
+    avi1, avi2, aci1, aci2, dio, mode = _LT22222.unpack_from(data)
+    mode &= 0x3F
+    if mode != 1:
+        raise ValueError(f'LT-22222-L working mode {mode} is not supported.')
+
+    return {
+        'analog': avi1 / 1000,
+        'analog2': avi2 / 1000,
+        'current': aci1 / 1000,
+        'current2': aci2 / 1000,
+        # the digital inputs on our units read with inverted logic
+        'digital': 0 if dio & 0x08 else 1,
+        'digital2': 0 if dio & 0x10 else 1,
+    }
 
 def test():
     cases = (
@@ -97,6 +81,16 @@ def test():
         print(res)
         assert res == result
 
+    res = decode_lt22222(bytes.fromhex('2E472E6E025A025A080001'))
+    print(res)
+    assert res == {'analog': 11.847, 'analog2': 11.886, 'current': 0.602, 'current2': 0.602, 'digital': 0, 'digital2': 1}
+
+    # payloads in a slice of a larger buffer decode without copying
+    buf = bytearray(b'\xff' * 3 + bytes.fromhex(cases[0][0] + '2E472E6E025A025A080001'))
+    view = memoryview(buf)
+    assert decode_lht65(view[3:14]) == cases[0][1]
+    assert decode_lt22222(view[14:]) == res
+
 if __name__ == '__main__':
     # To run this without import error, need to run "python -m decoder.decode_lht65" from the top level directory.
     test()
\ No newline at end of file
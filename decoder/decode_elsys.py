@@ -1,12 +1,175 @@
 """Module for decoding the Payload from Elsys LoRaWAN sensors.
 See Javascript Elsys decoder at:  https://www.elsys.se/en/elsys-payload/
 """
-from typing import Dict, Any
-from .decode_utils import bin16dec, bin8dec
+from typing import Dict, Any, Tuple, Optional, Iterable, Iterator, FrozenSet
+from collections.abc import Mapping
+from functools import lru_cache
+
+from .decode_utils import byte_view
+from .spec import Field, Block, RawBlock, TLVSpec, Layout, layouts, compile_tlv, add_repeated
+
+# Conversion functions for the blocks that can't be described by Fields.  Each takes the tuple
+# of raw values unpacked from the data block and returns a tuple of result values.  They only
+# use arithmetic, with no branching on the values.
+
+def _gps(vals):
+    # lat and long are 3 byte little-endian values.  Kept the sign handling of the original
+    # decoder, which sets the upper byte of a 32 bit value instead of producing a negative number.
+    lat_lo, lat_hi, long_lo, long_hi = vals
+    lat = (lat_lo | lat_hi << 16 | (lat_hi >> 7) * (0xFF << 24)) / 10000
+    long = (long_lo | long_hi << 16 | (long_hi >> 7) * (0xFF << 24)) / 10000
+    return lat, long
+
+def _grideye(vals):
+    ref = vals[0]
+    return ([ref + v / 10.0 for v in vals[1:]],)
+
+def _temp(name, offset=0):
+    # tenths of a degree C, reported in degrees F
+    return Field(name, offset, 2, signed=True, divisor=10, unit='degF')
+
+def _volts(name):
+    # changed from Elsys, result is in Volts not millivolts
+    return Field(name, 0, 2, divisor=1000)
+
+def _block(*fields) -> Block:
+    return Block(tuple(fields))
+
+# The Elsys payload format:  the block that follows each sensor type code.  Repeatable fields
+# can occur multiple times in one payload.  The first occurrence is stored as a single value;
+# further occurrences convert the value into a list of values.
+ELSYS_SPEC = TLVSpec({
+    0x01: _block(_temp('temperature')),
+    0x02: _block(Field('humidity')),
+    0x03: _block(Field('x', 0, signed=True), Field('y', 1, signed=True), Field('z', 2, signed=True)),
+    0x04: _block(Field('light', 0, 2)),
+    0x05: _block(Field('motion')),
+    0x06: _block(Field('co2', 0, 2)),
+    0x07: _block(_volts('vdd')),
+    0x08: _block(_volts('analog')),
+    0x09: RawBlock(('lat', 'long'), '<HBHB', _gps),
+    0x0A: _block(Field('pulse', 0, 2)),
+    0x0B: _block(Field('pulseAbs', 0, 4)),
+    0x0C: _block(_temp('extTemperature')),
+    0x0D: _block(Field('digital')),
+    0x0E: _block(Field('distance', 0, 2)),
+    0x0F: _block(Field('accMotion')),
+    0x10: _block(_temp('irIntTemperature'), _temp('irExtTemperature', 2)),
+    0x11: _block(Field('occupancy')),
+    0x12: _block(Field('waterleak')),
+    0x13: RawBlock(('grideye',), '>B64B', _grideye, list_length=64),
+    0x14: _block(Field('pressure', 0, 4, divisor=1000)),
+    0x15: _block(Field('soundPeak'), Field('soundAvg', 1)),
+    0x16: _block(Field('pulse2', 0, 2)),
+    0x17: _block(Field('pulseAbs2', 0, 4)),
+    0x18: _block(_volts('analog2')),
+    0x19: _block(_temp('extTemperature2')),
+    0x1A: _block(Field('digital2')),
+    0x1B: _block(Field('analogUv', 0, 4)),
+}, repeatable=('extTemperature2',))
+
+# Maps an Elsys sensor type code to the Layout of its data block.
+SENSOR_TYPES: Dict[int, Layout] = layouts(ELSYS_SPEC)
+
+REPEATABLE_FIELDS = ELSYS_SPEC.repeatable
+
+# The decoders generated from the spec, with value lists kept as lists or flattened.
+_decode_all = compile_tlv(ELSYS_SPEC, 'decode_elsys')
+_decode_all_flat = compile_tlv(ELSYS_SPEC, 'decode_elsys_flat', flatten_value_lists=True)
+
+# The decode tables used when decoding selected fields:  for each sensor type code, a tuple
+# of (unpack_from function, data width, conversion function, field names, repeatable).
+_DECODE_TABLE = {
+    code: (
+        sensor.struct.unpack_from,
+        sensor.width,
+        sensor.convert,
+        sensor.fields,
+        any(f in REPEATABLE_FIELDS for f in sensor.fields),
+    )
+    for code, sensor in SENSOR_TYPES.items()
+}
+
+def _flat_convert(convert):
+    # returns the elements of the list produced by 'convert' as separate values
+    return lambda vals: tuple(convert(vals)[0])
+
+# The table used when value lists are flattened.  List sensors produce one field per list
+# element, named with the element index appended.
+_FLAT_DECODE_TABLE = dict(_DECODE_TABLE)
+for _code, _sensor in SENSOR_TYPES.items():
+    if _sensor.list_length:
+        _unpack_from, _width, _convert, _fields, _repeatable = _DECODE_TABLE[_code]
+        _FLAT_DECODE_TABLE[_code] = (
+            _unpack_from,
+            _width,
+            _flat_convert(_convert),
+            tuple(f'{_fields[0]}_{i}' for i in range(_sensor.list_length)),
+            _repeatable,
+        )
+
+# Names of the fields whose values can be lists:  repeatable fields and list sensors.
+_LIST_FIELDS = frozenset(REPEATABLE_FIELDS) | {
+    sensor.fields[0] for sensor in SENSOR_TYPES.values() if sensor.list_length
+}
+
+def _base_name(name: str) -> str:
+    """Returns the field name for 'name', which may be the name of one flattened element of a
+    value list, e.g. 'grideye' for 'grideye_12'.
+    """
+    base, _, ix = name.rpartition('_')
+    return base if ix.isdigit() and base in _LIST_FIELDS else name
+
+@lru_cache(maxsize=256)
+def _projection(fields: FrozenSet[str], flatten_value_lists: bool) -> Dict[int, Optional[Tuple[int, ...]]]:
+    """Returns a table giving, for each sensor type code, the positions of the block's values
+    that hold one of 'fields', or None if the block is not needed.
+    """
+    wanted = {_base_name(name) for name in fields}
+    table = _FLAT_DECODE_TABLE if flatten_value_lists else _DECODE_TABLE
+    res = {}
+    for code, sensor in SENSOR_TYPES.items():
+        if sensor.list_length:
+            keep = tuple(range(len(table[code][3]))) if sensor.fields[0] in wanted else ()
+        else:
+            keep = tuple(j for j, name in enumerate(sensor.fields) if name in wanted)
+        res[code] = keep or None
+    return res
 
-def decode(data: bytes) -> Dict[str, Any]:
+def _decode_fields(data: bytes, fields: FrozenSet[str], flatten_value_lists: bool) -> Dict[str, Any]:
+    """Decodes only the sensor blocks holding 'fields'.  Other blocks are skipped using their
+    width alone, so their values are not checked.
+    """
+    res = {}
+    table = _FLAT_DECODE_TABLE if flatten_value_lists else _DECODE_TABLE
+    projection = _projection(fields, flatten_value_lists)
+    i = 0
+    data_len = len(data)
+    while i < data_len:
+        code = data[i]
+        unpack_from, width, convert, names, repeatable = table[code]
+        keep = projection[code]
+        if keep is not None:
+            vals = unpack_from(data, i + 1)
+            if convert:
+                vals = convert(vals)
+            if repeatable:
+                for j in keep:
+                    add_repeated(res, names[j], vals[j], flatten_value_lists)
+            else:
+                for j in keep:
+                    res[names[j]] = vals[j]
+        i += width + 1
+    return res
+
+def decode(
+        data: bytes,
+        flatten_value_lists: bool = False,
+        fields: Optional[Iterable[str]] = None,
+    ) -> Dict[str, Any]:
     """Returns a dictionary of enginerring values decoded from an Elsys Uplink Payload.
-    The payload 'data' is a byte array.
+    The payload 'data' is a byte array, or any object supporting the buffer protocol, like a
+    memoryview slice of a larger receive buffer; the data is not copied.
     Works with all Elsys LoRaWAN sensors.
     Converts temperatures to Fahrenheit instead of Celsius like the original Elsys decoder.
     All millivolt Voltage values are now in Volts instead of the original millivolts from Elsys.
@@ -16,193 +179,126 @@ def decode(data: bytes) -> Dict[str, Any]:
     Also, made two channel naming more consistent: first channel name does *not* input a "1"
     at the end, but the second channel of name includes a "2".  This also keeps name consistent
     with sensors that don't have a second channel, like the ELT Lite and the LHT65.
+    Some values are lists of values:  the grideye pixels, and external temperatures when there
+    are multiple channels.  If 'flatten_value_lists' is True, the list elements are instead
+    returned as separate fields, named by appending an underscore and the list index to the
+    field name, e.g. 'extTemperature2_0' and 'extTemperature2_1'.
+    If 'fields' is given, only those fields are returned, and the data blocks of other sensors
+    are skipped without being decoded.  Naming a value list field, e.g. 'grideye', or one of
+    its flattened elements, e.g. 'grideye_3', gives all the values of the list.
     """
 
-    # holds the dictionary of results
-    res = {}
+    if type(data) is not bytes:
+        data = byte_view(data)
+    if fields is not None:
+        if type(fields) is not frozenset:
+            fields = frozenset(fields)
+        return _decode_fields(data, fields, flatten_value_lists)
+
+    if flatten_value_lists:
+        return _decode_all_flat(data)
+    return _decode_all(data)
+
+class LazyFields(Mapping):
+    """The values of an Elsys payload, as a read-only mapping that decodes the data blocks of
+    a field when the field is first accessed.  Iterating over the mapping, taking its length,
+    or asking for a field the payload doesn't have decodes the whole payload.  The payload is
+    not copied, so it must not change while the mapping is in use.
+    """
+    __slots__ = ('_data', '_flatten', '_res', '_tried', '_complete')
 
-    def int16(ix: int) -> int:
-        """Returns a 16-bit integer from the 2 bytes starting at index 'ix' in data byte array.
+    def __init__(self, data: bytes, flatten_value_lists: bool = False, fields: Iterable[str] = ()):
+        """'data' and 'flatten_value_lists' are as for 'decode()'.  The 'fields' given are
+        decoded immediately.
         """
-        return (data[ix] << 8) | (data[ix + 1])
-
-    # Each of the functions below decodes one sensor type.  The function access the 'data' byte
-    # array parameter from the enclosing 'decode' function.  The following functions also add
-    # key/value elements to the 'res' results dictionary.  Each function takes an index parameter,
-    # which is the index the 'data' array where the sensor data starts; although, the i position
-    # contains the sensor type indicator, so the actual data really starts at the i+1 position.
-    # Each of the functions returns the number of bytes consumed by the actual sensor data (not
-    # counting the 1 byte consumed by the sensor type identifier.)
-
-    def temp(i: int) -> int:
-        # converts to Fahrenheit.
-        temp = int16(i+1)
-        temp = bin16dec(temp) / 10
-        res['temperature'] = temp * 1.8 + 32.0
-        return 2
-
-    def rh(i: int) -> int:
-        res['humidity'] = data[i + 1]
-        return 1
-
-    def acc(i: int) -> int:
-        res['x'] = bin8dec(data[i + 1])
-        res['y'] = bin8dec(data[i + 2])
-        res['z'] = bin8dec(data[i + 3])
-        return 3
-
-    def light(i: int) -> int:
-        res['light'] = int16(i+1)
-        return 2
-
-    def motion(i: int) -> int:
-        res['motion'] = (data[i + 1])
-        return 1
-
-    def co2(i: int) -> int:
-        res['co2'] = int16(i+1)
-        return 2
-
-    def vdd(i: int) -> int:
-        # changed from Elsys, result is in Volts not millivolts
-        res['vdd'] = int16(i+1) / 1000.
-        return 2
-
-    def analog1(i: int) -> int:
-        # changed from Elsys, result is in Volts not millivolts
-        res['analog'] = int16(i+1) / 1000.
-        return 2
-
-    def gps(i: int) -> int:
-        res['lat'] = (data[i + 1] | data[i + 2] << 8 | data[i + 3] << 16 | (0xFF << 24 if data[i + 3] & 0x80 else 0)) / 10000
-        res['long'] = (data[i + 4] | data[i + 5] << 8 | data[i + 6] << 16 | (0xFF << 24 if data[i + 6] & 0x80 else 0)) / 10000
-        return 6
-
-    def pulse1(i: int) -> int:
-        res['pulse'] = int16(i+1)
-        return 2
-
-    def pulse1_abs(i: int) -> int:
-        res['pulseAbs'] = (data[i + 1] << 24) | (data[i + 2] << 16) | (data[i + 3] << 8) | (data[i + 4])
-        return 4
-
-    def ext_temp1(i: int) -> int:
-        temp = int16(i+1)
-        temp = bin16dec(temp) / 10
-        res['extTemperature'] = temp * 1.8 + 32.0
-        return 2
-
-    def ext_digital(i: int) -> int:
-        res['digital'] = data[i + 1]
-        return 1
-
-    def ext_distance(i: int) -> int:
-        res['distance'] = int16(i+1)
-        return 2
-
-    def acc_motion(i: int) -> int:
-        res['accMotion'] = data[i + 1]
-        return 1
-
-    def ir_temp(i: int) -> int:
-        iTemp = int16(i+1)
-        iTemp = bin16dec(iTemp)
-        eTemp = int16(i + 3)
-        eTemp = bin16dec(eTemp)
-        res['irIntTemperature'] = iTemp / 10 * 1.8 + 32.0
-        res['irExtTemperature'] = eTemp / 10 * 1.8 + 32.0
-        return 4
-
-    def occupancy(i: int) -> int:
-        res['occupancy'] = data[i + 1]
-        return 1
-
-    def waterleak(i: int) -> int:
-        res['waterleak'] = data[i + 1]
-        return 1
-
-    def grideye(i: int) -> int:
-        ref = data[i+1]
-        res['grideye'] = [ref + data[i + 2 + j] / 10.0 for j in range(64)]
-        return 64
-
-    def pressure(i: int) -> int:
-        press = (data[i + 1] << 24) | (data[i + 2] << 16) | (data[i + 3] << 8) | (data[i + 4])
-        res['pressure'] = press / 1000
-        return 4
-
-    def sound(i: int) -> int:
-        res['soundPeak'] = data[i + 1]
-        res['soundAvg'] = data[i + 2]
-        return 2
-
-    def pulse2(i: int) -> int:
-        res['pulse2'] = int16(i+1)
-        return 2
-
-    def pulse2_abs(i: int) -> int:
-        res['pulseAbs2'] = (data[i + 1] << 24) | (data[i + 2] << 16) | (data[i + 3] << 8) | (data[i + 4])
-        return 4
-
-    def analog2(i: int) -> int:
-        # changed from Elsys, result is in Volts not millivolts
-        res['analog2'] = int16(i+1) / 1000.
-        return 2
-
-    def ext_temp2(i: int) -> int:
-        temp = int16(i+1)
-        temp = bin16dec(temp) / 10 * 1.8 + 32.0
+        self._data = data if type(data) is bytes else byte_view(data)
+        self._flatten = flatten_value_lists
+        fields = frozenset(fields)
+        self._res = decode(self._data, flatten_value_lists, fields) if fields else {}
+        self._tried = {_base_name(name) for name in fields}     # fields already decoded
+        self._complete = False
+
+    def _decode_all(self):
+        if not self._complete:
+            self._res = decode(self._data, self._flatten)
+            self._complete = True
+
+    def __getitem__(self, name: str):
         try:
-            exist_rd =  res['extTemperature2']
-            # there already is a Temperature 2 reading, 
-            if type(exist_rd) == list:
-                # the existing value is already a list of readings.  Append to it.
-                res['extTemperature2'].append(temp)
-            else:
-                # one existing reading. make a list.
-                res['extTemperature2'] = [exist_rd, temp]
-        except:
-            # this is the first External Temperature 2 reading.
-            res['extTemperature2'] = temp
-        
-        return 2
-
-    def ext_digital2(i: int) -> int:
-        res['digital2'] = data[i + 1]
-        return 1
-
-    def ext_analog_uv(i: int) -> int:
-        res['analogUv'] = (data[i + 1] << 24) | (data[i + 2] << 16) | (data[i + 3] << 8) | (data[i + 4])
-        return 4
-
-    # list of deconding functions, in their type indicator order.
-    decode_funcs = [temp, rh, acc, light, motion, co2,
-        vdd, analog1, gps, pulse1, pulse1_abs, ext_temp1,
-        ext_digital, ext_distance, acc_motion, ir_temp,
-        occupancy, waterleak, grideye, pressure, sound,
-        pulse2, pulse2_abs, analog2, ext_temp2, ext_digital2,
-        ext_analog_uv]
-
-    # make a dictionary that maps a sensor data type code to a decoding function
-    decode_func_map = dict(zip(range(1, len(decode_funcs) + 1), decode_funcs))
-
-    # index into payload byte array
-    i = 0
-    while i < len(data):
-        # retrieve the correct decoding function for a sensor of this type
-        cur_decode_func = decode_func_map[data[i]]
-        # the decoder function adds decoded values to the results dictionary, and it
-        # returns the number of bytes consumed by the decoded value.  Add 1 to account for the
-        # byte consumed the sensor type identifier.
-        i += cur_decode_func(i) + 1
-
-    return res
+            return self._res[name]
+        except KeyError:
+            pass
+        base = _base_name(name)
+        if base not in self._tried:
+            self._res.update(decode(self._data, self._flatten, (name,)))
+            self._tried.add(base)
+            if name in self._res:
+                return self._res[name]
+        # not in the payload, or a flattened name that needs the other values of its field.
+        self._decode_all()
+        return self._res[name]
+
+    def __iter__(self) -> Iterator[str]:
+        self._decode_all()
+        return iter(self._res)
+
+    def __len__(self) -> int:
+        self._decode_all()
+        return len(self._res)
+
+    def __repr__(self):
+        return f'LazyFields({self._res!r}, complete={self._complete})'
+
+def decode_lazy(data: bytes, flatten_value_lists: bool = False, fields: Iterable[str] = ()) -> LazyFields:
+    """Returns a LazyFields mapping of the values in the Elsys payload 'data', with 'fields'
+    already decoded.
+    """
+    return LazyFields(data, flatten_value_lists, fields)
 
 def test():
     results = decode(bytes.fromhex('0100e202290400270506060308070d6219000119FFFF'))
     print(results)
     assert results == {'temperature': 72.68, 'humidity': 41, 'light': 39, 'motion': 6, 'co2': 776, 'vdd': 3.426, 'extTemperature2': [32.18, 31.82]}
 
+    # grideye has a reference byte followed by 64 pixel bytes; make sure the sensor after it
+    # is decoded.
+    results = decode(bytes([0x13, 20] + list(range(64)) + [0x07, 0x0D, 0x62]))
+    assert results['grideye'][:3] == [20.0, 20.1, 20.2] and len(results['grideye']) == 64
+    assert results['vdd'] == 3.426
+
+    # a slice of a larger buffer
+    buf = bytearray(b'\x00\x00' + bytes([0x13, 20] + list(range(64)) + [0x07, 0x0D, 0x62]))
+    assert decode(memoryview(buf)[2:]) == results
+
+    # flattened value lists
+    results = decode(bytes.fromhex('0100e202290400270506060308070d6219000119FFFF'), flatten_value_lists=True)
+    assert results['extTemperature2_0'] == 32.18 and results['extTemperature2_1'] == 31.82
+    assert 'extTemperature2' not in results
+    results = decode(bytes([0x13, 20] + list(range(64)) + [0x07, 0x0D, 0x62]), flatten_value_lists=True)
+    assert results['grideye_2'] == 20.2 and results['grideye_63'] == 26.3 and 'grideye' not in results
+
+    # decoding selected fields gives the same values as decoding everything
+    payload = bytes.fromhex('0100e202290400270506060308070d6219000119FFFF0301FE7F')
+    full = decode(payload)
+    assert decode(payload, fields=['vdd']) == {'vdd': 3.426}
+    assert decode(payload, fields=('humidity', 'extTemperature2', 'y', 'nothing')) == \
+        {'humidity': 41, 'extTemperature2': [32.18, 31.82], 'y': -2}
+    flat = decode(payload, flatten_value_lists=True)
+    assert decode(payload, True, ['extTemperature2_1']) == \
+        {'extTemperature2_0': flat['extTemperature2_0'], 'extTemperature2_1': flat['extTemperature2_1']}
+    grideye = bytes([0x13, 20] + list(range(64)) + [0x07, 0x0D, 0x62])
+    assert decode(grideye, True, {'grideye_5'}) == {f'grideye_{i}': 20 + i / 10 for i in range(64)}
+    # a block that isn't requested is skipped without being checked
+    assert decode(payload + b'\x07\x0d', fields=('co2',)) == {'co2': 776}
+
+    # lazy decoding
+    lazy = decode_lazy(payload, fields=['vdd'])
+    assert lazy['vdd'] == 3.426 and lazy['co2'] == 776 and 'pressure' not in lazy
+    assert lazy.get('light') == 39 and lazy.get('analog') is None
+    assert dict(lazy) == full and len(lazy) == len(full)
+    lazy = decode_lazy(payload, flatten_value_lists=True)
+    assert lazy['extTemperature2_1'] == flat['extTemperature2_1'] and dict(lazy) == flat
+
 if __name__ == "__main__":
     # To run this without import error, need to run "python -m decoder.decode_elsys" from the top level directory.
     test()
@@ -1,5 +1,14 @@
 """Some utilities to assist in decoding LoRaWAN payloads.
 """
+from datetime import datetime, timezone
+from functools import lru_cache
+import calendar
+import hashlib
+import numbers
+
+# Number of bytes at the start of an append-only file, and before the end of the part already
+# processed, that are checked to confirm the file has only been appended to.
+CHECK_BYTES = 4096
 
 def bin16dec(bin: int) -> int:
     """Returns a signed integer from the first 16 bits of an integer
@@ -12,3 +21,124 @@ def bin8dec(bin: int) -> int:
     """
     num = bin & 0xFF
     return num - 0x0100 if 0x80 & num else num
+
+def byte_view(data):
+    """Returns the payload 'data', which can be any object supporting the buffer protocol
+    (bytes, bytearray, mmap, a memoryview slice of a larger buffer, etc.), as an object that
+    indexes by byte and can be passed to 'struct.unpack_from()', without copying the data.
+    """
+    if type(data) is bytes:
+        return data
+    view = memoryview(data)
+    return view if view.format == 'B' and view.ndim == 1 else view.cast('B')
+
+@lru_cache(maxsize=1024)
+def _second_timestamp(prefix: str) -> int:
+    """Returns the UNIX timestamp of the UTC date/time 'prefix', formatted as
+    'YYYY-MM-DDTHH:MM:SS'.  Raises ValueError if 'prefix' is not in that format.
+    Cached because messages arriving in the same second share the prefix.
+    """
+    parts = (prefix[0:4], prefix[5:7], prefix[8:10], prefix[11:13], prefix[14:16], prefix[17:19])
+    if prefix[4] != '-' or prefix[7] != '-' or prefix[13] != ':' or prefix[16] != ':' \
+            or not all(p.isdigit() for p in parts):
+        raise ValueError(f'Not an RFC3339 date/time: {prefix}')
+    dt = datetime(*(int(p) for p in parts))      # validates the ranges of the values
+    return calendar.timegm(dt.timetuple())
+
+def rfc3339_timestamp(ts: str) -> float:
+    """Returns the UNIX timestamp of the RFC3339 UTC date/time string 'ts', as produced by
+    the Things Network, e.g. '2020-11-12T17:37:20.211179423Z'.  Fractional seconds are
+    truncated to microseconds.  Strings in other formats are parsed with dateutil.  The result
+    is identical to dateutil.parser.parse(ts).timestamp().
+    """
+    try:
+        if ts[-1] == 'Z' and ts[10] == 'T':
+            secs = _second_timestamp(ts[:19])
+            if len(ts) == 20:
+                return float(secs)
+            frac = ts[20:-1]
+            if ts[19] == '.' and frac.isdigit():
+                # same arithmetic as datetime.timestamp(), so results match exactly
+                return (secs * 1000000 + int(frac[:6].ljust(6, '0'))) / 1000000
+    except (ValueError, IndexError):
+        pass
+
+    # imported here so the decoders don't require dateutil unless it is needed.
+    from dateutil.parser import parse
+    return parse(ts).timestamp()
+
+def unix_timestamp(tm) -> float:
+    """Converts a UNIX timestamp, a datetime or an ISO format string, e.g. '2020-11-12 17:00',
+    to a UNIX timestamp.  Times without a timezone are taken to be UTC.
+    """
+    if isinstance(tm, numbers.Real):
+        return float(tm)
+    if isinstance(tm, str):
+        if tm.endswith('Z'):
+            return rfc3339_timestamp(tm)
+        tm = datetime.fromisoformat(tm)
+    if tm.tzinfo is None:
+        tm = tm.replace(tzinfo=timezone.utc)
+    return tm.timestamp()
+
+def append_check(f, size: int) -> str:
+    """Returns a hash of the bytes at the start of the open binary file 'f' and the bytes
+    before 'size'.  If the hash is unchanged the next time the file is read, the first 'size'
+    bytes can be assumed unchanged, i.e. the file has only been appended to.
+    """
+    f.seek(0)
+    head = f.read(min(size, CHECK_BYTES))
+    f.seek(max(0, size - CHECK_BYTES))
+    tail = f.read(min(size, CHECK_BYTES))
+    return hashlib.sha1(head + tail).hexdigest()
+
+def test():
+    import io
+    from dateutil.parser import parse
+    cases = (
+        '2020-11-12T17:37:20.211179423Z',
+        '2020-11-12T17:37:20.9999999Z',
+        '2020-11-12T17:37:20.5Z',
+        '2020-11-12T17:37:20Z',
+        '2020-12-31T23:59:59.000001Z',
+        '1969-07-20T20:17:40.123Z',
+        '2020-11-12T17:37:20.211179423+02:00',
+        '2020-11-12 17:37:20.21Z',
+    )
+    for ts in cases:
+        assert rfc3339_timestamp(ts) == parse(ts).timestamp(), ts
+
+    for bad in ('2020-13-12T17:37:20Z', 'garbage'):
+        try:
+            rfc3339_timestamp(bad)
+            assert False, bad
+        except ValueError:
+            pass
+
+    assert bin16dec(0xFFFF) == -1 and bin8dec(0x80) == -128
+
+    assert unix_timestamp('2020-11-12 17:37:20') == unix_timestamp('2020-11-12T17:37:20Z') \
+        == unix_timestamp(datetime(2020, 11, 12, 17, 37, 20)) == 1605202640.0
+
+    data = bytes(range(256)) * 100
+    check = append_check(io.BytesIO(data[:10000]), 10000)
+    assert append_check(io.BytesIO(data), 10000) == check
+    assert append_check(io.BytesIO(b'x' + data[1:]), 10000) != check
+    assert append_check(io.BytesIO(data[:100]), 50) == append_check(io.BytesIO(data[:50]), 50)
+
+def bench():
+    """Prints the time to parse a Things Network timestamp with dateutil and with
+    'rfc3339_timestamp()'.
+    """
+    from timeit import timeit
+    from dateutil.parser import parse
+    # timestamps of consecutive messages, several per second
+    stamps = [f'2020-11-12T17:37:{sec:02d}.{ix * 123457:09d}Z' for sec in range(60) for ix in range(8)]
+    for label, func in (('dateutil', lambda s: parse(s).timestamp()), ('rfc3339_timestamp', rfc3339_timestamp)):
+        secs = timeit(lambda: [func(s) for s in stamps], number=20)
+        print(f'{label:20} {secs / (20 * len(stamps)) * 1e6:8.2f} usec per message')
+
+if __name__ == '__main__':
+    # To run this without import error, need to run "python -m decoder.decode_utils" from the top level directory.
+    test()
+    bench()
@@ -1,19 +1,46 @@
 """Module that decodes a LoRaWAN HTTP Integration payload into a field/value sensor
 reading dictionary for certain supported sensor types.
 """
-from typing import Dict, Any
-import base64
-
-from dateutil.parser import parse
+from typing import Dict, Any, Optional, Union, Iterable
+from functools import partial
+import binascii
 
 from . import decode_elsys
 from . import decode_dragino
+from .decode_utils import rfc3339_timestamp
+from .registry import default_registry
+from .payload_cache import PayloadCache
+from .signal_stats import SignalStats
+from .instrument import Instrumentation
+from .records import Reading
+
+# Register the decoders for the supported sensors.  Decoders for new sensor types can be
+# added by registering them in the same way.
+# If the Device ID contains "lht65" anywhere in it, use the LHT65 decoder.  Only messages on
+# Port 2 are sensor readings (although haven't yet seen any other types of messages from
+# this sensor).
+default_registry.register('lht65', decode_dragino.decode_lht65, contains=('lht65',), ports=(2,))
+# If the Device ID starts with "ers", "elsys" or "elt", or the Device EUI has the Elsys OUI,
+# use the Elsys decoder.  Only messages on Port 5 are sensor readings.  Some Elsys values are
+# lists of values (grideye pixels, multiple external temperature channels).
+default_registry.register('elsys', decode_elsys.decode, prefixes=('elsys', 'ers', 'elt'),
+                          ouis=('A81758',), ports=(5,),
+                          flat_func=partial(decode_elsys.decode, flatten_value_lists=True),
+                          projects=True)
+# Dragino LT-22222-L IO controllers, e.g. "boat-lt2-a8404137b182428e".  Readings are on Port 2.
+default_registry.register('lt22222', decode_dragino.decode_lt22222, prefixes=('boat-lt2',),
+                          contains=('lt22222',), ports=(2,))
 
 def decode(
         integration_payload: Dict[str, Any],
         flatten_value_lists=True,
         raw_payload_priority=True,
-    ) -> Dict[str, float]:
+        payload_cache: Optional[PayloadCache] = None,
+        signal_stats: Optional[SignalStats] = None,
+        instrument: Optional[Instrumentation] = None,
+        as_record: bool = False,
+        only_fields: Optional[Iterable[str]] = None,
+    ) -> Union[Dict[str, Any], Reading]:
     """ Returns a dictionary of information derived from the payload sent by 
     a Things Network HTTP Integration.  Some general data about the message is included
     (e.g. Unix timestamp) but a full list of the sensor values encoded in the payload are returned
@@ -23,6 +50,7 @@ def decode(
     decoded from the raw payload:
         All Elsys sensors
         Drgaino LHT65 sensors
+        Dragino LT-22222-L sensors
     
     Function Parameters are:
     'integration_payload': the data payload that is sent by a Things Network HTTP integration, 
@@ -33,21 +61,45 @@ def decode(
         the list index to the sensor name.
     'raw_payload_priority': If True (the default), an attempt will be made first to decode the raw payload; if that
         fails and there is a 'payload_fields' key in the integration post, those values will be used.
+    'payload_cache': an optional PayloadCache.  If given, the fields decoded from a raw payload are
+        cached, and a later message with the same decoder, port and raw payload gets a copy of the
+        cached fields instead of being decoded again.
+    'signal_stats': an optional SignalStats.  If given, the SNR and RSSI from every gateway that
+        received the message are added to its per device and gateway statistics.
+    'instrument': an optional Instrumentation.  If given, the time spent in each stage of decoding
+        is recorded in it.
+    'as_record': if True, a compact Reading object (see the 'records' module) is returned instead
+        of a dictionary.
+    'only_fields': if given, only these sensor fields are returned.  Decoders that support it,
+        like the Elsys decoder, skip the parts of the payload holding other fields.  For those
+        decoders, naming a value list field or one of its flattened elements gives all the
+        values of the list.
     """
+    if only_fields is not None and type(only_fields) is not frozenset:
+        only_fields = frozenset(only_fields)
+
+    # times the stages of decoding, if instrumentation is requested.
+    timing = instrument.begin() if instrument is not None else None
 
     # Go here to learn about the format of an HTTP Integration Uplink coming from the Things
     # network:  https://www.thethingsnetwork.org/docs/applications/http/
     device_id = integration_payload['dev_id']
     device_eui = integration_payload['hardware_serial']
-    payload = base64.b64decode(integration_payload['payload_raw'])  # is a list of bytes now
+    payload = binascii.a2b_base64(integration_payload['payload_raw'])  # is a list of bytes now
+    if timing:
+        timing.lap('base64')
 
     # Make UNIX timestamp for the record
-    ts = parse(integration_payload['metadata']['time']).timestamp()
+    ts = rfc3339_timestamp(integration_payload['metadata']['time'])
+    if timing:
+        timing.lap('timestamp')
 
     # Extract the strongest SNR across the gateways that received the transmission.  And record
     # the RSSI from that gateway.
     sigs = [(gtw['snr'], gtw['rssi']) for gtw in integration_payload['metadata']['gateways']]
     snr, rssi = max(sigs)
+    if signal_stats is not None:
+        signal_stats.add_uplink(integration_payload, ts)
 
     # the dictionary that will hold the decoded results.  the 'fields' key will be added later.
     results = {
@@ -61,49 +113,62 @@ def decode(
         'rssi': rssi,         # RSSI from the gateway with the best SNR
         'gateway_count': len(integration_payload['metadata']['gateways']),
     }
+    if timing:
+        timing.lap('metadata')
 
     fields = {}      # default to no field data
+    projected = False   # True if 'only_fields' were decoded from the raw payload
     if raw_payload_priority or ('payload_fields' not in integration_payload):
         try:
-            # dispatch to the right decoding function based on characters in the device_id.
-            # if device_id contains "lht65" anywhere in it, use the lht65 decoder
-            # if device_id starts with "ers" or "elsys" or "elt", use the elsys decoder
-            dev_id_lwr = device_id.lower()    # get variable for lower case device ID
-            if 'lht65' in dev_id_lwr:
-                # only messages on Port 2 are sensor readings (although haven't yet seen 
-                # any other types of messages from this sensor)
-                if integration_payload['port'] == 2:
-                    fields = decode_dragino.decode_lht65(payload)
-            elif dev_id_lwr.startswith('elsys') or (dev_id_lwr[:3] in ('ers', 'elt')):
-                # only messages on Port 5 are sensor readings
-                if integration_payload['port']  == 5:
-                    fields = decode_elsys.decode(payload)
-
-            # some decoders will give a list of values back for one field.  If requested, convert 
+            # the registry picks the decoding function based on the device, and
+            # returns None if this port does not carry sensor readings.  Some decoders give a
+            # list of values back for one field.  If requested, the decoder returned puts
             # these into multiple fields with an underscore index at end of field name.
-            if flatten_value_lists:
-                flat_fields ={}
-                fields_to_delete = []
-                for k, v in fields.items():
-                    if type(v) == list:
-                        fields_to_delete.append(k)
-                        for ix, val in enumerate(v):
-                            flat_fields[f'{k}_{ix}'] = val
-                for k in fields_to_delete:
-                    del fields[k]     # remove that item cuz will add individual elements
-                fields.update(flat_fields)
+            decode_func = default_registry.decoder_for(
+                device_id, device_eui, integration_payload['port'], flatten_value_lists)
+            if timing:
+                timing.lap('dispatch')
+            cache_key = cached = None
+            if decode_func and payload_cache is not None:
+                cache_key = (decode_func, integration_payload['port'], payload, only_fields)
+                cached = payload_cache.get(cache_key)
+            if cached is not None:
+                fields = cached
+            elif decode_func and only_fields is None:
+                fields = decode_func(payload)
+            elif decode_func and default_registry.projects(decode_func):
+                fields = decode_func(payload, fields=only_fields)
+            elif decode_func:
+                fields = {k: v for k, v in decode_func(payload).items() if k in only_fields}
+            # none of the requested fields being in the payload is not a decoding failure.
+            projected = decode_func is not None and only_fields is not None
+            if timing:
+                timing.lap('decode')
+
+            if cache_key is not None and cached is None:
+                payload_cache.put(cache_key, fields)
         except:
             # Failed at decoding raw payload.  Go on to see if there might be values in 
             # the payload_fields element.
-            pass
+            if timing:
+                timing.error = True
             
 
-    if len(fields) == 0 and ('payload_fields' in integration_payload):
+    if len(fields) == 0 and not projected and ('payload_fields' in integration_payload):
         # get sensor data from already-decoded payload_fields
         EXCLUDE_THINGS_FIELDS = ('event', )    # fields not to include
         fields = integration_payload['payload_fields'].copy()
         for ky in EXCLUDE_THINGS_FIELDS:
             fields.pop(ky, None)      # deletes element without an error if not there
+        if only_fields is not None:
+            fields = {k: v for k, v in fields.items() if k in only_fields}
+        if timing:
+            timing.lap('payload_fields')
+
+    if timing:
+        instrument.finish(timing, device_id, device_eui)
+    if as_record:
+        return Reading(results, fields)
 
     # Add these fields to the results dictionary
     results['fields'] = fields
@@ -122,6 +187,23 @@ def test():
 
     pprint(decode(recs[-1], flatten_value_lists=False))
 
+    # decoding with a cache gives the same results, and cached fields are copies.
+    cache = PayloadCache()
+    for rec in recs + recs:
+        assert decode(rec, payload_cache=cache) == decode(rec)
+    decode(recs[-1], payload_cache=cache)['fields'].clear()
+    assert decode(recs[-1], payload_cache=cache) == decode(recs[-1])
+    assert cache.cache_info().hits == 5 and cache.cache_info().misses == 3
+
+    # decoding only some fields
+    for rec in recs:
+        full = decode(rec)['fields']
+        for names in (['vdd'], ['temperature', 'humidity', 'extTemperature2_0'], ['bat_v', 'nothing']):
+            res = decode(rec, only_fields=names, payload_cache=cache)
+            expected = {k: v for k, v in full.items()
+                        if k in names or ('extTemperature2_0' in names and k.startswith('extTemperature2_'))}
+            assert res['fields'] == expected
+
 if __name__ == '__main__':
     # To run this without import error, need to run "python -m decoder.decoder" from the top level directory.
     test()
@@ -0,0 +1,163 @@
+"""Module for removing duplicate uplinks from a stream of Things Network HTTP Integration
+payloads before they are decoded.  The same uplink can arrive more than once, posted once per
+gateway that received it or redelivered after a retry.  Duplicates are recognized by their
+device, frame counter and raw payload, within a time window.
+
+Because the frame counter is only compared within the time window, rollover of the counter
+and devices that reset their counter to 0 (e.g. after a battery change) don't cause new
+uplinks to be mistaken for duplicates.  Duplicates can be held back for a short time so that
+the gateways from later duplicates are merged into the gateway list of the uplink that is
+passed on, which then gives the best SNR and the true gateway count when decoded.
+
+Typical use:
+
+    for rec in (decode(p) for p in dedupe(iter_payloads('lora.json'))):
+        ...
+"""
+from typing import Dict, Any, Iterable, Iterator, List, Tuple
+from collections import deque
+
+from .decode_utils import rfc3339_timestamp
+
+class _DeviceWindow:
+    """The uplinks seen from one device within the duplicate window.
+    """
+    __slots__ = ('seen', 'order')
+
+    def __init__(self):
+        self.seen: Dict[int, Tuple[float, str, Dict[str, Any]]] = {}   # counter -> (ts, payload_raw, uplink)
+        self.order = deque()        # (ts, counter) in order received, for expiring entries
+
+    def expire(self, before: float):
+        """Removes the uplinks received before time 'before'.
+        """
+        order, seen = self.order, self.seen
+        while order and order[0][0] < before:
+            ts, counter = order.popleft()
+            if counter in seen and seen[counter][0] == ts:
+                del seen[counter]
+
+class Deduplicator:
+    """Removes duplicate uplinks from a stream of integration payloads, which must be in about
+    time order.
+    """
+
+    def __init__(self, window: float = 300.0, hold: float = 0.0):
+        """An uplink is a duplicate if an uplink from the same device, with the same frame
+        counter and raw payload, was received less than 'window' seconds earlier.  Uplinks
+        are held for 'hold' seconds (of uplink time) before they are passed on, and the
+        gateways of duplicates received in that time are merged into the held uplink.
+        """
+        self.window = window
+        self.hold = hold
+        self.counts = dict.fromkeys(('received', 'duplicates', 'merged', 'emitted'), 0)
+        self._devices: Dict[str, _DeviceWindow] = {}
+        self._held = deque()        # (release time, uplink) in order received
+        self._latest = float('-inf')              # latest uplink time seen
+        self._released_until = float('-inf')      # uplinks held until this time are released
+
+    def push(self, uplink: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Adds an integration payload to the stream and returns the list of uplinks that are
+        ready to be passed on, which may be empty.  When gateways are merged, the uplink
+        passed on is a copy; the payloads pushed are not modified.
+        """
+        self.counts['received'] += 1
+        ts = rfc3339_timestamp(uplink['metadata']['time'])
+        self._latest = max(self._latest, ts)
+        dev = self._devices.get(uplink['dev_id'])
+        if dev is None:
+            dev = self._devices[uplink['dev_id']] = _DeviceWindow()
+        dev.expire(ts - self.window)
+
+        counter = uplink['counter']
+        prior = dev.seen.get(counter)
+        if prior is not None and prior[1] == uplink['payload_raw']:
+            self.counts['duplicates'] += 1
+            if prior[0] + self.hold > self._released_until:
+                # the first uplink is still held
+                self._merge_gateways(prior[2], uplink)
+        else:
+            if self.hold > 0:
+                # copy the parts that are changed when gateways are merged
+                uplink = dict(uplink)
+                uplink['metadata'] = dict(uplink['metadata'])
+                uplink['metadata']['gateways'] = list(uplink['metadata'].get('gateways', []))
+                self._held.append((ts + self.hold, uplink))
+            else:
+                self._held.append((ts, uplink))
+            dev.seen[counter] = (ts, uplink['payload_raw'], uplink)
+            dev.order.append((ts, counter))
+
+        return self._release(self._latest)
+
+    def _merge_gateways(self, held: Dict[str, Any], duplicate: Dict[str, Any]):
+        """Adds the gateways of 'duplicate' that are not already in the gateway list of the
+        'held' uplink.
+        """
+        gateways = held['metadata']['gateways']
+        have = {gtw.get('gtw_id') for gtw in gateways}
+        for gtw in duplicate['metadata'].get('gateways', []):
+            if gtw.get('gtw_id') not in have:
+                gateways.append(gtw)
+                have.add(gtw.get('gtw_id'))
+                self.counts['merged'] += 1
+
+    def _release(self, now: float) -> List[Dict[str, Any]]:
+        """Returns the held uplinks whose release time is at or before 'now'.
+        """
+        self._released_until = now
+        ready = []
+        held = self._held
+        while held and held[0][0] <= now:
+            ready.append(held.popleft()[1])
+        self.counts['emitted'] += len(ready)
+        return ready
+
+    def flush(self) -> List[Dict[str, Any]]:
+        """Returns all the held uplinks, e.g. at the end of the stream.
+        """
+        return self._release(float('inf'))
+
+def dedupe(uplinks: Iterable[Dict[str, Any]], window: float = 300.0, hold: float = 0.0) -> Iterator[Dict[str, Any]]:
+    """Yields the integration payloads from 'uplinks' with duplicates removed.  See
+    'Deduplicator' for the meaning of 'window' and 'hold'.
+    """
+    dedup = Deduplicator(window, hold)
+    for uplink in uplinks:
+        yield from dedup.push(uplink)
+    yield from dedup.flush()
+
+def test():
+    from pathlib import Path
+    import copy
+    from .stream import iter_payloads
+    from .decoder import decode
+
+    debug_file = Path(__file__).parent.parent / 'lora-debug.txt'
+    uplinks = list(iter_payloads(debug_file))
+
+    # duplicates from a second gateway, and a redelivery; none of the originals are dropped,
+    # including the LHT65 counter reset from 256 to 0.
+    dup = copy.deepcopy(uplinks[2])
+    dup['metadata']['gateways'][0]['gtw_id'] = 'eui-other'
+    dup['metadata']['gateways'][0]['snr'] = 20.0
+    stream = uplinks[:3] + [dup, uplinks[1]] + uplinks[3:]
+    assert [u['counter'] for u in dedupe(stream)] == [0, 254, 255, 256, 0, 1]
+
+    # with a hold, the second gateway is merged into the uplink.
+    dedup = Deduplicator(hold=5.0)
+    out = [u for uplink in stream for u in dedup.push(uplink)] + dedup.flush()
+    assert [u['counter'] for u in out] == [0, 254, 255, 256, 0, 1]
+    rec = decode(out[2])
+    assert rec['gateway_count'] == 2 and rec['snr'] == 20.0
+    assert len(uplinks[2]['metadata']['gateways']) == 1       # input not modified
+    assert dedup.counts == dict(received=8, duplicates=2, merged=1, emitted=6)
+
+    # the same counter and payload after the window is a new uplink
+    later = copy.deepcopy(uplinks[1])
+    later['metadata']['time'] = '2020-11-12T18:39:24Z'
+    assert len(list(dedupe([uplinks[1], later]))) == 2
+
+if __name__ == '__main__':
+    # To run this without import error, need to run "python -m decoder.dedup" from the top level directory.
+    test()
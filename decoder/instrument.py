@@ -0,0 +1,192 @@
+"""Module for instrumenting 'decoder.decode()' to find where decoding time goes.  When an
+Instrumentation object is passed to 'decode()', the time spent in each stage of decoding
+(base64 decoding, timestamp parsing, metadata extraction, choosing the decoder, decoding the
+payload and using 'payload_fields') is added up per decoder, and messages are counted per
+decoder and device type.  When no Instrumentation is passed, the only cost is a check for None
+at each stage.
+
+The counters can be exported in the Prometheus text format, and a fraction of the messages
+can be run under cProfile to see what the decoders spend their time on.
+"""
+from typing import Dict, Any, List, Optional, Tuple
+from contextlib import contextmanager
+from functools import lru_cache
+import cProfile
+import random
+import re
+import threading
+import time
+
+from .registry import default_registry
+
+# The stages of 'decoder.decode()', in order
+STAGES = ('base64', 'timestamp', 'metadata', 'dispatch', 'decode', 'payload_fields')
+
+@lru_cache(maxsize=4096)
+def device_type(device_id: str) -> str:
+    """Returns the device type part of a Device ID, the text before the first '-' or '_',
+    e.g. 'lht65' for 'lht65-a8404173e1822ca4'.
+    """
+    return re.split('[-_]', device_id, maxsplit=1)[0].lower()
+
+class Timing:
+    """The stage times of one message being decoded.
+    """
+    __slots__ = ('laps', 'last', 'error', 'profiled')
+
+    def __init__(self):
+        self.laps: List[Tuple[str, float]] = []
+        self.error = False          # True if decoding the raw payload failed
+        self.profiled = False       # True if the message is being profiled
+        self.last = time.perf_counter()
+
+    def lap(self, stage: str):
+        """Records the time since the previous lap as the time of 'stage'.
+        """
+        now = time.perf_counter()
+        self.laps.append((stage, now - self.last))
+        self.last = now
+
+class Instrumentation:
+    """Collects decoding statistics.
+    """
+
+    def __init__(self):
+        self.stage_calls: Dict[Tuple[str, str], int] = {}       # (stage, decoder) -> count
+        self.stage_seconds: Dict[Tuple[str, str], float] = {}   # (stage, decoder) -> total seconds
+        self.messages: Dict[Tuple[str, str], int] = {}          # (decoder, device type) -> count
+        self.errors: Dict[str, int] = {}                        # decoder -> count
+        self.profiler: Optional[cProfile.Profile] = None
+        self.sample_fraction = 0.0
+        self._rng = random.Random()
+        self._lock = threading.Lock()
+
+    def begin(self) -> Timing:
+        """Starts timing a message.  If profiling is on, the message may be chosen to be
+        profiled.
+        """
+        timing = Timing()
+        if self.profiler is not None:
+            # a profiled message that failed before 'finish()' left the profiler running.
+            self.profiler.disable()
+            if self._rng.random() < self.sample_fraction:
+                timing.profiled = True
+                self.profiler.enable()
+                timing.last = time.perf_counter()
+        return timing
+
+    def finish(self, timing: Timing, device_id: str, device_eui: str):
+        """Adds the stage times of a decoded message to the statistics.
+        """
+        if timing.profiled:
+            self.profiler.disable()
+        entry = default_registry.lookup(device_id, device_eui)
+        decoder = entry.name if entry else 'none'
+        with self._lock:
+            for stage, secs in timing.laps:
+                key = (stage, decoder)
+                self.stage_calls[key] = self.stage_calls.get(key, 0) + 1
+                self.stage_seconds[key] = self.stage_seconds.get(key, 0.0) + secs
+            key = (decoder, device_type(device_id))
+            self.messages[key] = self.messages.get(key, 0) + 1
+            if timing.error:
+                self.errors[decoder] = self.errors.get(decoder, 0) + 1
+
+    @contextmanager
+    def profile(self, fraction: float = 0.01, seed: Optional[int] = None):
+        """Context manager that runs the fraction 'fraction' of the messages decoded in its
+        block under cProfile.  Yields the cProfile.Profile, which can be passed to 'pstats'
+        after the block.  Only use in a single thread, as cProfile profiles one thread at a
+        time.
+        """
+        profiler = cProfile.Profile()
+        self.profiler, self.sample_fraction = profiler, fraction
+        if seed is not None:
+            self._rng.seed(seed)
+        try:
+            yield profiler
+        finally:
+            profiler.disable()
+            self.profiler, self.sample_fraction = None, 0.0
+
+    def summary(self) -> List[Dict[str, Any]]:
+        """Returns a list with a dictionary for each (stage, decoder) giving the number of
+        calls, the total seconds and the average microseconds per call.
+        """
+        rows = []
+        for (stage, decoder), calls in self.stage_calls.items():
+            secs = self.stage_seconds[(stage, decoder)]
+            rows.append(dict(stage=stage, decoder=decoder, calls=calls, seconds=secs,
+                             usec_per_call=secs / calls * 1e6))
+        rows.sort(key=lambda r: (r['decoder'], STAGES.index(r['stage'])))
+        return rows
+
+    def metrics_text(self) -> str:
+        """Returns the counters in the Prometheus text exposition format.
+        """
+        lines = ['# TYPE decode_stage_seconds_total counter']
+        with self._lock:
+            for (stage, decoder), secs in self.stage_seconds.items():
+                lines.append(f'decode_stage_seconds_total{{stage="{stage}",decoder="{decoder}"}} {secs}')
+            lines.append('# TYPE decode_stage_calls_total counter')
+            for (stage, decoder), calls in self.stage_calls.items():
+                lines.append(f'decode_stage_calls_total{{stage="{stage}",decoder="{decoder}"}} {calls}')
+            lines.append('# TYPE decode_messages_total counter')
+            for (decoder, dev_type), count in self.messages.items():
+                lines.append(f'decode_messages_total{{decoder="{decoder}",device_type="{dev_type}"}} {count}')
+            lines.append('# TYPE decode_errors_total counter')
+            for decoder, count in self.errors.items():
+                lines.append(f'decode_errors_total{{decoder="{decoder}"}} {count}')
+        return '\n'.join(lines) + '\n'
+
+def test():
+    import pstats
+    from pathlib import Path
+    from .stream import iter_payloads
+    from .decoder import decode
+
+    debug_file = Path(__file__).parent.parent / 'lora-debug.txt'
+    uplinks = list(iter_payloads(debug_file))
+    inst = Instrumentation()
+    for uplink in uplinks:
+        assert decode(uplink, instrument=inst) == decode(uplink)
+    assert inst.messages == {('elsys', 'ersco2'): 2, ('lht65', 'lht65'): 4}
+    assert inst.stage_calls[('decode', 'lht65')] == 4
+    assert {r['stage'] for r in inst.summary()} <= set(STAGES)
+    text = inst.metrics_text()
+    assert 'decode_messages_total{decoder="lht65",device_type="lht65"} 4\n' in text
+
+    # a bad payload is counted as an error
+    bad = dict(uplinks[1], payload_raw='AAE=')
+    decode(bad, instrument=inst)
+    assert inst.errors == {'lht65': 1}
+
+    # profile every message
+    with inst.profile(fraction=1.0) as prof:
+        for uplink in uplinks:
+            decode(uplink, instrument=inst)
+    # the generated LHT65 decoding function ran inside the profiler
+    profiled = pstats.Stats(prof).stats
+    assert any(func == 'decode_lht65' and calls[1] == 4 for (_, _, func), calls in profiled.items())
+    assert inst.profiler is None
+
+    # a message that fails to decode doesn't leave the profiler running
+    import sys
+    with inst.profile(fraction=1.0):
+        try:
+            decode(dict(uplinks[1], metadata={}), instrument=inst)
+            assert False
+        except KeyError:
+            pass
+        # the next message stops the profiler left running by the failed one
+        decode(uplinks[1], instrument=inst)
+        assert sys.getprofile() is None
+        try:
+            decode(dict(uplinks[1], metadata={}), instrument=inst)
+        except KeyError:
+            pass
+    assert sys.getprofile() is None
+
+if __name__ == '__main__':
+    # To run this without import error, need to run "python -m decoder.instrument" from the top level directory.
+    test()
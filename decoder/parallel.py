@@ -0,0 +1,159 @@
+"""Module for decoding large numbers of integration payloads using multiple CPU cores, e.g. to
+re-decode an archive after a decoder fix.  The payloads are split into chunks, and each chunk
+is decoded by a worker in a process pool (or thread pool, or serially).  Chunks amortize the
+cost of sending work to the processes; payloads are sent as the raw JSON lines when reading
+from a file, which are much cheaper to transfer than dictionaries.
+
+A SignalStats passed to 'decoder.decode()' is not shared by the workers, threads or processes:
+each chunk is decoded with its own empty SignalStats, which is merged into the caller's as
+the chunk's records are yielded.  An Instrumentation or PayloadCache can't be used with
+worker processes; both are thread-safe, so they can be used in the other modes.
+"""
+from typing import Dict, Any, Iterable, Iterator, List, Union, Optional, Tuple
+from pathlib import Path
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from itertools import islice
+import os
+
+from .stream import iter_records
+from .signal_stats import SignalStats
+
+MODES = ('serial', 'thread', 'process')
+
+# 'decoder.decode()' arguments that accumulate state and can't be merged from worker processes.
+_PROCESS_UNSUPPORTED = ('instrument', 'payload_cache')
+
+def _decode_chunk(
+        items: List[Any],
+        skip_errors: bool,
+        decode_kwargs: Dict[str, Any],
+    ) -> Tuple[List[Dict[str, Any]], Optional[SignalStats]]:
+    """Decodes a chunk of payloads in a worker.  Returns the records and the SignalStats
+    passed in 'decode_kwargs', if any.
+    """
+    return list(iter_records(items, skip_errors, **decode_kwargs)), decode_kwargs.get('signal_stats')
+
+def decode_many(
+        payloads: Iterable[Union[Dict[str, Any], str, bytes]],
+        mode: str = 'process',
+        workers: Optional[int] = None,
+        chunk_size: int = 1000,
+        ordered: bool = True,
+        skip_errors: bool = False,
+        **decode_kwargs,
+    ) -> Iterator[Dict[str, Any]]:
+    """Yields the decoded records from 'decoder.decode()' for each item in 'payloads'.  An item
+    is an integration payload dictionary or a JSON string/bytes line holding one.
+    'mode' is 'serial', 'thread' or 'process' and determines how the work is spread.
+    'workers' is the number of threads or processes, defaulting to the number of CPUs.
+    'chunk_size' is the number of payloads in each unit of work sent to a worker.
+    If 'ordered' is True, records are yielded in the same order as 'payloads'; otherwise
+    they are yielded as soon as their chunk is done.
+    'skip_errors' and other keyword arguments are as described in 'stream.iter_records()'.
+    A 'signal_stats' argument is updated with the statistics gathered by the workers as their
+    records are yielded.  In 'process' mode, 'instrument' and 'payload_cache' arguments raise
+    a ValueError.
+    Only a limited number of chunks are in progress at once, so memory use is bounded.
+    """
+    if mode not in MODES:
+        raise ValueError(f'mode must be one of {MODES}.')
+    if mode == 'process':
+        unsupported = [name for name in _PROCESS_UNSUPPORTED if decode_kwargs.get(name) is not None]
+        if unsupported:
+            raise ValueError(f'{", ".join(unsupported)} can not be used in process mode.')
+    if mode == 'serial':
+        yield from iter_records(payloads, skip_errors, **decode_kwargs)
+        return
+    signal_stats = decode_kwargs.get('signal_stats')
+
+    workers = workers or os.cpu_count() or 1
+    executor_class = ProcessPoolExecutor if mode == 'process' else ThreadPoolExecutor
+    items = iter(payloads)
+    with executor_class(max_workers=workers) as executor:
+        pending = deque()
+        max_pending = workers * 2      # keeps the workers busy without reading ahead too far
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < max_pending:
+                chunk = list(islice(items, chunk_size))
+                if chunk:
+                    chunk_kwargs = decode_kwargs
+                    if signal_stats is not None:
+                        # the chunk fills a new SignalStats, which is merged into the caller's.
+                        chunk_kwargs = dict(decode_kwargs, signal_stats=signal_stats.empty_copy())
+                    pending.append(executor.submit(_decode_chunk, chunk, skip_errors, chunk_kwargs))
+                else:
+                    exhausted = True
+            if not pending:
+                return
+
+            if ordered:
+                done = [pending.popleft()]
+            else:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    pending.remove(fut)
+            for fut in done:
+                records, chunk_stats = fut.result()
+                if signal_stats is not None:
+                    signal_stats.merge(chunk_stats)
+                yield from records
+
+def decode_file(
+        path: Union[str, Path],
+        mode: str = 'process',
+        workers: Optional[int] = None,
+        chunk_size: int = 1000,
+        ordered: bool = True,
+        skip_errors: bool = False,
+        **decode_kwargs,
+    ) -> Iterator[Dict[str, Any]]:
+    """Yields the decoded records for each payload in the JSON-lines file at 'path'.  See
+    'decode_many()' for a description of the other parameters.
+    """
+    with open(path, 'rb') as f:
+        yield from decode_many(f, mode, workers, chunk_size, ordered, skip_errors, **decode_kwargs)
+
+def test():
+    import json
+    import tempfile
+    debug_file = Path(__file__).parent.parent / 'lora-debug.txt'
+    lines = open(debug_file, 'rb').readlines() * 50
+    expected = [rec for rec in iter_records(lines)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / 'lora.json'
+        path.write_bytes(b''.join(lines))
+        for mode in MODES:
+            assert list(decode_file(path, mode, workers=2, chunk_size=7)) == expected
+        recs = list(decode_file(path, 'process', workers=2, chunk_size=7, ordered=False))
+        key = lambda r: json.dumps(r, sort_keys=True)
+        assert sorted(recs, key=key) == sorted(expected, key=key)
+
+    payloads = [json.loads(lin) for lin in lines]
+    assert list(decode_many(payloads, 'thread', chunk_size=10)) == expected
+
+    # signal statistics gathered in worker threads and processes are merged into the caller's
+    expected_stats = SignalStats()
+    list(decode_many(payloads, 'serial', signal_stats=expected_stats))
+    for mode in ('thread', 'process'):
+        stats = SignalStats()
+        list(decode_many(payloads, mode, workers=2, chunk_size=7, ordered=False, signal_stats=stats))
+        # chunks finish in any order, so links can be added in a different order
+        assert sorted(stats.links()) == sorted(expected_stats.links())
+        assert stats.histogram() == expected_stats.histogram()
+        for dev_id, gtw_id in expected_stats.links():
+            link, expected_link = stats.link(dev_id, gtw_id), expected_stats.link(dev_id, gtw_id)
+            assert link.snr_hist == expected_link.snr_hist and link.rssi.count == expected_link.rssi.count
+            assert abs(link.rssi.mean - expected_link.rssi.mean) < 1e-9
+    try:
+        list(decode_many(payloads, 'process', instrument=object()))
+        assert False
+    except ValueError:
+        pass
+    print('parallel tests passed')
+
+if __name__ == '__main__':
+    # To run this without import error, need to run "python -m decoder.parallel" from the top level directory.
+    test()
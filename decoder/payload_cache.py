@@ -0,0 +1,102 @@
+"""Module providing a cache of decoded payloads for 'decoder.decode()'.  Many sensors send the
+same payload over and over (steady readings, configuration frames, and the same uplink
+delivered more than once), so the field dictionary decoded from a raw payload is kept and
+reused.  Entries are keyed by the decoding function, the port and the raw payload bytes, and
+the least recently used entries are dropped when the cache is full.
+"""
+from typing import Dict, Any, Hashable, NamedTuple, Optional
+from collections import OrderedDict
+import threading
+
+class CacheInfo(NamedTuple):
+    """Cache statistics, in the same form as 'functools.lru_cache'.
+    """
+    hits: int
+    misses: int
+    maxsize: int
+    currsize: int
+
+def _copy_fields(fields: Dict[str, Any]) -> Dict[str, Any]:
+    """Returns a copy of a field dictionary that the caller can modify without changing the
+    cached dictionary.  Lists of values are copied as well.
+    """
+    return {k: v.copy() if type(v) == list else v for k, v in fields.items()}
+
+class PayloadCache:
+    """A bounded, least-recently-used cache of decoded field dictionaries.  It can be shared
+    by several threads.
+    """
+
+    def __init__(self, maxsize: int = 10000):
+        """'maxsize' is the maximum number of decoded payloads kept.
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # the lock can't be pickled, e.g. when the cache is sent to a worker process.
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Dict[str, Any]]:
+        """Returns a copy of the field dictionary cached for 'key', or None if there is none.
+        """
+        with self._lock:
+            fields = self._entries.get(key)
+            if fields is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return _copy_fields(fields)
+
+    def put(self, key: Hashable, fields: Dict[str, Any]):
+        """Caches a copy of the field dictionary 'fields' for 'key'.
+        """
+        fields = _copy_fields(fields)
+        with self._lock:
+            self._entries[key] = fields
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Removes all entries and resets the statistics.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+    def cache_info(self) -> CacheInfo:
+        """Returns the hit and miss statistics and the size of the cache.
+        """
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self._entries))
+
+def test():
+    cache = PayloadCache(maxsize=2)
+    assert cache.get('a') is None
+    cache.put('a', {'x': 1, 'y': [1, 2]})
+    fields = cache.get('a')
+    fields['y'].append(3)
+    fields['z'] = 0
+    assert cache.get('a') == {'x': 1, 'y': [1, 2]}     # the cached entry is unchanged
+    cache.put('b', {})
+    cache.get('a')
+    cache.put('c', {})                                  # drops 'b', the least recently used
+    assert cache.get('b') is None and cache.get('a') is not None
+    assert cache.cache_info() == CacheInfo(hits=4, misses=2, maxsize=2, currsize=2)
+
+    import pickle
+    assert pickle.loads(pickle.dumps(cache)).get('c') == {}
+
+if __name__ == '__main__':
+    # To run this without import error, need to run "python -m decoder.payload_cache" from the top level directory.
+    test()
@@ -0,0 +1,322 @@
+"""Module providing an HTTP server that receives the uplink payloads POSTed by a Things Network
+HTTP Integration and decodes them with 'decoder.decode()'.  Only the Python standard library
+is used.
+
+Each POST is acknowledged (202 Accepted) as soon as its body is read, and the body is put on a
+queue.  A background task takes payloads off the queue in micro-batches and decodes each batch
+in a worker thread, so decoding never blocks the event loop that is accepting uplinks.  If the
+queue is full, the POST is answered with 503 so that the sender retries later.  A GET of
+'/metrics' returns counters, the queue depth and latency statistics in a plain text format.
+If decoding a batch fails as a whole, e.g. because 'on_records' raises, the error is logged and
+counted, and the following batches are still decoded.
+"""
+from typing import Dict, Any, List, Callable, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import json
+import logging
+import time
+
+from .decoder import decode
+
+logger = logging.getLogger(__name__)
+
+# Largest request body accepted, in bytes
+MAX_BODY_SIZE = 1_000_000
+
+_STATUS_TEXT = {
+    200: 'OK', 202: 'Accepted', 400: 'Bad Request', 404: 'Not Found',
+    405: 'Method Not Allowed', 411: 'Length Required', 413: 'Payload Too Large',
+    503: 'Service Unavailable',
+}
+
+def _decode_bodies(
+        bodies: List[bytes],
+        on_records: Optional[Callable[[List[Dict[str, Any]]], None]],
+        decode_kwargs: Dict[str, Any],
+    ) -> Tuple[int, int]:
+    """Decodes a batch of POST bodies and passes the decoded records to 'on_records'.
+    Returns the number of records decoded and the number of bodies that failed to decode.
+    Runs in a worker thread.
+    """
+    records = []
+    errors = 0
+    for body in bodies:
+        try:
+            records.append(decode(json.loads(body), **decode_kwargs))
+        except Exception:
+            errors += 1
+    if on_records and records:
+        on_records(records)
+    return len(records), errors
+
+class UplinkReceiver:
+    """Receives, queues and decodes uplinks posted by a Things Network HTTP Integration.
+    """
+
+    def __init__(
+            self,
+            on_records: Optional[Callable[[List[Dict[str, Any]]], None]] = None,
+            batch_size: int = 200,
+            max_delay: float = 0.2,
+            max_queue: int = 10000,
+            **decode_kwargs,
+        ):
+        """'on_records' is called with each list of decoded records; it is called from a worker
+        thread.  A batch is decoded when 'batch_size' uplinks are waiting or 'max_delay' seconds
+        after its first uplink arrived, whichever comes first.  'max_queue' is the number of
+        uplinks that can wait to be decoded before new ones are refused.  Other keyword arguments
+        are passed to 'decoder.decode()'.
+        """
+        self.on_records = on_records
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.max_queue = max_queue
+        self.decode_kwargs = decode_kwargs
+        self.counters = dict.fromkeys(
+            ('received', 'rejected', 'decoded', 'decode_errors', 'batches', 'batch_errors'), 0)
+        self.latency_total = 0.0    # total seconds from receipt to decoding, for all uplinks
+        self.latency_max = 0.0
+        self._queue: Optional[asyncio.Queue] = None
+        self._server = None
+        self._batcher = None
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue else 0
+
+    def metrics(self) -> Dict[str, float]:
+        """Returns a dictionary of the current metrics.
+        """
+        res = dict(self.counters)
+        res['queue_depth'] = self.queue_depth
+        handled = self.counters['decoded'] + self.counters['decode_errors']
+        res['latency_avg_seconds'] = self.latency_total / handled if handled else 0.0
+        res['latency_max_seconds'] = self.latency_max
+        return res
+
+    def metrics_text(self) -> str:
+        """Returns the metrics in the Prometheus text exposition format.
+        """
+        return ''.join(f'uplink_{name} {val}\n' for name, val in self.metrics().items())
+
+    async def start(self, host: str = '0.0.0.0', port: int = 8080) -> int:
+        """Starts the server and the decoding task.  Returns the port being listened on,
+        useful if 'port' is 0.
+        """
+        self._queue = asyncio.Queue(self.max_queue)
+        self._batcher = asyncio.create_task(self._run_batches())
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        """Stops accepting uplinks, decodes the ones that are queued, then stops.
+        """
+        self._server.close()
+        await self._server.wait_closed()
+        await self._queue.join()
+        self._batcher.cancel()
+        self._executor.shutdown()
+
+    async def _run_batches(self):
+        """Takes uplinks off the queue in batches and decodes them in the worker thread.
+        """
+        loop = asyncio.get_running_loop()
+        queue = self._queue
+        while True:
+            batch = [await queue.get()]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(queue.get_nowait())
+                    continue
+                except asyncio.QueueEmpty:
+                    pass
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                decoded, errors = await loop.run_in_executor(
+                    self._executor, _decode_bodies, [body for body, _ in batch],
+                    self.on_records, self.decode_kwargs)
+                self.counters['decoded'] += decoded
+                self.counters['decode_errors'] += errors
+            except Exception:
+                # the records of the batch are lost, but keep decoding later batches.
+                logger.exception('Failed to decode a batch of %d uplinks', len(batch))
+                self.counters['batch_errors'] += 1
+                self.counters['decode_errors'] += len(batch)
+            finally:
+                now = time.monotonic()
+                for _, received in batch:
+                    latency = now - received
+                    self.latency_total += latency
+                    self.latency_max = max(self.latency_max, latency)
+                self.counters['batches'] += 1
+                for _ in batch:
+                    queue.task_done()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Handles the HTTP requests on one connection.
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, path, _ = request_line.decode('latin-1').split()
+                except ValueError:
+                    await self._respond(writer, 400, close=True)
+                    break
+
+                headers = {}
+                while True:
+                    lin = await reader.readline()
+                    if lin in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = lin.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                close = headers.get('connection', '').lower() == 'close'
+
+                length = headers.get('content-length')
+                if length is None:
+                    if method == 'POST':
+                        await self._respond(writer, 411, close=True)
+                        break
+                    length = '0'
+                if not length.isdigit():
+                    await self._respond(writer, 400, close=True)
+                    break
+                length = int(length)
+                if length > MAX_BODY_SIZE:
+                    await self._respond(writer, 413, close=True)
+                    break
+                body = await reader.readexactly(length) if length else b''
+
+                if method == 'POST':
+                    try:
+                        self._queue.put_nowait((body, time.monotonic()))
+                        self.counters['received'] += 1
+                        await self._respond(writer, 202, close=close)
+                    except asyncio.QueueFull:
+                        self.counters['rejected'] += 1
+                        await self._respond(writer, 503, close=close, headers={'Retry-After': '5'})
+                elif method == 'GET' and path == '/metrics':
+                    await self._respond(writer, 200, self.metrics_text().encode(), close=close)
+                elif method == 'GET':
+                    await self._respond(writer, 404, close=close)
+                else:
+                    await self._respond(writer, 405, close=close)
+                if close:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _respond(writer: asyncio.StreamWriter, status: int, body: bytes = b'', close: bool = False, headers=None):
+        head = [f'HTTP/1.1 {status} {_STATUS_TEXT[status]}', f'Content-Length: {len(body)}']
+        if body:
+            head.append('Content-Type: text/plain; charset=utf-8')
+        if close:
+            head.append('Connection: close')
+        head += [f'{name}: {val}' for name, val in (headers or {}).items()]
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + body)
+        await writer.drain()
+
+def run(host: str = '0.0.0.0', port: int = 8080, **kwargs):
+    """Runs an UplinkReceiver until interrupted.  Keyword arguments are passed to
+    UplinkReceiver.
+    """
+    async def main():
+        receiver = UplinkReceiver(**kwargs)
+        await receiver.start(host, port)
+        await asyncio.Event().wait()
+    asyncio.run(main())
+
+def test():
+    from pathlib import Path
+    debug_file = Path(__file__).parent.parent / 'lora-debug.txt'
+    bodies = [lin.strip() for lin in open(debug_file, 'rb')] + [b'not json']
+
+    async def post(host, port, body):
+        reader, writer = await asyncio.open_connection(host, port)
+        writer.write(b'POST / HTTP/1.1\r\nHost: test\r\nConnection: close\r\n'
+                     + f'Content-Length: {len(body)}\r\n\r\n'.encode() + body)
+        await writer.drain()
+        resp = await reader.read()
+        writer.close()
+        return resp
+
+    async def main():
+        results = []
+        receiver = UplinkReceiver(on_records=results.extend, batch_size=4, max_delay=0.05)
+        port = await receiver.start('127.0.0.1', 0)
+        responses = await asyncio.gather(*(post('127.0.0.1', port, body) for body in bodies))
+        assert all(resp.startswith(b'HTTP/1.1 202') for resp in responses)
+
+        # metrics request on a keep-alive connection
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        await receiver._queue.join()
+        writer.write(b'GET /metrics HTTP/1.1\r\n\r\n')
+        await writer.drain()
+        head = await reader.readuntil(b'\r\n\r\n')
+        length = int(head.split(b'Content-Length: ')[1].split(b'\r\n')[0])
+        metrics = (await reader.readexactly(length)).decode()
+        writer.close()
+        assert 'uplink_decoded 6\n' in metrics and 'uplink_decode_errors 1\n' in metrics
+        assert 'uplink_queue_depth 0\n' in metrics
+
+        await receiver.stop()
+        assert sorted(r['counter'] for r in results) == [0, 0, 1, 254, 255, 256]
+
+        # a full queue refuses uplinks; make decoding slow so the queue fills up.
+        receiver = UplinkReceiver(on_records=lambda recs: time.sleep(0.2), batch_size=1, max_queue=1)
+        port = await receiver.start('127.0.0.1', 0)
+        responses = [await post('127.0.0.1', port, body) for body in bodies[:3]]
+        assert responses[-1].startswith(b'HTTP/1.1 503')
+        assert receiver.metrics()['rejected'] >= 1
+        await receiver.stop()
+
+        # a failing 'on_records' doesn't stop later batches from being decoded
+        def fail_first(recs):
+            if not results:
+                results.append(None)
+                raise RuntimeError('storage is down')
+            results.extend(recs)
+        results = []
+        receiver = UplinkReceiver(on_records=fail_first, batch_size=1, max_delay=0.01)
+        port = await receiver.start('127.0.0.1', 0)
+        logger.disabled = True
+        for body in bodies[:3]:
+            await post('127.0.0.1', port, body)
+            await receiver._queue.join()
+        logger.disabled = False
+        await asyncio.wait_for(receiver.stop(), 5)
+        assert len(results) == 3 and receiver.metrics()['batch_errors'] == 1
+
+        # missing or bad Content-Length
+        receiver = UplinkReceiver()
+        port = await receiver.start('127.0.0.1', 0)
+        for head, status in ((b'', b'411'), (b'Content-Length: abc\r\n', b'400'), (b'Content-Length: -1\r\n', b'400')):
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(b'POST / HTTP/1.1\r\nHost: test\r\n' + head + b'\r\n')
+            await writer.drain()
+            assert (await reader.read()).startswith(b'HTTP/1.1 ' + status)
+            writer.close()
+        await receiver.stop()
+
+    asyncio.run(main())
+    print('receiver tests passed')
+
+if __name__ == '__main__':
+    # To run this without import error, need to run "python -m decoder.receiver" from the top level directory.
+    test()
@@ -0,0 +1,219 @@
+"""Module providing a compact record type for decoded readings, and a collector that builds
+columns from many records.  The dictionaries returned by 'decoder.decode()' take several
+hundred bytes per reading, which adds up when a day's readings are held in memory before they
+are written out.  A Reading keeps the message metadata in slots and the sensor values in a
+typed array, and readings with the same set of fields share one tuple of field names.
+
+'decoder.decode(..., as_record=True)' returns a Reading.  The RecordCollector gathers Readings
+and produces NumPy arrays or an Arrow table, one column per metadata item and sensor field,
+without making a dictionary for each reading.
+"""
+from typing import Dict, Any, List, Tuple, Iterable
+from array import array
+
+# Metadata keys of a decoded record that become columns, in column order.  Sensor fields
+# follow these columns.
+RECORD_COLUMNS = (
+    'device_id', 'device_eui', 'ts', 'data_rate', 'port', 'counter',
+    'snr', 'rssi', 'gateway_count',
+)
+
+# Field name tuples in use, so readings with the same fields share one tuple.
+_NAME_TUPLES: Dict[Tuple[str, ...], Tuple[str, ...]] = {}
+
+def _intern_names(names: Tuple[str, ...]) -> Tuple[str, ...]:
+    return _NAME_TUPLES.setdefault(names, names)
+
+class Reading:
+    """A decoded reading.  The sensor values are floats, in the array 'values', named by the
+    corresponding element of 'names'.  Values that are not numbers, which can come from
+    'payload_fields', are in the dictionary 'other', which is None if there are none.
+    """
+    __slots__ = RECORD_COLUMNS + ('names', 'values', 'other')
+
+    def __init__(self, meta: Dict[str, Any], fields: Dict[str, Any]):
+        """'meta' is a dictionary with the RECORD_COLUMNS items, and 'fields' maps sensor
+        field names to values.
+        """
+        for name in RECORD_COLUMNS:
+            setattr(self, name, meta[name])
+        names = []
+        values = array('d')
+        other = None
+        for name, val in fields.items():
+            try:
+                values.append(val)
+                names.append(name)
+            except TypeError:
+                if other is None:
+                    other = {}
+                other[name] = val
+        self.names = _intern_names(tuple(names))
+        self.values = values
+        self.other = other
+
+    @property
+    def fields(self) -> Dict[str, Any]:
+        """The sensor values, as a dictionary.
+        """
+        res = dict(zip(self.names, self.values))
+        if self.other:
+            res.update(self.other)
+        return res
+
+    def get(self, name: str, default=None):
+        """Returns the value of the sensor field 'name', or 'default' if there is none.
+        """
+        try:
+            return self.values[self.names.index(name)]
+        except ValueError:
+            return self.other.get(name, default) if self.other else default
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Returns the reading in the dictionary form returned by 'decoder.decode()'.  Sensor
+        values are floats.
+        """
+        res = {name: getattr(self, name) for name in RECORD_COLUMNS}
+        res['fields'] = self.fields
+        return res
+
+    def __repr__(self):
+        return f'Reading({self.device_id!r}, ts={self.ts}, fields={self.fields!r})'
+
+class RecordCollector:
+    """Collects Readings and produces columns from them.  The values of readings having the
+    same fields are appended to one typed array, so the Readings themselves are not kept.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self._meta: Dict[str, Any] = {
+            name: array('d') if name in ('ts', 'snr', 'rssi') else [] for name in RECORD_COLUMNS
+        }
+        self._values: Dict[Tuple[str, ...], array] = {}     # field names -> values of all rows
+        self._rows: Dict[Tuple[str, ...], array] = {}       # field names -> row numbers
+        self._other: Dict[str, Dict[int, Any]] = {}         # field name -> {row: value}
+
+    def append(self, reading: Reading):
+        row = self.count
+        for name in RECORD_COLUMNS:
+            self._meta[name].append(getattr(reading, name))
+        values = self._values.get(reading.names)
+        if values is None:
+            values = self._values[reading.names] = array('d')
+            self._rows[reading.names] = array('q')
+        values.extend(reading.values)
+        self._rows[reading.names].append(row)
+        if reading.other:
+            for name, val in reading.other.items():
+                self._other.setdefault(name, {})[row] = val
+        self.count += 1
+
+    def extend(self, readings: Iterable[Reading]):
+        for reading in readings:
+            self.append(reading)
+
+    def field_names(self) -> List[str]:
+        """Returns the sensor field names found, in order of first appearance.
+        """
+        names = {}
+        for layout in self._values:
+            names.update(dict.fromkeys(layout))
+        names.update(dict.fromkeys(self._other))
+        return list(names)
+
+    def to_numpy(self) -> Dict[str, Any]:
+        """Returns a dictionary of NumPy arrays, one for each of RECORD_COLUMNS and each sensor
+        field.  Sensor fields are float arrays with NaN for readings that don't have the
+        field, except fields holding values that are not numbers, which are object arrays with
+        None for missing values.  Requires NumPy.
+        """
+        import numpy as np
+        cols = {}
+        for name, vals in self._meta.items():
+            if isinstance(vals, array):
+                cols[name] = np.frombuffer(vals, dtype=np.float64).copy()
+            elif name in ('device_id', 'device_eui', 'data_rate'):
+                cols[name] = np.array(vals, dtype=object)
+            else:
+                cols[name] = np.array(vals)
+
+        for layout, vals in self._values.items():
+            if not layout:
+                continue
+            rows = np.frombuffer(self._rows[layout], dtype=np.int64)
+            block = np.frombuffer(vals, dtype=np.float64).reshape(len(rows), len(layout))
+            for j, name in enumerate(layout):
+                col = cols.get(name)
+                if col is None:
+                    col = cols[name] = np.full(self.count, np.nan)
+                col[rows] = block[:, j]
+
+        for name, row_vals in self._other.items():
+            col = np.full(self.count, None, dtype=object)
+            if name in cols:
+                # a field that is a number in some readings
+                has_num = ~np.isnan(cols[name])
+                col[has_num] = cols[name][has_num]
+            col[list(row_vals)] = list(row_vals.values())
+            cols[name] = col
+        return cols
+
+    def to_arrow(self):
+        """Returns the columns as a pyarrow Table.  Requires NumPy and pyarrow.
+        """
+        import pyarrow as pa
+        cols = self.to_numpy()
+        arrays = {}
+        for name, col in cols.items():
+            if col.dtype == object and name not in ('device_id', 'device_eui', 'data_rate'):
+                col = [v if v is None else str(v) for v in col]
+            arrays[name] = pa.array(col, from_pandas=True)
+        return pa.table(arrays)
+
+def test():
+    import sys
+    import numpy as np
+    from pathlib import Path
+    from .stream import iter_payloads
+    from .decoder import decode
+
+    debug_file = Path(__file__).parent.parent / 'lora-debug.txt'
+    uplinks = list(iter_payloads(debug_file))
+    collector = RecordCollector()
+    for uplink in uplinks:
+        rec = decode(uplink)
+        reading = decode(uplink, as_record=True)
+        assert reading.to_dict() == rec
+        assert reading.get('no such field', 1) == 1
+        collector.append(reading)
+
+    # readings with the same fields share the field name tuple
+    readings = [decode(u, as_record=True) for u in uplinks]
+    assert readings[1].names is readings[2].names
+
+    # smaller than the dictionary form
+    def dict_size(d):
+        return sys.getsizeof(d) + sum(dict_size(v) if isinstance(v, dict) else sys.getsizeof(v) for v in d.values())
+    reading = readings[1]
+    assert sys.getsizeof(reading) + sys.getsizeof(reading.values) < dict_size(decode(uplinks[1])) / 2
+
+    cols = collector.to_numpy()
+    assert len(cols['ts']) == 6 and cols['counter'].tolist() == [0, 254, 255, 256, 0, 1]
+    assert np.isnan(cols['temperature'][0]) and cols['temperature'][1] == decode(uplinks[1])['fields']['temperature']
+    assert set(collector.field_names()) == set(cols) - set(RECORD_COLUMNS)
+
+    # values that are not numbers
+    odd = Reading(decode(uplinks[1]), {'humidity': '66.2', 'vdd': 3.1})
+    assert odd.fields == {'vdd': 3.1, 'humidity': '66.2'} and odd.get('humidity') == '66.2'
+    collector.append(odd)
+    cols = collector.to_numpy()
+    assert cols['humidity'].dtype == object and cols['humidity'][-1] == '66.2'
+    assert cols['humidity'][1] == decode(uplinks[1])['fields']['humidity']
+
+    table = collector.to_arrow()
+    assert table.num_rows == 7 and 'temperature' in table.column_names
+
+if __name__ == '__main__':
+    # To run this without import error, need to run "python -m decoder.records" from the top level directory.
+    test()
@@ -0,0 +1,148 @@
+"""Module holding the registry of payload decoders used by 'decoder.decode()'.  A decoder is
+registered with rules identifying the devices it handles (by Device ID prefix or substring, or
+by the OUI of the Device EUI) and the ports that carry sensor readings.  The decoder chosen
+for a device is cached, so the rules are only evaluated once per device.
+"""
+from typing import Callable, Dict, Any, Optional, Iterable, NamedTuple, FrozenSet, Tuple, List
+from functools import lru_cache
+
+class DecoderEntry(NamedTuple):
+    """A registered decoder.
+    """
+    name: str                               # short name of the decoder, e.g. 'elsys'
+    func: Callable[[bytes], Dict[str, Any]] # decodes a raw payload into a field dictionary
+    ports: Optional[FrozenSet[int]]         # ports carrying sensor readings; None means all ports
+    flat_func: Optional[Callable[[bytes], Dict[str, Any]]] = None
+                                            # decodes with value lists flattened into separate
+                                            # fields; None if the decoder never returns lists
+    projects: bool = False                  # True if the decoding functions take a 'fields'
+                                            # argument to decode only some fields
+
+    def accepts(self, port: int) -> bool:
+        """Returns True if messages on 'port' should be decoded by this decoder.
+        """
+        return self.ports is None or port in self.ports
+
+class DecoderRegistry:
+    """Maps devices to the decoder that handles their payloads.
+    """
+
+    def __init__(self, cache_size: int = 4096):
+        """'cache_size' is the maximum number of devices whose decoder is cached.
+        """
+        # each rule is (DecoderEntry, Device ID prefixes, Device ID substrings, EUI OUIs)
+        self._rules: List[Tuple[DecoderEntry, Tuple[str, ...], Tuple[str, ...], FrozenSet[str]]] = []
+        self._cached_find = lru_cache(maxsize=cache_size)(self._find)
+        self._projecting = set()        # decoding functions that take a 'fields' argument
+
+    def register(
+            self,
+            name: str,
+            func: Callable[[bytes], Dict[str, Any]],
+            prefixes: Iterable[str] = (),
+            contains: Iterable[str] = (),
+            ouis: Iterable[str] = (),
+            ports: Optional[Iterable[int]] = None,
+            flat_func: Optional[Callable[[bytes], Dict[str, Any]]] = None,
+            projects: bool = False,
+        ) -> DecoderEntry:
+        """Registers the decoding function 'func' under 'name'.  The decoder is used for devices
+        whose Device ID starts with one of 'prefixes' or contains one of the 'contains' strings
+        (both case-insensitive), or whose Device EUI starts with one of the 6 hex digit 'ouis'.
+        If 'ports' is given, only messages on those ports are decoded.  Device ID rules are
+        checked before EUI rules, and within each, decoders registered earlier have priority.
+        A decoder whose results can include lists of values must also give 'flat_func', which
+        decodes the same payload but returns each list element as a separate field, named by
+        appending an underscore and the list index to the field name.
+        'projects' is True if the decoding functions accept a 'fields' keyword argument giving
+        the only fields to decode.
+        """
+        entry = DecoderEntry(name, func, None if ports is None else frozenset(ports), flat_func, projects)
+        if projects:
+            self._projecting.add(func)
+            if flat_func is not None:
+                self._projecting.add(flat_func)
+        self._rules.append((
+            entry,
+            tuple(p.lower() for p in prefixes),
+            tuple(s.lower() for s in contains),
+            frozenset(oui.upper() for oui in ouis),
+        ))
+        self._cached_find.cache_clear()
+        return entry
+
+    def _find(self, device_id: str, device_eui: str) -> Optional[DecoderEntry]:
+        """Returns the decoder entry for a device, or None if no decoder handles it.
+        """
+        dev_id_lwr = device_id.lower()
+        for entry, prefixes, contains, _ in self._rules:
+            if dev_id_lwr.startswith(prefixes) or any(s in dev_id_lwr for s in contains):
+                return entry
+        oui = device_eui[:6].upper()
+        for entry, _, _, ouis in self._rules:
+            if oui in ouis:
+                return entry
+        return None
+
+    def lookup(self, device_id: str, device_eui: str = '') -> Optional[DecoderEntry]:
+        """Returns the decoder entry for the device with 'device_id' and 'device_eui', or None
+        if no decoder is registered for the device.  Results are cached per device.
+        """
+        return self._cached_find(device_id, device_eui)
+
+    def decoder_for(
+            self,
+            device_id: str,
+            device_eui: str,
+            port: int,
+            flatten_value_lists: bool = False,
+        ) -> Optional[Callable[[bytes], Dict[str, Any]]]:
+        """Returns the decoding function for a message from a device on 'port', or None if
+        the message should not be decoded.  If 'flatten_value_lists' is True, the function
+        returned does not produce lists of values.
+        """
+        entry = self._cached_find(device_id, device_eui)
+        if entry is None or not entry.accepts(port):
+            return None
+        if flatten_value_lists and entry.flat_func is not None:
+            return entry.flat_func
+        return entry.func
+
+    def projects(self, func: Callable[[bytes], Dict[str, Any]]) -> bool:
+        """Returns True if the decoding function 'func' accepts a 'fields' argument.
+        """
+        return func in self._projecting
+
+    def cache_info(self):
+        """Returns the hit and miss statistics of the device cache.
+        """
+        return self._cached_find.cache_info()
+
+# The registry used by 'decoder.decode()'.  The decoders for the supported sensors are
+# registered by the 'decoder' module.
+default_registry = DecoderRegistry()
+
+def test():
+    reg = DecoderRegistry(cache_size=2)
+    a = lambda data: {'a': 1}
+    b = lambda data: {'b': 1}
+    reg.register('a', a, contains=('abc',), ports=(2,))
+    b_flat = lambda data: {'b_0': 1}
+    reg.register('b', b, prefixes=('xy', 'ers'), ouis=('a81758',), flat_func=b_flat)
+    assert reg.decoder_for('my-ABC-1', '', 2) is a
+    assert reg.decoder_for('my-abc-1', '', 5) is None
+    assert reg.decoder_for('ers-abc', '', 2) is a          # earlier registration wins
+    assert reg.decoder_for('ERS-1', '', 7) is b
+    assert reg.decoder_for('other', 'A81758FFFE0523DB', 7) is b
+    assert reg.decoder_for('other', 'A84041000181C74E', 7) is None
+    reg.decoder_for('other', 'A84041000181C74E', 7)
+    assert reg.cache_info().hits == 1
+    assert reg.decoder_for('ERS-1', '', 7, flatten_value_lists=True) is b_flat
+    assert reg.decoder_for('my-ABC-1', '', 2, flatten_value_lists=True) is a
+    c = lambda data, fields=None: {'c': 1}
+    reg.register('c', c, prefixes=('c',), projects=True)
+    assert reg.projects(c) and not reg.projects(b) and not reg.projects(b_flat)
+
+if __name__ == '__main__':
+    # To run this without import error, need to run "python -m decoder.registry" from the top level directory.
+    test()
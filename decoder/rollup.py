@@ -0,0 +1,321 @@
+"""Module for keeping 1 minute, hourly and daily aggregates of decoded readings, so that
+dashboards covering months read a few thousand rollup rows instead of millions of readings.
+For each device, field and time period the rollup holds the count, minimum, maximum, sum and
+the last value (with its timestamp); the mean is the sum divided by the count.  The signal
+values 'snr', 'rssi' and 'gateway_count' are rolled up along with the sensor fields.  Every
+reading has an 'snr', so the count of the 'snr' field is the number of readings.
+
+Rollups are stored next to the readings in the Parquet store (see the 'store' module), laid
+out as:
+
+    <root>/rollup=<resolution>/period=<period>/part-<id>.parquet
+
+where the period is the UTC day for 1 minute rollups, the month for hourly rollups and the
+year for daily rollups.  Aggregates can be combined, so each write adds part files holding the
+aggregates of the new readings, and part files covering the same time periods are merged when
+read.  'compact()' merges the part files of each period into one.
+
+Requires pandas and pyarrow.
+"""
+from typing import Dict, Any, List, Union, Optional, Iterable, Tuple
+from pathlib import Path
+import os
+import uuid
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from .records import RECORD_COLUMNS, Reading
+from .store import TimeValue
+from .decode_utils import unix_timestamp
+
+# Rollup resolutions and the length of their time periods in seconds.
+RESOLUTIONS = {'1min': 60, 'hour': 3600, 'day': 86400}
+
+# strftime format of the partition holding the rollups of each resolution.
+_PARTITIONS = {'1min': '%Y-%m-%d', 'hour': '%Y-%m', 'day': '%Y'}
+
+# Metadata items of a decoded record that are rolled up like sensor fields.
+SIGNAL_FIELDS = ('snr', 'rssi', 'gateway_count')
+
+# Columns of the stored rollups.  'ts' is the UNIX timestamp of the start of the period.
+ROLLUP_COLUMNS = ('device_id', 'field', 'ts', 'count', 'min', 'max', 'sum', 'last_ts', 'last')
+
+_KEYS = ['device_id', 'field', 'ts']
+
+def _combine(df: pd.DataFrame) -> pd.DataFrame:
+    """Combines the rows of 'df', which has the ROLLUP_COLUMNS, having the same device, field
+    and period into one row.
+    """
+    df = df.sort_values('last_ts', kind='stable')
+    res = df.groupby(_KEYS, sort=False).agg(
+        count=('count', 'sum'),
+        min=('min', 'min'),
+        max=('max', 'max'),
+        sum=('sum', 'sum'),
+        last_ts=('last_ts', 'last'),
+        last=('last', 'last'),
+    )
+    return res.reset_index().sort_values(_KEYS, kind='stable').reset_index(drop=True)
+
+def _aggregate(values: pd.DataFrame, period: int) -> pd.DataFrame:
+    """Returns the rollup of 'values', a DataFrame of readings with 'device_id', 'field',
+    'ts' and 'value' columns, for time periods of 'period' seconds.
+    """
+    return _combine(pd.DataFrame({
+        'device_id': values['device_id'].values,
+        'field': values['field'].values,
+        'ts': values['ts'].values // period * period,
+        'count': 1,
+        'min': values['value'].values,
+        'max': values['value'].values,
+        'sum': values['value'].values,
+        'last_ts': values['ts'].values,
+        'last': values['value'].values,
+    }))
+
+class Rollup:
+    """Accumulates the rollups of decoded readings until they are written to a store.
+    """
+
+    def __init__(self, resolutions: Iterable[str] = tuple(RESOLUTIONS)):
+        """'resolutions' are the keys of RESOLUTIONS to roll up.
+        """
+        self.resolutions = tuple(resolutions)
+        self._rows: List[Tuple[str, str, float, float]] = []        # from 'add()'
+        self._frames: List[pd.DataFrame] = []                       # from 'add_columns()'
+
+    def add(self, record: Union[Dict[str, Any], Reading]):
+        """Adds a decoded record from 'decoder.decode()', or a Reading.  Values that can't be
+        converted to numbers are ignored.
+        """
+        if isinstance(record, Reading):
+            device_id, ts = record.device_id, record.ts
+            fields = record.fields
+            signal = {name: getattr(record, name) for name in SIGNAL_FIELDS}
+        else:
+            device_id, ts = record['device_id'], record['ts']
+            fields = record['fields']
+            signal = record
+        rows = self._rows
+        for name in SIGNAL_FIELDS:
+            rows.append((device_id, name, ts, signal[name]))
+        for name, val in fields.items():
+            try:
+                rows.append((device_id, name, ts, float(val)))
+            except (TypeError, ValueError):
+                pass
+
+    def add_columns(self, data):
+        """Adds the readings in a dictionary of columns from 'stream.records_to_columns()', or
+        a DataFrame with the same columns.
+        """
+        df = data if isinstance(data, pd.DataFrame) else pd.DataFrame(data)
+        fields = [c for c in df.columns if c not in RECORD_COLUMNS or c in SIGNAL_FIELDS]
+        values = df.melt(id_vars=['device_id', 'ts'], value_vars=fields, var_name='field')
+        values['value'] = pd.to_numeric(values['value'], errors='coerce')
+        self._frames.append(values.dropna(subset=['value']))
+
+    def _values(self) -> pd.DataFrame:
+        frames = self._frames
+        if self._rows:
+            frames = frames + [pd.DataFrame(self._rows, columns=['device_id', 'field', 'ts', 'value'])]
+        if not frames:
+            return pd.DataFrame(columns=['device_id', 'field', 'ts', 'value'])
+        values = pd.concat(frames, ignore_index=True)
+        values['ts'] = values['ts'].astype(float)
+        values['value'] = values['value'].astype(float)
+        return values
+
+    def frame(self, resolution: str) -> pd.DataFrame:
+        """Returns the rollup of the readings added, at 'resolution', as a DataFrame with the
+        ROLLUP_COLUMNS.
+        """
+        return _aggregate(self._values(), RESOLUTIONS[resolution])
+
+    def clear(self):
+        self._rows = []
+        self._frames = []
+
+    def write(self, root: Union[str, Path]) -> List[Path]:
+        """Writes the rollups of the readings added to the store at 'root', and clears them.
+        Returns the list of files written.
+        """
+        values = self._values()
+        paths = []
+        if len(values):
+            for resolution in self.resolutions:
+                paths += _write_rollup(root, resolution, _aggregate(values, RESOLUTIONS[resolution]))
+        self.clear()
+        return paths
+
+def _period_dir(root: Union[str, Path], resolution: str) -> Path:
+    return Path(root) / f'rollup={resolution}'
+
+def _write_rollup(root: Union[str, Path], resolution: str, df: pd.DataFrame) -> List[Path]:
+    """Writes the rollup DataFrame 'df' into the partitions of 'resolution' in the store at
+    'root'.  Returns the list of files written.
+    """
+    periods = pd.to_datetime(df['ts'], unit='s').dt.strftime(_PARTITIONS[resolution])
+    paths = []
+    for period, part in df.groupby(periods, sort=False):
+        part_dir = _period_dir(root, resolution) / f'period={period}'
+        part_dir.mkdir(parents=True, exist_ok=True)
+        path = part_dir / f'part-{uuid.uuid4().hex}.parquet'
+        pq.write_table(pa.Table.from_pandas(part[list(ROLLUP_COLUMNS)], preserve_index=False), path)
+        paths.append(path)
+    return paths
+
+def _iter_period_dirs(root: Union[str, Path], resolution: str, start=None, end=None):
+    """Yields the partition directories of 'resolution' that may hold rollups from 'start'
+    up to 'end'.
+    """
+    fmt = _PARTITIONS[resolution]
+    first = pd.Timestamp(unix_timestamp(start), unit='s').strftime(fmt) if start is not None else None
+    last = pd.Timestamp(unix_timestamp(end), unit='s').strftime(fmt) if end is not None else None
+    for period_dir in sorted(_period_dir(root, resolution).glob('period=*')):
+        period = period_dir.name[7:]
+        if (first and period < first) or (last and period > last):
+            continue
+        yield period_dir
+
+def read_rollup(
+        root: Union[str, Path],
+        resolution: str = 'hour',
+        start: Optional[TimeValue] = None,
+        end: Optional[TimeValue] = None,
+        devices: Optional[Iterable[str]] = None,
+        fields: Optional[Iterable[str]] = None,
+    ) -> pd.DataFrame:
+    """Returns the rollups at 'resolution' in the store at 'root' for periods starting at or
+    after 'start' and before 'end', for the 'devices' and 'fields' listed.  Arguments that are
+    None don't restrict the results.  The DataFrame has the columns 'device_id', 'field', 'ts'
+    (the start of the period), 'count', 'min', 'max', 'mean', 'last' and 'last_ts', sorted by
+    device, field and time.  'start' is rounded down to the start of its period.
+    """
+    period = RESOLUTIONS[resolution]
+    filters = []
+    if start is not None:
+        filters.append(('ts', '>=', unix_timestamp(start) // period * period))
+    if end is not None:
+        filters.append(('ts', '<', unix_timestamp(end)))
+    if devices is not None:
+        filters.append(('device_id', 'in', list(devices)))
+    if fields is not None:
+        filters.append(('field', 'in', list(fields)))
+
+    frames = []
+    for period_dir in _iter_period_dirs(root, resolution, start, end):
+        for path in sorted(period_dir.glob('part-*.parquet')):
+            table = pq.read_table(path, filters=filters or None)
+            if table.num_rows:
+                frames.append(table.to_pandas())
+    if not frames:
+        df = pd.DataFrame(columns=ROLLUP_COLUMNS)
+    else:
+        df = _combine(pd.concat(frames, ignore_index=True))
+    df['mean'] = df['sum'] / df['count']
+    return df[['device_id', 'field', 'ts', 'count', 'min', 'max', 'mean', 'last', 'last_ts']]
+
+def reading_counts(
+        root: Union[str, Path],
+        resolution: str = 'hour',
+        start: Optional[TimeValue] = None,
+        end: Optional[TimeValue] = None,
+        devices: Optional[Iterable[str]] = None,
+    ) -> pd.DataFrame:
+    """Returns the number of readings per period from the rollups in the store at 'root', as
+    a DataFrame with a UTC DatetimeIndex of the period starts and a column for each device.
+    Periods without readings are not included.
+    """
+    df = read_rollup(root, resolution, start, end, devices, fields=['snr'])
+    counts = df.pivot(index='ts', columns='device_id', values='count')
+    counts.index = pd.to_datetime(counts.index, unit='s', utc=True)
+    counts.columns.name = None
+    return counts
+
+def compact(root: Union[str, Path], resolution: Optional[str] = None):
+    """Merges the part files in each rollup partition of the store at 'root' into one file.
+    If 'resolution' is given, only its rollups are compacted.
+    """
+    for res in ([resolution] if resolution else RESOLUTIONS):
+        for period_dir in _iter_period_dirs(root, res):
+            paths = sorted(period_dir.glob('part-*.parquet'))
+            if len(paths) < 2:
+                continue
+            df = _combine(pd.concat([pq.read_table(p).to_pandas() for p in paths], ignore_index=True))
+            # the merged file only gets its part file name after the files it replaces are
+            # removed, so the rows are never read twice.
+            tmp_path = period_dir / 'compact.tmp'
+            pq.write_table(pa.Table.from_pandas(df[list(ROLLUP_COLUMNS)], preserve_index=False), tmp_path)
+            for path in paths:
+                path.unlink()
+            os.replace(tmp_path, period_dir / f'part-{uuid.uuid4().hex}.parquet')
+
+def test():
+    import tempfile
+    import numpy as np
+    from .stream import iter_records, records_to_columns
+    from .store import ingest_archive, read_records
+
+    debug_file = Path(__file__).parent.parent / 'lora-debug.txt'
+    records = list(iter_records(debug_file))
+
+    # adding records one at a time and as columns give the same rollups
+    by_record = Rollup()
+    for rec in records:
+        by_record.add(rec)
+    by_columns = Rollup()
+    by_columns.add_columns(records_to_columns(records))
+    odd = dict(records[1], fields={'humidity': '66.2', 'state': 'open'})
+    by_record.add(odd)
+    by_columns.add_columns(records_to_columns([odd]))
+    for resolution in RESOLUTIONS:
+        pd.testing.assert_frame_equal(by_record.frame(resolution), by_columns.frame(resolution))
+    assert 'state' not in set(by_record.frame('day').field)
+
+    lines = open(debug_file, 'rb').read().splitlines(keepends=True)
+    with tempfile.TemporaryDirectory() as tmp:
+        # ingest part of the archive, then the whole of it; also writes the rollups
+        archive = Path(tmp) / 'lora.json'
+        archive.write_bytes(b''.join(lines[:3]))
+        root = Path(tmp) / 'store'
+        ingest_archive(root, archive, chunk_size=2)
+        archive.write_bytes(b''.join(lines))
+        ingest_archive(root, archive, chunk_size=2)
+        ingest_archive(root, archive)       # nothing new, so nothing is added
+        raw = read_records(root)
+        assert len(raw) == len(lines)
+
+        # hourly rollups match resampling the raw readings
+        df = read_rollup(root, 'hour', fields=['temperature', 'snr'])
+        lht65 = raw[raw.device_id == 'lht65-a8404173e1822ca4'].set_index(pd.to_datetime(raw.ts[raw.device_id == 'lht65-a8404173e1822ca4'], unit='s'))
+        expected = lht65['temperature'].resample('1h').agg(['count', 'min', 'max', 'mean', 'last']).dropna()
+        got = df[(df.device_id == 'lht65-a8404173e1822ca4') & (df.field == 'temperature')]
+        assert got['count'].tolist() == expected['count'].tolist()
+        for col in ('min', 'max', 'mean', 'last'):
+            assert np.allclose(got[col], expected[col])
+        assert got['last_ts'].iloc[-1] == lht65.ts.max()
+
+        counts = reading_counts(root, 'hour')
+        assert counts.sum().to_dict() == raw.device_id.value_counts().to_dict()
+        assert read_rollup(root, 'day', fields=['snr'])['count'].sum() == len(raw)
+
+        # each ingest added part files, which are merged when read and by compact()
+        minute = read_rollup(root, '1min', devices=['lht65-a8404173e1822ca4'], fields=['temperature'])
+        assert minute['count'].sum() == lht65['temperature'].count()
+        assert any(len(list(d.glob('part-*'))) > 1 for d in root.glob('rollup=*/period=*'))
+        compact(root)
+        assert all(len(list(d.glob('part-*'))) == 1 for d in root.glob('rollup=*/period=*'))
+        pd.testing.assert_frame_equal(
+            read_rollup(root, '1min', devices=['lht65-a8404173e1822ca4'], fields=['temperature']), minute)
+
+        # time range
+        df = read_rollup(root, '1min', start='2020-11-12 17:39:30', end='2020-11-12 17:40')
+        assert df.ts.min() == unix_timestamp('2020-11-12 17:39') and df.ts.max() < unix_timestamp('2020-11-12 17:40')
+        assert read_rollup(root, 'hour', start='2020-11-13').empty
+
+if __name__ == '__main__':
+    # To run this without import error, need to run "python -m decoder.rollup" from the top level directory.
+    test()
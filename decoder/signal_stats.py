@@ -0,0 +1,212 @@
+"""Module that accumulates signal statistics for each (device, gateway) link while uplinks are
+decoded.  'decoder.decode()' only reports the SNR and RSSI of the best gateway, but coverage
+reports need the signal from every gateway that heard a device.  For each link, the count,
+mean, variance, minimum and maximum of SNR and RSSI are updated with each reception using
+Welford's method, and SNR is also counted in a histogram with fixed bins.  Memory use per link
+is constant, so the statistics can be kept for a whole archive and read at any time.
+"""
+from typing import Dict, Any, List, Optional, Tuple
+import math
+
+from .decode_utils import rfc3339_timestamp
+
+class RunningStats:
+    """Count, mean, variance, minimum and maximum of a stream of values.
+    """
+    __slots__ = ('count', 'mean', 'm2', 'min', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0           # sum of squared differences from the mean
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, val: float):
+        self.count += 1
+        delta = val - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (val - self.mean)
+        if val < self.min:
+            self.min = val
+        if val > self.max:
+            self.max = val
+
+    def merge(self, other: 'RunningStats'):
+        """Adds the values summarized by 'other' to these statistics.
+        """
+        if other.count == 0:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    @property
+    def variance(self) -> float:
+        """Sample variance; NaN if there are fewer than 2 values.
+        """
+        return self.m2 / (self.count - 1) if self.count > 1 else math.nan
+
+    @property
+    def std(self) -> float:
+        return math.sqrt(self.variance)
+
+class LinkStats:
+    """Signal statistics for one (device, gateway) link.
+    """
+    __slots__ = ('snr', 'rssi', 'snr_hist', 'first_ts', 'last_ts')
+
+    def __init__(self, bin_count: int):
+        self.snr = RunningStats()
+        self.rssi = RunningStats()
+        self.snr_hist = [0] * bin_count
+        self.first_ts = math.inf
+        self.last_ts = -math.inf
+
+class SignalStats:
+    """Signal statistics for all the (device, gateway) links seen.
+    """
+
+    def __init__(self, snr_low: float = -20.0, snr_high: float = 15.0, bin_width: float = 1.0):
+        """The SNR histogram has bins 'bin_width' dB wide from 'snr_low' to 'snr_high'.  Values
+        below or above that range are counted in the first or last bin.
+        """
+        self.snr_low = snr_low
+        self.bin_width = bin_width
+        self.bin_count = int(math.ceil((snr_high - snr_low) / bin_width))
+        self._links: Dict[Tuple[str, str], LinkStats] = {}
+
+    @property
+    def bin_edges(self) -> List[float]:
+        """The edges of the SNR histogram bins; there is one more edge than bins.
+        """
+        return [self.snr_low + i * self.bin_width for i in range(self.bin_count + 1)]
+
+    def add(self, device_id: str, gateway_id: str, snr: float, rssi: float, ts: Optional[float] = None):
+        """Adds one reception of an uplink from 'device_id' by 'gateway_id'.  'ts' is the UNIX
+        timestamp of the uplink, if known.
+        """
+        link = self._links.get((device_id, gateway_id))
+        if link is None:
+            link = self._links[(device_id, gateway_id)] = LinkStats(self.bin_count)
+        link.snr.add(snr)
+        link.rssi.add(rssi)
+        ix = int((snr - self.snr_low) // self.bin_width)
+        link.snr_hist[min(max(ix, 0), self.bin_count - 1)] += 1
+        if ts is not None:
+            link.first_ts = min(link.first_ts, ts)
+            link.last_ts = max(link.last_ts, ts)
+
+    def add_uplink(self, integration_payload: Dict[str, Any], ts: Optional[float] = None):
+        """Adds the receptions by all the gateways listed in a Things Network HTTP Integration
+        payload.  'ts' is the UNIX timestamp of the uplink; it is taken from the payload if not
+        given.
+        """
+        if ts is None:
+            ts = rfc3339_timestamp(integration_payload['metadata']['time'])
+        device_id = integration_payload['dev_id']
+        for gtw in integration_payload['metadata']['gateways']:
+            self.add(device_id, gtw['gtw_id'], gtw['snr'], gtw['rssi'], ts)
+
+    def empty_copy(self) -> 'SignalStats':
+        """Returns a SignalStats with the same histogram bins and no statistics.
+        """
+        res = SignalStats.__new__(SignalStats)
+        res.snr_low, res.bin_width, res.bin_count = self.snr_low, self.bin_width, self.bin_count
+        res._links = {}
+        return res
+
+    def merge(self, other: 'SignalStats'):
+        """Adds the statistics in 'other', which must have the same histogram bins.
+        """
+        if other.bin_edges != self.bin_edges:
+            raise ValueError('SNR histogram bins do not match.')
+        for key, src in other._links.items():
+            link = self._links.get(key)
+            if link is None:
+                link = self._links[key] = LinkStats(self.bin_count)
+            link.snr.merge(src.snr)
+            link.rssi.merge(src.rssi)
+            link.snr_hist = [a + b for a, b in zip(link.snr_hist, src.snr_hist)]
+            link.first_ts = min(link.first_ts, src.first_ts)
+            link.last_ts = max(link.last_ts, src.last_ts)
+
+    def link(self, device_id: str, gateway_id: str) -> Optional[LinkStats]:
+        """Returns the statistics for one link, or None if it hasn't been seen.
+        """
+        return self._links.get((device_id, gateway_id))
+
+    def links(self) -> List[Tuple[str, str]]:
+        """Returns the (device, gateway) links seen.
+        """
+        return list(self._links)
+
+    def histogram(self, device_id: Optional[str] = None, gateway_id: Optional[str] = None) -> List[int]:
+        """Returns the SNR histogram counts summed over the links for 'device_id' and
+        'gateway_id'; None includes all devices or gateways.
+        """
+        hist = [0] * self.bin_count
+        for (dev, gtw), link in self._links.items():
+            if (device_id is None or dev == device_id) and (gateway_id is None or gtw == gateway_id):
+                hist = [a + b for a, b in zip(hist, link.snr_hist)]
+        return hist
+
+    def summary(self) -> List[Dict[str, Any]]:
+        """Returns a list with a dictionary of statistics for each link, suitable for making
+        a DataFrame.
+        """
+        rows = []
+        for (dev, gtw), link in self._links.items():
+            row = dict(device_id=dev, gateway=gtw, count=link.snr.count,
+                       first_ts=link.first_ts, last_ts=link.last_ts)
+            for name in ('snr', 'rssi'):
+                st = getattr(link, name)
+                row.update({
+                    f'{name}_mean': st.mean, f'{name}_std': st.std,
+                    f'{name}_min': st.min, f'{name}_max': st.max,
+                })
+            rows.append(row)
+        return rows
+
+def test():
+    import statistics
+    from pathlib import Path
+    from .stream import iter_payloads
+    from .decoder import decode
+
+    stats = SignalStats()
+    snrs = [9.25, 11, -7.5, 3, 30, -40]
+    for i, snr in enumerate(snrs):
+        stats.add('dev', 'gtw', snr, -100 + i, ts=float(i))
+    link = stats.link('dev', 'gtw')
+    assert link.snr.count == 6 and link.snr.min == -40 and link.snr.max == 30
+    assert math.isclose(link.snr.mean, statistics.mean(snrs))
+    assert math.isclose(link.snr.variance, statistics.variance(snrs))
+    assert sum(link.snr_hist) == 6 and link.snr_hist[0] == 1 and link.snr_hist[-1] == 1
+    assert (link.first_ts, link.last_ts) == (0.0, 5.0)
+
+    # merging partial statistics gives the same result as one pass
+    a, b = SignalStats(), SignalStats()
+    for i, snr in enumerate(snrs):
+        (a if i % 2 else b).add('dev', 'gtw', snr, -100 + i, ts=float(i))
+    a.merge(b)
+    merged = a.link('dev', 'gtw')
+    assert math.isclose(merged.snr.variance, link.snr.variance) and merged.snr_hist == link.snr_hist
+
+    # statistics gathered while decoding
+    stats = SignalStats()
+    debug_file = Path(__file__).parent.parent / 'lora-debug.txt'
+    for rec in iter_payloads(debug_file):
+        decode(rec, signal_stats=stats)
+    assert stats.links() == [('ersco2-a81758fffe0526d8', 'eui-a840411d91b44150'),
+                             ('lht65-a8404173e1822ca4', 'eui-a840411d91b44150')]
+    assert sum(stats.histogram()) == 6 and sum(stats.histogram(gateway_id='other')) == 0
+    assert len(stats.summary()) == 2
+
+if __name__ == '__main__':
+    # To run this without import error, need to run "python -m decoder.signal_stats" from the top level directory.
+    test()
@@ -0,0 +1,368 @@
+"""Module for describing sensor payload formats declaratively and compiling the descriptions
+into decoding functions.  A payload is either a fixed layout, a Block of Fields at set byte
+offsets, optionally followed by one of several extension blocks chosen by the value of a
+field, or a TLV layout:  a sequence of blocks, each introduced by a one byte type code, as used
+by the Elsys sensors.
+
+A Field gives the offset, width and signedness of an integer in its block, and how to turn it
+into an engineering value:  a bit mask and shift, a divisor and a unit conversion.  Values are
+divided rather than multiplied by a scale factor so results are identical to hand-written
+decoders that divide.  Blocks whose values can't be described by Fields, e.g. a list of pixel
+values, are given as a RawBlock with a struct format and a conversion function.
+
+The compile functions generate Python source for the decoder, with one struct unpack per
+block and the conversions written out as expressions, and compile it once, when the decoder
+module is imported.  The generated source shows up in tracebacks.
+"""
+from typing import Dict, Any, Tuple, Callable, Optional, NamedTuple, Union, List
+import linecache
+import struct
+
+from .decode_utils import byte_view
+
+# struct format codes for integers, by (width in bytes, signed)
+_INT_FORMATS = {
+    (1, False): 'B', (1, True): 'b',
+    (2, False): 'H', (2, True): 'h',
+    (4, False): 'I', (4, True): 'i',
+    (8, False): 'Q', (8, True): 'q',
+}
+
+# Unit conversions from the unit reported by the sensor, as expression templates applied to
+# the scaled value.
+UNITS = {
+    'degF': '{} * 1.8 + 32.0',      # degrees C to degrees F
+}
+
+class Field(NamedTuple):
+    """An integer value in a block of payload bytes.  Fields with a name starting with '_'
+    are read but not returned; they can be used to choose an extension block.  Several
+    Fields can read the same bytes, e.g. to extract different bits.
+    """
+    name: str
+    offset: int = 0                 # byte offset of the value within its block
+    width: int = 1                  # width of the value in bytes:  1, 2, 4 or 8
+    signed: bool = False
+    mask: Optional[int] = None      # bits of the raw value to keep
+    shift: int = 0                  # right shift applied after the mask
+    divisor: Optional[float] = None # the value is divided by this
+    unit: Optional[str] = None      # key of the unit conversion in UNITS, applied last
+    missing: Optional[int] = None   # raw value meaning there is no reading; the field is
+                                    # then left out of the results
+
+class Block(NamedTuple):
+    """A group of Fields read with one struct unpack.
+    """
+    fields: Tuple[Field, ...]
+    little_endian: bool = False
+    width: Optional[int] = None     # width of the block in bytes; None means it ends with
+                                    # its last Field
+
+class RawBlock(NamedTuple):
+    """A block whose values are produced by a conversion function.
+    """
+    fields: Tuple[str, ...]         # names of the values produced
+    format: str                     # struct format of the raw values, including byte order
+    convert: Optional[Callable] = None  # converts the tuple of raw values into a tuple of
+                                        # values, one per field.  None means the raw values
+                                        # are used as is.
+    list_length: int = 0            # for a block whose one field is a list of values, the
+                                    # length of the list
+
+class FixedSpec(NamedTuple):
+    """A payload with the Fields of 'block' starting at byte 0.  If 'select' names a Field,
+    the block in 'variants' for the value of that Field, given with its byte offset in the
+    payload, is decoded as well.
+    """
+    block: Block
+    select: Optional[str] = None
+    variants: Dict[int, Tuple[int, Block]] = {}
+
+class TLVSpec(NamedTuple):
+    """A payload of blocks, each preceded by a type code byte giving the block in 'blocks'.
+    The fields named in 'repeatable' can occur more than once in a payload.
+    """
+    blocks: Dict[int, Union[Block, RawBlock]]
+    repeatable: Tuple[str, ...] = ()
+
+class Layout(NamedTuple):
+    """A compiled block:  the struct that unpacks its raw values and the function that
+    converts them.  The conversion only uses arithmetic, so it also works on arrays of raw
+    values, unless a field of the block has a 'missing' value:  that check is a conditional
+    expression, which only works on single values.
+    """
+    fields: Tuple[str, ...]         # names of the values produced
+    struct: struct.Struct           # unpacks the raw values of the block
+    convert: Optional[Callable]     # converts the tuple of raw values into a tuple of values,
+                                    # one per field.  None means the raw values are used as is.
+    list_length: int = 0            # for a block whose one field is a list of values, the
+                                    # length of the list; 0 for other blocks.
+
+    @property
+    def width(self) -> int:
+        """Number of bytes in the block.
+        """
+        return self.struct.size
+
+def add_repeated(res: Dict[str, Any], name: str, val, flatten_value_lists: bool):
+    """Adds the value 'val' of the repeatable field 'name' to the results 'res'.  The first
+    occurrence is stored as a single value; further occurrences convert the value into a list
+    of values, or, if 'flatten_value_lists' is True, into fields numbered like a flattened list.
+    """
+    if name not in res:
+        if flatten_value_lists and f'{name}_0' in res:
+            # third or later occurrence
+            ix = 2
+            while f'{name}_{ix}' in res:
+                ix += 1
+            res[f'{name}_{ix}'] = val
+        else:
+            res[name] = val
+    elif flatten_value_lists:
+        # second occurrence
+        res[f'{name}_0'] = res.pop(name)
+        res[f'{name}_1'] = val
+    else:
+        exist_rd = res[name]
+        if type(exist_rd) == list:
+            # the existing value is already a list of readings.  Append to it.
+            exist_rd.append(val)
+        else:
+            # one existing reading. make a list.
+            res[name] = [exist_rd, val]
+
+def _unpacker(block: Block, prefix: str) -> Tuple[struct.Struct, Dict[Field, str]]:
+    """Returns the struct that unpacks the raw values of 'block', and a dictionary giving
+    the variable, named starting with 'prefix', that holds the raw value of each Field.
+    """
+    fmt = ['<' if block.little_endian else '>']
+    slots = {}          # (offset, width, signed) -> variable name
+    pos = 0
+    for field in sorted(block.fields, key=lambda f: f.offset):
+        key = (field.offset, field.width, field.signed)
+        if key in slots:
+            continue
+        if (field.width, field.signed) not in _INT_FORMATS:
+            raise ValueError(f'Field {field.name} has an unsupported width of {field.width}.')
+        if field.offset < pos:
+            raise ValueError(f'Field {field.name} overlaps the previous field.')
+        fmt.append('x' * (field.offset - pos) + _INT_FORMATS[(field.width, field.signed)])
+        slots[key] = f'{prefix}{len(slots)}'
+        pos = field.offset + field.width
+    if block.width is not None:
+        if block.width < pos:
+            raise ValueError(f'Block width {block.width} is less than the width of its fields.')
+        fmt.append('x' * (block.width - pos))
+    return struct.Struct(''.join(fmt)), {f: slots[(f.offset, f.width, f.signed)] for f in block.fields}
+
+def _value_expr(field: Field, var: str) -> str:
+    """Returns the expression giving the value of 'field' from its raw value in 'var'.
+    """
+    expr = var
+    if field.mask is not None:
+        expr = f'({expr} & {field.mask:#x})'
+    if field.shift:
+        expr = f'({expr} >> {field.shift})'
+    if field.divisor is not None:
+        expr = f'{expr} / {field.divisor!r}'
+    if field.unit is not None:
+        expr = UNITS[field.unit].format(expr)
+    return expr
+
+def _unpack_line(variables: List[str], unpack: str, offset: str) -> str:
+    return f'{", ".join(variables)}, = {unpack}(data, {offset})'
+
+def _block_lines(block: Block, prefix: str, unpack: str, offset: str, store: Callable[[str, str], str]) -> List[str]:
+    """Returns the lines of source that unpack 'block' at 'offset' with the function named
+    'unpack' and store each value using the line made by 'store(name, expression)'.
+    """
+    st, variables = _unpacker(block, prefix)
+    lines = [_unpack_line(sorted(set(variables.values()), key=lambda v: int(v[len(prefix):])), unpack, offset)]
+    for field in block.fields:
+        if field.name.startswith('_'):
+            continue
+        var = variables[field]
+        line = store(field.name, _value_expr(field, var))
+        if field.missing is not None:
+            lines += [f'if {var} != {field.missing:#x}:', '    ' + line]
+        else:
+            lines.append(line)
+    return lines
+
+def _build(source: str, name: str, namespace: Dict[str, Any], doc: Optional[str] = None) -> Callable:
+    """Compiles the generated 'source', defining the function 'name', and returns the function
+    with the docstring 'doc'.
+    """
+    filename = f'<spec {name}>'
+    namespace.update(byte_view=byte_view, add_repeated=add_repeated)
+    exec(compile(source, filename, 'exec'), namespace)
+    # so tracebacks show the generated source
+    linecache.cache[filename] = (len(source), None, source.splitlines(True), filename)
+    func = namespace[name]
+    func.__doc__ = doc
+    return func
+
+def compile_fixed(spec: FixedSpec, name: str, doc: Optional[str] = None) -> Callable[[bytes], Dict[str, Any]]:
+    """Returns a function named 'name', with the docstring 'doc', that decodes a payload
+    described by 'spec' into a dictionary of values.  The payload can be bytes or any object
+    supporting the buffer protocol.
+    """
+    namespace = {}
+    st, variables = _unpacker(spec.block, 'v')
+    namespace['_unpack'] = st.unpack_from
+    lines = [
+        f'def {name}(data):',
+        '    if type(data) is not bytes:',
+        '        data = byte_view(data)',
+        '    res = {}',
+    ]
+    body = _block_lines(spec.block, 'v', '_unpack', '0', lambda n, expr: f'res[{n!r}] = {expr}')
+    if spec.select is not None:
+        select = next(f for f in spec.block.fields if f.name == spec.select)
+        body.append(f'select = {_value_expr(select, variables[select])}')
+        keyword = 'if'
+        for ix, (value, (offset, block)) in enumerate(spec.variants.items()):
+            unpack = f'_unpack{ix}'
+            namespace[unpack] = _unpacker(block, 'w')[0].unpack_from
+            body.append(f'{keyword} select == {value!r}:')
+            body += ['    ' + line for line in _block_lines(
+                block, 'w', unpack, str(offset), lambda n, expr: f'res[{n!r}] = {expr}')]
+            keyword = 'elif'
+    lines += ['    ' + line for line in body] + ['    return res']
+    return _build('\n'.join(lines) + '\n', name, namespace, doc)
+
+def layouts(spec: TLVSpec) -> Dict[int, Layout]:
+    """Returns the Layout of each block of the TLV 'spec', by type code.
+    """
+    res = {}
+    for code, block in spec.blocks.items():
+        if isinstance(block, RawBlock):
+            res[code] = Layout(block.fields, struct.Struct(block.format), block.convert, block.list_length)
+            continue
+        st, variables = _unpacker(block, 'v')
+        fields = [f for f in block.fields if not f.name.startswith('_')]
+        exprs = []
+        for field in fields:
+            expr = _value_expr(field, variables[field])
+            if field.missing is not None:
+                expr = f'({expr} if {variables[field]} != {field.missing:#x} else None)'
+            exprs.append(expr)
+        raw_vars = sorted(set(variables.values()), key=lambda v: int(v[1:]))
+        convert = None
+        if exprs != raw_vars:
+            name = f'convert_{code:#04x}'
+            source = f'def {name}(vals):\n    {", ".join(raw_vars)}, = vals\n    return ({", ".join(exprs)},)\n'
+            convert = _build(source, name, {})
+        res[code] = Layout(tuple(f.name for f in fields), st, convert)
+    return res
+
+def compile_tlv(
+        spec: TLVSpec,
+        name: str,
+        flatten_value_lists: bool = False,
+        doc: Optional[str] = None,
+    ) -> Callable[[bytes], Dict[str, Any]]:
+    """Returns a function named 'name', with the docstring 'doc', that decodes a payload
+    described by 'spec' into a dictionary of values.  The payload can be bytes or any object
+    supporting the buffer protocol.  A KeyError is raised for an unknown type code.  Repeated
+    fields give a list of values, and list fields a list; if 'flatten_value_lists' is True,
+    the list elements are instead returned as separate fields, named by appending an
+    underscore and the list index to the field name.
+    """
+    namespace = {}
+    handlers = {}
+    for code, block in spec.blocks.items():
+        handler = f'_block_{code:#04x}'
+        unpack = f'_unpack_{code:#04x}'
+        width = (struct.calcsize(block.format) if isinstance(block, RawBlock) else _unpacker(block, 'v')[0].size)
+        names = block.fields if isinstance(block, RawBlock) else [f.name for f in block.fields]
+        repeatable = any(n in spec.repeatable for n in names)
+
+        def store(n, expr):
+            if repeatable and n in spec.repeatable:
+                return f'add_repeated(res, {n!r}, {expr}, {flatten_value_lists})'
+            return f'res[{n!r}] = {expr}'
+
+        lines = [f'def {handler}(data, i, res):']
+        if isinstance(block, RawBlock):
+            namespace[unpack] = struct.Struct(block.format).unpack_from
+            namespace[f'_convert_{code:#04x}'] = block.convert
+            vals = f'{unpack}(data, i)'
+            if block.convert is not None:
+                vals = f'_convert_{code:#04x}({vals})'
+            lines.append(f'    vals = {vals}')
+            for j, n in enumerate(block.fields):
+                if block.list_length and flatten_value_lists:
+                    namespace[f'_names_{code:#04x}'] = tuple(f'{n}_{ix}' for ix in range(block.list_length))
+                    lines.append(f'    res.update(zip(_names_{code:#04x}, vals[{j}]))')
+                else:
+                    lines.append('    ' + store(n, f'vals[{j}]'))
+        else:
+            namespace[unpack] = _unpacker(block, 'v')[0].unpack_from
+            lines += ['    ' + line for line in _block_lines(block, 'v', unpack, 'i', store)]
+        lines.append(f'    return i + {width}')
+        _build('\n'.join(lines) + '\n', handler, namespace)
+        handlers[code] = namespace[handler]
+
+    namespace['_handlers'] = handlers
+    source = '\n'.join([
+        f'def {name}(data):',
+        '    if type(data) is not bytes:',
+        '        data = byte_view(data)',
+        '    res = {}',
+        '    # index into the payload.  The byte at index i is the type code; the block',
+        '    # data starts at i + 1.  Each handler returns the index of the next type code.',
+        '    i = 0',
+        '    data_len = len(data)',
+        '    while i < data_len:',
+        '        i = _handlers[data[i]](data, i + 1, res)',
+        '    return res',
+    ]) + '\n'
+    return _build(source, name, namespace, doc)
+
+def test():
+    # a fixed layout with an extension block chosen by a masked field
+    spec = FixedSpec(
+        Block((
+            Field('temp', 1, 2, signed=True, divisor=10, unit='degF'),
+            Field('flags', 0, 1, mask=0xF0, shift=4),
+            Field('_kind', 0, 1, mask=0x0F),
+        )),
+        select='_kind',
+        variants={
+            1: (3, Block((Field('level', 0, 2, missing=0xFFFF),))),
+            2: (4, Block((Field('count', 0, 4, divisor=1000),), little_endian=True)),
+        },
+    )
+    dec = compile_fixed(spec, 'decode_test')
+    assert dec(bytes.fromhex('A1FF9C0102')) == {'temp': 14.0, 'flags': 10, 'level': 258}
+    assert dec(bytes.fromhex('A1FF9CFFFF')) == {'temp': 14.0, 'flags': 10}
+    assert dec(memoryview(bytes.fromhex('0200640010270000'))) == {'temp': 50.0, 'flags': 0, 'count': 10.0}
+    assert dec(bytes.fromhex('0300640010270000')) == {'temp': 50.0, 'flags': 0}
+
+    # a TLV layout with a repeatable field and a list field
+    spec = TLVSpec({
+        1: Block((Field('a', 0, 2, signed=True),)),
+        2: Block((Field('b', 0, 1), Field('c', 1, 1, divisor=2)), width=3),
+        3: RawBlock(('pixels',), '>BBB', lambda vals: (list(vals),), list_length=3),
+    }, repeatable=('a',))
+    dec = compile_tlv(spec, 'decode_tlv')
+    payload = bytes.fromhex('01FFFE020305FF0301020301000A')
+    assert dec(payload) == {'a': [-2, 10], 'b': 3, 'c': 2.5, 'pixels': [1, 2, 3]}
+    flat = compile_tlv(spec, 'decode_tlv_flat', flatten_value_lists=True)
+    assert flat(payload) == {'a_0': -2, 'a_1': 10, 'b': 3, 'c': 2.5, 'pixels_0': 1, 'pixels_1': 2, 'pixels_2': 3}
+    for bad in (payload + b'\x09', payload + b'\x01\x00'):
+        try:
+            dec(bad)
+            assert False
+        except (KeyError, struct.error):
+            pass
+
+    # layouts convert tuples of raw values
+    lay = layouts(spec)
+    assert lay[1].convert is None and lay[2].width == 3 and lay[2].convert((3, 5)) == (3, 2.5)
+    assert lay[3].list_length == 3
+
+if __name__ == '__main__':
+    # To run this without import error, need to run "python -m decoder.spec" from the top level directory.
+    test()
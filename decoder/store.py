@@ -0,0 +1,252 @@
+"""Module for storing decoded readings in a columnar format, Parquet files, partitioned by day
+and device.  The files are laid out as:
+
+    <root>/day=YYYY-MM-DD/device=<device_id>/part-<id>.parquet
+
+where the day is the UTC day of the reading timestamp.  Each write adds new part files, so data
+can be appended without rewriting existing files.  When reading, only the partitions for the
+requested days and devices are opened, and the time range is also passed to the Parquet reader
+so that row groups outside the range are skipped.
+
+Unless turned off, writing readings also updates the 1 minute, hourly and daily rollups of
+the readings kept in the same store (see the 'rollup' module).
+
+'ingest_archive()' keeps the store up to date with a growing JSON-lines archive like
+'lora.json':  it only writes the lines appended since the archive was last ingested, so it can
+be run again and again without storing a reading twice.
+
+Requires pandas and pyarrow.
+"""
+from typing import Any, List, Union, Optional, Iterable, Iterator, Tuple
+from pathlib import Path
+from urllib.parse import quote, unquote
+import io
+import json
+import os
+import uuid
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from .stream import records_to_columns, iter_column_batches
+from .decode_utils import unix_timestamp, append_check
+
+# A time value:  a UNIX timestamp, a datetime, or a string like '2020-11-12 17:00'.  Times
+# without a timezone are taken to be UTC.
+TimeValue = Union[float, int, str, Any]
+
+# File in the store root recording how much of each archive has been ingested.
+INGEST_STATE = 'ingested.json'
+
+def _day(unix_ts: float) -> str:
+    return pd.Timestamp(unix_ts, unit='s').strftime('%Y-%m-%d')
+
+def _clean_column(col: pd.Series) -> pd.Series:
+    """Makes a column storable in Parquet.  Columns holding a mix of types, which happens
+    with some 'payload_fields' values, are converted to numbers if possible, otherwise to
+    strings.
+    """
+    if col.dtype != object:
+        return col
+    try:
+        return pd.to_numeric(col)
+    except (ValueError, TypeError):
+        return col.map(lambda v: v if v is None else str(v))
+
+def write_records(root: Union[str, Path], data, rollups: bool = True) -> List[Path]:
+    """Writes decoded records to the store at 'root'.  'data' is a list of decoded records from
+    'decoder.decode()', a dictionary of columns from 'stream.records_to_columns()', or a
+    DataFrame with the same columns.  If 'rollups' is True, the rollups of the records are
+    written as well.  Returns the list of reading files written.
+    """
+    if isinstance(data, list):
+        data = records_to_columns(data)
+    df = data if isinstance(data, pd.DataFrame) else pd.DataFrame(data)
+    if df.empty:
+        return []
+    days = pd.to_datetime(df['ts'], unit='s').dt.strftime('%Y-%m-%d')
+
+    paths = []
+    for (day, device_id), part in df.groupby([days, df['device_id']], sort=False):
+        # only keep the columns that this device has values for.
+        part = part.dropna(axis='columns', how='all').sort_values('ts')
+        part = part.apply(_clean_column)
+        part_dir = Path(root) / f'day={day}' / f'device={quote(device_id, safe="")}'
+        part_dir.mkdir(parents=True, exist_ok=True)
+        path = part_dir / f'part-{uuid.uuid4().hex}.parquet'
+        pq.write_table(pa.Table.from_pandas(part, preserve_index=False), path)
+        paths.append(path)
+
+    if rollups:
+        # imported here because the rollup module uses this one.
+        from .rollup import Rollup
+        rollup = Rollup()
+        rollup.add_columns(df)
+        rollup.write(root)
+    return paths
+
+def write_archive(root: Union[str, Path], source, chunk_size: int = 50000, rollups: bool = True, **kwargs) -> int:
+    """Decodes the JSON-lines archive 'source' (see 'stream.iter_records()') and writes the
+    records, and their rollups if 'rollups' is True, to the store at 'root', one chunk at a
+    time.  Other keyword arguments are passed to 'stream.iter_column_batches()'.  Returns the
+    number of records written.  All the records are written on every call; use
+    'ingest_archive()' to only write the ones not already in the store.
+    """
+    count = 0
+    for cols in iter_column_batches(source, chunk_size, **kwargs):
+        write_records(root, cols, rollups)
+        count += len(cols['ts'])
+    return count
+
+def ingest_archive(root: Union[str, Path], path: Union[str, Path], chunk_size: int = 50000, rollups: bool = True, **kwargs) -> int:
+    """Decodes the lines appended to the JSON-lines archive at 'path' since it was last
+    ingested into the store at 'root', and writes the records, and their rollups if 'rollups'
+    is True, 'chunk_size' lines at a time.  A partial last line is left for the next call.
+    The byte offset reached in each archive is saved in the INGEST_STATE file after each chunk
+    is written, so ingesting the same archive again doesn't write any reading twice.  Raises
+    ValueError if the archive is not an extension of the file ingested before.  Other keyword
+    arguments are passed to 'stream.iter_column_batches()'.  Returns the number of records
+    written.
+    """
+    Path(root).mkdir(parents=True, exist_ok=True)
+    state_path = Path(root) / INGEST_STATE
+    state = json.loads(state_path.read_text()) if state_path.exists() else {}
+    key = str(Path(path).resolve())
+    offset = state.get(key, {}).get('size', 0)
+
+    count = 0
+    with open(path, 'rb') as f:
+        size = f.seek(0, io.SEEK_END)
+        if size < offset or (offset and append_check(f, offset) != state[key]['check']):
+            raise ValueError(f'{path} is not an extension of the archive ingested into {root}.')
+
+        def flush(lines):
+            nonlocal count
+            for cols in iter_column_batches(lines, len(lines), **kwargs):
+                write_records(root, cols, rollups)
+                count += len(cols['ts'])
+            state[key] = dict(size=offset, check=append_check(f, offset))
+            tmp_path = state_path.with_name(INGEST_STATE + '.tmp')
+            tmp_path.write_text(json.dumps(state))
+            os.replace(tmp_path, state_path)
+            f.seek(offset)
+
+        f.seek(offset)
+        lines = []
+        for lin in f:
+            if not lin.endswith(b'\n'):
+                break           # partial line still being written
+            lines.append(lin)
+            offset += len(lin)
+            if len(lines) == chunk_size:
+                flush(lines)
+                lines = []
+        if lines:
+            flush(lines)
+    return count
+
+def iter_partitions(
+        root: Union[str, Path],
+        start: Optional[TimeValue] = None,
+        end: Optional[TimeValue] = None,
+        devices: Optional[Iterable[str]] = None,
+    ) -> Iterator[Tuple[str, str, Path]]:
+    """Yields (day, device_id, part file path) for each part file in the store at 'root' that
+    may hold readings from 'start' up to 'end' for one of 'devices'.  Arguments that are None
+    don't restrict the partitions.
+    """
+    first_day = _day(unix_timestamp(start)) if start is not None else None
+    last_day = _day(unix_timestamp(end)) if end is not None else None
+    devices = set(devices) if devices is not None else None
+    for day_dir in sorted(Path(root).glob('day=*')):
+        day = day_dir.name[4:]
+        if (first_day and day < first_day) or (last_day and day > last_day):
+            continue
+        for device_dir in sorted(day_dir.glob('device=*')):
+            device_id = unquote(device_dir.name[7:])
+            if devices is not None and device_id not in devices:
+                continue
+            for path in sorted(device_dir.glob('part-*.parquet')):
+                yield day, device_id, path
+
+def read_records(
+        root: Union[str, Path],
+        start: Optional[TimeValue] = None,
+        end: Optional[TimeValue] = None,
+        devices: Optional[Iterable[str]] = None,
+        columns: Optional[Iterable[str]] = None,
+    ) -> pd.DataFrame:
+    """Returns a DataFrame of the readings in the store at 'root' with a timestamp greater than
+    or equal to 'start' and less than 'end', from the 'devices' listed.  If 'columns' is given,
+    only those columns (plus 'device_id' and 'ts') are read.  Arguments that are None don't
+    restrict the results.  Rows are sorted by timestamp.
+    """
+    filters = []
+    if start is not None:
+        filters.append(('ts', '>=', unix_timestamp(start)))
+    if end is not None:
+        filters.append(('ts', '<', unix_timestamp(end)))
+    if columns is not None:
+        columns = ['device_id', 'ts'] + [c for c in columns if c not in ('device_id', 'ts')]
+
+    frames = []
+    for _, _, path in iter_partitions(root, start, end, devices):
+        cols = None
+        if columns is not None:
+            names = set(pq.read_schema(path).names)
+            cols = [c for c in columns if c in names]
+        table = pq.read_table(path, columns=cols, filters=filters or None)
+        if table.num_rows:
+            frames.append(table.to_pandas())
+
+    if not frames:
+        return pd.DataFrame(columns=columns or ['device_id', 'ts'])
+    df = pd.concat(frames, ignore_index=True, sort=False)
+    return df.sort_values('ts', kind='stable').reset_index(drop=True)
+
+def test():
+    import tempfile
+    debug_file = Path(__file__).parent.parent / 'lora-debug.txt'
+    with tempfile.TemporaryDirectory() as root:
+        assert write_archive(root, debug_file, chunk_size=4) == 6
+        parts = list(iter_partitions(root))
+        assert {(day, dev) for day, dev, _ in parts} == {
+            ('2020-11-12', 'ersco2-a81758fffe0526d8'), ('2020-11-12', 'lht65-a8404173e1822ca4')}
+
+        df = read_records(root)
+        assert len(df) == 6 and df.ts.is_monotonic_increasing
+
+        df = read_records(root, start='2020-11-12 17:39', end='2020-11-12 17:40',
+                          devices=['lht65-a8404173e1822ca4'], columns=['temperature'])
+        assert list(df.columns) == ['device_id', 'ts', 'temperature']
+        assert len(df) == 3
+
+        assert read_records(root, start='2020-11-13').empty
+        assert len(list(iter_partitions(root, start='2020-11-13'))) == 0
+
+    # ingesting only adds the lines appended since the last time
+    lines = open(debug_file, 'rb').read().splitlines(keepends=True)
+    with tempfile.TemporaryDirectory() as root:
+        archive = Path(root) / 'lora.json'
+        archive.write_bytes(b''.join(lines[:4]) + lines[4][:20])
+        store = Path(root) / 'store'
+        assert ingest_archive(store, archive, chunk_size=3) == 4
+        assert ingest_archive(store, archive) == 0
+        archive.write_bytes(b''.join(lines))
+        assert ingest_archive(store, archive) == 2
+        assert ingest_archive(store, archive) == 0
+        df = read_records(store)
+        assert len(df) == 6 and sorted(df.counter) == [0, 0, 1, 254, 255, 256]
+
+        archive.write_bytes(b''.join(lines[1:]))
+        try:
+            ingest_archive(store, archive)
+            assert False, 'replaced archive ingested'
+        except ValueError:
+            pass
+    print('store tests passed')
+
+if __name__ == '__main__':
+    # To run this without import error, need to run "python -m decoder.store" from the top level directory.
+    test()
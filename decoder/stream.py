@@ -0,0 +1,140 @@
+"""Module for streaming through a file of newline-delimited Things Network HTTP Integration
+payloads (one JSON object per line, like the 'lora.json' archive), decoding each payload with
+'decoder.decode()'.  Records are produced in chunks of bounded size, and lines are only read
+from the file when the consumer asks for the next chunk, so memory use stays constant no
+matter how large the file is.
+"""
+from typing import Dict, Any, Iterator, Iterable, List, Union, IO
+from pathlib import Path
+from itertools import islice
+import json
+
+from .decoder import decode
+from .records import RECORD_COLUMNS
+
+def iter_payloads(source: Union[str, Path, IO]) -> Iterator[Dict[str, Any]]:
+    """Yields the integration payloads, as dictionaries, from the JSON-lines 'source', which
+    is a file path or an open file.  Blank lines are skipped.
+    """
+    if isinstance(source, (str, Path)):
+        with open(source, 'rb') as f:
+            yield from iter_payloads(f)
+        return
+
+    for lin in source:
+        if lin.strip():
+            yield json.loads(lin)
+
+def iter_records(
+        source: Union[str, Path, IO, Iterable[Dict[str, Any]]],
+        skip_errors: bool = False,
+        **decode_kwargs,
+    ) -> Iterator[Dict[str, Any]]:
+    """Yields decoded records, from 'decoder.decode()', for each payload in 'source'.
+    'source' is a file path, an open JSON-lines file, or an iterable of integration payload
+    dictionaries.  If 'skip_errors' is True, lines that are not valid JSON or that can't be
+    decoded are skipped; otherwise the error is raised.  Other keyword arguments are passed
+    to 'decoder.decode()'.
+    """
+    if isinstance(source, (str, Path)):
+        with open(source, 'rb') as f:
+            yield from iter_records(f, skip_errors, **decode_kwargs)
+        return
+
+    for item in source:
+        try:
+            if isinstance(item, (str, bytes)):
+                if not item.strip():
+                    continue
+                item = json.loads(item)
+            rec = decode(item, **decode_kwargs)
+        except Exception:
+            if skip_errors:
+                continue
+            raise
+        yield rec
+
+def iter_chunks(
+        source: Union[str, Path, IO, Iterable[Dict[str, Any]]],
+        chunk_size: int = 1000,
+        skip_errors: bool = False,
+        **decode_kwargs,
+    ) -> Iterator[List[Dict[str, Any]]]:
+    """Yields lists of up to 'chunk_size' decoded records from 'source'.  See 'iter_records()'
+    for a description of the parameters.  The next chunk is not read until the previous one
+    has been consumed.
+    """
+    records = iter_records(source, skip_errors, **decode_kwargs)
+    while True:
+        chunk = list(islice(records, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+def records_to_columns(records: List[Dict[str, Any]]) -> Dict[str, List[Any]]:
+    """Converts a list of decoded records into a dictionary of columns:  one list per
+    metadata item and per sensor field, each having one element per record.  Records lacking
+    a field have None in that field's column.
+    """
+    row_count = len(records)
+    cols = {name: [rec[name] for rec in records] for name in RECORD_COLUMNS}
+    for ix, rec in enumerate(records):
+        for name, val in rec['fields'].items():
+            col = cols.get(name)
+            if col is None:
+                col = cols[name] = [None] * row_count
+            col[ix] = val
+    return cols
+
+def iter_column_batches(
+        source: Union[str, Path, IO, Iterable[Dict[str, Any]]],
+        chunk_size: int = 1000,
+        skip_errors: bool = False,
+        **decode_kwargs,
+    ) -> Iterator[Dict[str, List[Any]]]:
+    """Like 'iter_chunks()' but each chunk is converted to columns with
+    'records_to_columns()'.
+    """
+    for chunk in iter_chunks(source, chunk_size, skip_errors, **decode_kwargs):
+        yield records_to_columns(chunk)
+
+def iter_frames(
+        source: Union[str, Path, IO, Iterable[Dict[str, Any]]],
+        chunk_size: int = 10000,
+        skip_errors: bool = False,
+        **decode_kwargs,
+    ):
+    """Like 'iter_column_batches()' but yields each chunk as a pandas DataFrame.
+    """
+    import pandas as pd
+    for cols in iter_column_batches(source, chunk_size, skip_errors, **decode_kwargs):
+        yield pd.DataFrame(cols)
+
+def test():
+    from pathlib import Path
+    debug_file = Path(__file__).parent.parent / 'lora-debug.txt'
+
+    chunks = list(iter_chunks(debug_file, chunk_size=4))
+    assert [len(c) for c in chunks] == [4, 2]
+    records = [rec for c in chunks for rec in c]
+    with open(debug_file) as f:
+        assert records == [decode(json.loads(lin)) for lin in f]
+
+    batches = list(iter_column_batches(debug_file, chunk_size=4))
+    assert batches[0]['device_id'][1] == 'lht65-a8404173e1822ca4'
+    assert batches[0]['temperature'][0] is None
+    assert batches[0]['temperature'][1] == records[1]['fields']['temperature']
+
+    # bad lines are skipped if requested
+    lines = [b'{"not": "a payload"}\n', b'not json\n'] + open(debug_file, 'rb').readlines()
+    assert len(list(iter_records(lines, skip_errors=True))) == 6
+    try:
+        list(iter_records(lines))
+        assert False
+    except KeyError:
+        pass
+    print('stream tests passed')
+
+if __name__ == '__main__':
+    # To run this without import error, need to run "python -m decoder.stream" from the top level directory.
+    test()
@@ -0,0 +1,92 @@
+"""Renders a matrix of hourly reading counts as colored bars in the terminal, one row per
+device.  Each row is built as a single rich Text object with style spans looked up from a
+precomputed table, so no markup is parsed and the cost is linear in the number of cells.
+"""
+from typing import Dict, List, Callable, Optional
+
+import numpy as np
+import pandas as pd
+from rich.style import Style
+from rich.text import Text, Span
+
+# Cell values at or above this all use the same character
+CHAR_LIMIT = 10
+
+class HeatmapRenderer:
+    """Renders count matrices using a color scale.
+    """
+
+    def __init__(
+            self,
+            color_scale: Dict[int, str],
+            char_func: Callable[[int], str] = lambda val: str(val) if val < 10 else '+',
+            overflow_style: Optional[str] = None,
+            text_color: str = '#000000',
+            label_width: int = 20,
+        ):
+        """'color_scale' maps a cell value to a background color; the keys must run from 0 up.
+        'char_func' gives the character printed for a cell value.  Values larger than the
+        largest 'color_scale' key use the 'overflow_style' (a rich style string) if given, or
+        else the color of the largest key.  'text_color' is the color of the cell characters,
+        and 'label_width' is the width of the row label.
+        """
+        self.max_key = max(color_scale)
+        styles = [Style.parse(f'{text_color} on {color_scale[k]}') for k in range(self.max_key + 1)]
+        styles.append(Style.parse(overflow_style) if overflow_style else styles[-1])
+        self.styles = styles
+        self.chars = np.array([char_func(val) for val in range(CHAR_LIMIT + 1)])
+        self.label_width = label_width
+
+    def render_row(self, label: str, values: np.ndarray, day_starts: np.ndarray) -> Text:
+        """Returns the Text for one row.  'values' are the integer cell values, and
+        'day_starts' is a boolean array that is True for cells starting a new day; a space
+        is placed before those cells.
+        """
+        values = np.maximum(values.astype(np.int64), 0)
+        style_ix = np.minimum(values, self.max_key + 1)
+        chars = self.chars[np.minimum(values, CHAR_LIMIT)]
+
+        parts = [f'{label:{self.label_width}}']
+        pos = len(parts[0])
+        spans = []
+        # cells are rendered in runs that share a style and don't cross a day boundary.
+        breaks = np.flatnonzero((np.diff(style_ix) != 0) | day_starts[1:]) + 1
+        bounds = np.concatenate(([0], breaks, [len(values)]))
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            if day_starts[start]:
+                parts.append(' ')
+                pos += 1
+            parts.append(''.join(chars[start:end]))
+            spans.append(Span(pos, pos + end - start, self.styles[style_ix[start]]))
+            pos += end - start
+        return Text(''.join(parts), spans=spans, end='\n')
+
+    def render(self, counts: pd.DataFrame) -> List[Text]:
+        """Returns a Text row for each column of the 'counts' DataFrame, which is indexed by
+        hour.
+        """
+        day_starts = np.asarray(counts.index.hour == 0)
+        values = counts.to_numpy()
+        return [self.render_row(str(col), values[:, ix], day_starts) for ix, col in enumerate(counts.columns)]
+
+def test():
+    from rich.console import Console
+    color_scale = {0: '#FF3131', 1: '#FFD822', 2: '#FFFF00'}
+    hours = pd.date_range('2020-12-10 22:00', periods=6, freq='1h')
+    counts = pd.DataFrame({'dev a': [0, 1, 1, 2, 3, 12], 'dev b': [2, 2, 2, 2, 2, 2]}, index=hours)
+    renderer = HeatmapRenderer(color_scale, overflow_style='#BBBBBB on #FFFFFF', label_width=6)
+    rows = renderer.render(counts)
+    assert [r.plain for r in rows] == ['dev a 01 123+', 'dev b 22 2222']
+
+    # each character has the same style as when rendering the equivalent markup, cell by cell
+    console = Console(color_system='truecolor')
+    markup = Text.from_markup(
+        'dev a [#000000 on #FF3131]0[/][#000000 on #FFD822]1[/] [#000000 on #FFD822]1[/]'
+        '[#000000 on #FFFF00]2[/][#BBBBBB on #FFFFFF]3[/][#BBBBBB on #FFFFFF]+[/]')
+    assert markup.plain == rows[0].plain
+    for i in range(len(markup.plain)):
+        assert markup.get_style_at_offset(console, i) == rows[0].get_style_at_offset(console, i), i
+    print('heatmap tests passed')
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,88 @@
+"""Applies the label dictionaries in 'label_map' to DataFrame columns.  Each distinct ID in a
+column is looked up once, and the column becomes a pandas Categorical of labels, so the labels
+are stored as small integer codes instead of repeated strings.  Selecting rows by label then
+compares integer codes rather than strings.
+"""
+from typing import Dict, List, Iterable, Optional
+
+import numpy as np
+import pandas as pd
+
+from label_map import dev_lbls, dev_id_lbls, gtw_lbls
+
+class LabelIndex:
+    """Maps IDs to labels, and labels back to IDs.
+    """
+
+    def __init__(self, labels: Dict[str, str], keep_unmapped: bool = True):
+        """'labels' maps ID to label.  If 'keep_unmapped' is True, an ID that is not in
+        'labels' is used as its own label; otherwise it has no label (NaN).
+        """
+        self.labels = labels
+        self.keep_unmapped = keep_unmapped
+        self._ids: Dict[str, List[str]] = {}
+        for id, lbl in labels.items():
+            self._ids.setdefault(lbl, []).append(id)
+
+    def label(self, id: str) -> Optional[str]:
+        """Returns the label for one ID.
+        """
+        return self.labels.get(id, id if self.keep_unmapped else None)
+
+    def ids(self, label: str) -> List[str]:
+        """Returns the IDs having the label 'label'.  An unmapped ID is its own label if
+        'keep_unmapped' is True.
+        """
+        ids = self._ids.get(label, [])
+        if not ids and self.keep_unmapped:
+            ids = [label]
+        return list(ids)
+
+    def categorical(self, ids: pd.Series) -> pd.Series:
+        """Returns a Series of labels for the Series of IDs 'ids', as a Categorical whose
+        categories are the labels in sorted order.
+        """
+        id_codes, uniques = pd.factorize(ids)
+        lbls = [self.label(id) for id in uniques]
+        categories = sorted({lbl for lbl in lbls if lbl is not None})
+        cat_codes = {lbl: i for i, lbl in enumerate(categories)}
+        # the last entry is for missing IDs, which have a code of -1.
+        lookup = np.array([cat_codes.get(lbl, -1) for lbl in lbls] + [-1])
+        return pd.Series(
+            pd.Categorical.from_codes(lookup[id_codes], categories=categories),
+            index=ids.index,
+            name=ids.name)
+
+    @staticmethod
+    def mask(labels: pd.Series, selected: Iterable[str]) -> np.ndarray:
+        """Returns a boolean array that is True where the Categorical Series 'labels' (from
+        'categorical()') has one of the 'selected' labels.
+        """
+        wanted = np.append(labels.cat.categories.isin(list(selected)), False)
+        return wanted[labels.cat.codes.values]
+
+# Indexes for the dictionaries in 'label_map'.  Unlabeled devices are dropped from reports,
+# unlabeled gateways are shown by ID.
+dev_index = LabelIndex(dev_lbls)
+dev_id_index = LabelIndex(dev_id_lbls, keep_unmapped=False)
+gtw_index = LabelIndex(gtw_lbls)
+
+def test():
+    ids = pd.Series(['eui-c0ee40ffff293d87', 'kl4qh-mtcdt3', 'eui-unknown', None, 'kl4qh-mtcdt3'],
+                    name='gateway')
+    gtw = gtw_index.categorical(ids)
+    assert list(gtw.astype(object).fillna('-')) == ['Laird', 'ANMC', 'eui-unknown', '-', 'ANMC']
+    assert list(gtw.cat.categories) == ['ANMC', 'Laird', 'eui-unknown']
+    assert gtw_index.ids('ANMC') == ['kl4qh-mtcdt3'] and gtw_index.ids('eui-x') == ['eui-x']
+
+    dev_ids = pd.Series(['lht65-a8404173e1822ca4', 'elt2-a81758fffe05368e', 'unknown', 'elt2-a81758fffe05368f'])
+    devs = dev_id_index.categorical(dev_ids)
+    expected = dev_ids.map(dev_id_lbls)
+    assert devs.astype(object).equals(expected.astype(object))
+    selected = ['122 N Bliss', '122 N Bliss Unit', 'no such device']
+    assert list(LabelIndex.mask(devs, selected)) == list(expected.isin(selected))
+    assert dev_id_index.ids('unknown') == []
+    print('label_index tests passed')
+
+if __name__ == '__main__':
+    test()
@@ -38,13 +38,15 @@ color_scale = {
 
 from datetime import datetime, timedelta
 import subprocess
-import pandas as pd
 from dateutil.parser import parse
 from dateutil import tz
 from rich import print
 from rich.markdown import Markdown
 import questionary
-from label_map import dev_id_lbls, gtw_lbls
+from label_index import LabelIndex, dev_id_index, gtw_index
+from tsv_index import IndexedTsv
+from reading_cube import ReadingCube
+from heatmap import HeatmapRenderer
 
 print()
 refresh = questionary.confirm("Download new Data?").ask()
@@ -66,63 +68,29 @@ start_ts = (datetime.now(tz_ak) - timedelta(days=days_to_show)).replace(
 end_ts = datetime.now(tz_ak).replace(
     tzinfo=None, minute=0, second=0, microsecond=0)
 
-df = pd.read_csv('gateways.tsv', 
-    sep='\t', 
-    parse_dates=['ts', 'ts_hour'],
-    index_col='ts',
-    low_memory=False)
-df = df.loc[str(start_ts):]
-df['dev_id'] = df.dev_id.map(dev_id_lbls)
-df.query('dev_id in @devices', inplace=True)
+# only parses the rows in the requested window that weren't parsed on a previous run.
+df = IndexedTsv('gateways.tsv').read(start_ts)
+# labels are categorical columns, and the device group is selected by label code.
+df['dev_id'] = dev_id_index.categorical(df.dev_id)
+df = df[LabelIndex.mask(df.dev_id, devices)].copy()
 
-def gtw_map(gtw_eui):
-    return gtw_lbls.get(gtw_eui, gtw_eui)
+df['gateway'] = gtw_index.categorical(df.gateway)
 
-df['gateway'] = df.gateway.map(gtw_map)
-
-gtws = df.gateway.unique()
-gtw_choices = ['Any'] + list(gtws)
+# count readings for all gateways and each gateway in one pass
+cube = ReadingCube(df, start_ts, end_ts)
 # filter gateway here, if requested
-#gtw_incl = questionary.select("Gateways to Include:", choices=gtw_choices).ask()
+#gtw_incl = questionary.select("Gateways to Include:", choices=cube.gateways).ask()
+# counts above the largest color scale key are shown grey on white.
+renderer = HeatmapRenderer(color_scale, overflow_style='#BBBBBB on #FFFFFF')
 print('\nNumber of Readings in the Hour:\n')
-for gtw_incl in gtw_choices:
-    if gtw_incl != 'Any':
-        dfg = df.query('gateway == @gtw_incl').copy()
-    else:
-        dfg = df.copy()
-    
+for gtw_incl in cube.gateways:
     print(f'Gateway: {gtw_incl}')
     print()
 
-    dfg = dfg[['ts_hour', 'dev_id', 'counter']].reset_index()
-    dfg.drop_duplicates(inplace=True)
-    dfg.drop(columns='ts', inplace=True)
-    df2 = dfg.groupby(['ts_hour', 'dev_id']).count().reset_index()
-    df_cts = df2.pivot(index='ts_hour', columns='dev_id', values='counter')
-
-    # Make a new index that fills in any missing hours
-    #new_ix = pd.date_range(df_cts.index[0], df_cts.index[-1], freq='1H')
-    new_ix = pd.date_range(start_ts, end_ts, freq='1H')
-    df_cts = df_cts.reindex(new_ix)
-
-    # Fill NaNs with 0
-    df_cts.fillna(0, inplace=True)
-
-    # drop last hour because likely a partial hour
-    df_cts = df_cts[:-1]
-
-    for c in df_cts.columns:
-        print(f'{c:20}', end='')
-        for ts, val in df_cts[c].iteritems():
-            if ts.hour == 0:
-                print(' ', end='')
-            if val > max(color_scale.keys()):
-                prn_char = int(val) if val < 10 else '+'
-                print(f"[#BBBBBB on #FFFFFF]{prn_char}[/]", end='')
-            else:
-                color = color_scale[val]
-                print(f"[#000000 on {color}]{int(val)}[/]", end='')
-        print()
+    df_cts = cube.view(gtw_incl)
+
+    for row in renderer.render(df_cts):
+        print(row)
 
     print(Markdown('---\n\n'))
 
@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 
 """Creates a heat map showing reading counts per hour for selected sensors.
-Depends on a 
+The counts come from the hourly rollups in the Parquet store of decoded readings.  The store
+is first brought up to date with the 'lora.json' archive (see 'data_get.sh'); only the uplinks
+added to the archive since the last run are decoded.
 """
 
 # %%
@@ -11,34 +13,32 @@ DEVICES = (
     'Phil LT22222 428E',
     'Phil CO2 26D8',
 )
+ARCHIVE = 'lora.json'       # JSON-lines archive of uplinks
+STORE = 'readings'          # root directory of the Parquet store
 
-import json
+import sys
+from pathlib import Path
 from datetime import datetime, timedelta
 import pytz
-import pandas as pd
 import plotly.graph_objects as go
-from dateutil.parser import parse
 from dateutil import tz
-from label_map import dev_lbls
+from label_map import dev_id_lbls
 
-start_ts = datetime.now(pytz.utc) - timedelta(days=DAYS_TO_SHOW)
-recs = []
-tz_ak = tz.gettz('US/Alaska')
-for lin in open('lora.json'):
-    rec = json.loads(lin)
-    ts = parse(rec['metadata']['time'])
-    device = dev_lbls.get(rec['hardware_serial'], rec['hardware_serial'])
-    if ts > start_ts and device in DEVICES:
-        ts_ak = ts.astimezone(tz_ak)
-        recs.append(dict(ts = ts_ak, device=device))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))    # to find the decoder package
+from decoder.store import ingest_archive
+from decoder.rollup import reading_counts
 
-df = pd.DataFrame(recs)
-df.set_index('ts', inplace=True)
+ingest_archive(STORE, ARCHIVE, skip_errors=True)
 
-df['readings'] = 1
-df_cts = df.pivot(columns='device', values='readings')
+start_ts = datetime.now(pytz.utc) - timedelta(days=DAYS_TO_SHOW)
+tz_ak = tz.gettz('US/Alaska')
+dev_ids = {lbl: dev_id for dev_id, lbl in dev_id_lbls.items()}
 
-df_cts = df_cts.resample('1H').sum()
+# one row per hour and a column per device, without resampling the readings.
+df_cts = reading_counts(STORE, 'hour', start=start_ts, devices=[dev_ids[d] for d in DEVICES])
+df_cts = df_cts.rename(columns=dev_id_lbls)
+df_cts = df_cts.asfreq('1h').fillna(0)        # include hours without readings
+df_cts.index = df_cts.index.tz_convert(tz_ak)
 df_cts.where(df_cts <= 12, 12, inplace=True)
 df_cts = df_cts[1:-1]                  # take out first and last hour
 # %%
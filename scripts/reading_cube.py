@@ -0,0 +1,118 @@
+"""Counts the readings received per hour for each device, for all gateways together and for
+each gateway individually, in one grouped pass over a gateways.tsv DataFrame.
+"""
+from typing import Dict, List, Union
+
+import numpy as np
+import pandas as pd
+
+ANY_GATEWAY = 'Any'
+
+class ReadingCube:
+    """Reading counts in an integer array, 'counts', indexed by [gateway, device, hour].
+    Gateway 0 is 'Any':  readings received by at least one gateway.  The other gateways are in
+    order of first appearance in the data, devices are sorted.  A reading is a unique
+    (ts, dev_id, counter) combination, so a reading received by several gateways, or recorded
+    twice by one gateway, is counted once.
+    """
+
+    def __init__(self, df: pd.DataFrame, start_ts, end_ts):
+        """'df' is a DataFrame of gateways.tsv rows indexed by 'ts' and having 'ts_hour',
+        'dev_id', 'gateway' and 'counter' columns.  Counts are made for the hours from 'start_ts'
+        up to, but not including, the hour 'end_ts', which is likely a partial hour.
+        """
+        self.hours = pd.date_range(start_ts, end_ts, freq='1h')[:-1]
+        gtw_codes, gateways = pd.factorize(df['gateway'])
+        dev_codes, devices = pd.factorize(df['dev_id'], sort=True)
+        self.gateways: List[str] = [ANY_GATEWAY] + list(gateways)
+        self.devices: List[str] = list(devices)
+        gtw_count, dev_count, hour_count = len(self.gateways), len(self.devices), len(self.hours)
+
+        hour_codes = self.hours.get_indexer(df['ts_hour'])
+        keys = pd.DataFrame({
+            'g': gtw_codes + 1,
+            'ts': df.index.values,
+            'd': dev_codes,
+            'h': hour_codes,
+            'c': df['counter'].values,
+        })
+        has_rdg = (hour_codes >= 0) & (dev_codes >= 0) & (gtw_codes >= 0) & keys['c'].notna().values
+        has_row = (dev_codes >= 0) & (gtw_codes >= 0) & df['ts_hour'].notna().values
+
+        def count(layer_codes, dup):
+            ok = has_rdg & ~dup
+            flat = (layer_codes[ok] * dev_count + dev_codes[ok]) * hour_count + hour_codes[ok]
+            return np.bincount(flat, minlength=gtw_count * dev_count * hour_count)
+
+        gtw_layer = keys['g'].values
+        counts = count(gtw_layer, keys.duplicated(['g', 'ts', 'd', 'h', 'c']).values)
+        counts += count(np.zeros_like(gtw_layer), keys.duplicated(['ts', 'd', 'h', 'c']).values)
+        self.counts: np.ndarray = counts.reshape(gtw_count, dev_count, hour_count)
+
+        # which devices have any rows for each gateway
+        self.present = np.zeros((gtw_count, dev_count), dtype=bool)
+        self.present[gtw_layer[has_row], dev_codes[has_row]] = True
+        self.present[0] = self.present[1:].any(axis=0)
+
+    def missed(self, max_reading_count: Union[int, Dict[str, int]]) -> np.ndarray:
+        """Returns an array like 'counts' holding the number of missed readings in each hour.
+        'max_reading_count' is the expected number of readings per hour, either one number for
+        all devices or a dictionary mapping device to number.
+        """
+        if isinstance(max_reading_count, dict):
+            max_cts = np.array([max_reading_count[d] for d in self.devices])
+        else:
+            max_cts = np.full(len(self.devices), max_reading_count)
+        return np.maximum(max_cts[None, :, None] - self.counts, 0)
+
+    def view(self, gateway: str, values: np.ndarray = None) -> pd.DataFrame:
+        """Returns a DataFrame for 'gateway' indexed by hour with a column for each device having
+        data from that gateway.  The values come from 'counts', or from 'values' if given, which
+        is an array like 'counts' (e.g. from 'missed()').
+        """
+        g = self.gateways.index(gateway)
+        values = self.counts if values is None else values
+        cols = np.flatnonzero(self.present[g])
+        return pd.DataFrame(
+            values[g][cols].T,
+            index=self.hours,
+            columns=[self.devices[d] for d in cols])
+
+def test():
+    # compare against the per-gateway pandas pipeline that the rdg-ct scripts used
+    rng = np.random.default_rng(1)
+    n = 5000
+    start_ts, end_ts = pd.Timestamp('2020-12-10 00:00'), pd.Timestamp('2020-12-12 00:00')
+    ts = start_ts + pd.to_timedelta(np.sort(rng.integers(-3600, 50 * 3600, n)), unit='s')
+    df = pd.DataFrame({
+        'ts_hour': ts.floor('h'),
+        'dev_id': rng.choice(['dev a', 'dev b', 'dev c'], n),
+        'gateway': rng.choice(['g1', 'g2', 'g3'], n, p=[0.5, 0.4, 0.1]),
+        'counter': rng.integers(0, 300, n).astype(float),
+    }, index=pd.Index(ts, name='ts'))
+    df.loc[df.index[::50], 'counter'] = np.nan
+    # duplicates: the same reading received by another gateway, and by the same gateway
+    dups = df.iloc[::7].copy()
+    dups['gateway'] = 'g2'
+    df = pd.concat([df, dups, df.iloc[::11]]).sort_index()
+
+    cube = ReadingCube(df, start_ts, end_ts)
+    assert cube.gateways[0] == ANY_GATEWAY and set(cube.gateways[1:]) == {'g1', 'g2', 'g3'}
+    for gtw in cube.gateways:
+        dfg = df.copy() if gtw == ANY_GATEWAY else df.query('gateway == @gtw').copy()
+        dfg = dfg[['ts_hour', 'dev_id', 'counter']].reset_index()
+        dfg.drop_duplicates(inplace=True)
+        dfg.drop(columns='ts', inplace=True)
+        df2 = dfg.groupby(['ts_hour', 'dev_id']).count().reset_index()
+        df_cts = df2.pivot(index='ts_hour', columns='dev_id', values='counter')
+        df_cts = df_cts.reindex(pd.date_range(start_ts, end_ts, freq='1h')).fillna(0)[:-1]
+
+        view = cube.view(gtw)
+        assert list(view.columns) == list(df_cts.columns)
+        assert (view.values == df_cts.values).all(), gtw
+        missed = cube.view(gtw, cube.missed(12))
+        assert (missed.values == np.maximum(12 - df_cts.values, 0)).all()
+    print('reading_cube tests passed')
+
+if __name__ == '__main__':
+    test()
@@ -1,21 +1,18 @@
 #!/usr/bin/env python3
 """Analyzes erroneous Shore Power readings on AV1.
 """
-import base64
-import json
-from datetime import datetime
+import sys
+from pathlib import Path
 import subprocess
 import pandas as pd
 import questionary
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))    # to find the decoder package
+from decoder.decode_batch import decode_lt22222_b64
+
 DEVICE = 'boat-lt2-a8404137b182428e'
 START_DATE = '2021-01-13 10:24'
 
-def int16(ix: int) -> int:
-    """Returns a 16-bit integer from the 2 bytes starting at index 'ix' in data byte array.
-    """
-    return (data[ix] << 8) | (data[ix + 1])
-
 print()
 refresh = questionary.confirm("Download new Data?").ask()
 #refresh = False
@@ -29,10 +26,8 @@ bad_ct = 0
 fout = open('shore.tsv', 'w')
 fout.write('ts\tv1\tv2\n')
 
-for ix, row in dfs.iterrows():
-    data = base64.b64decode(row['payload'])
-    ts = row['ts']
-    v1 = int16(0) / 1000.
-    v2 = int16(2) / 1000.
+# decode all of the payloads at once
+vals = decode_lt22222_b64(dfs['payload'])
+for ts, v1, v2 in zip(dfs['ts'], vals['analog'], vals['analog2']):
     print(f"{ts} V1: {v1:.3f}, V2: {v2:.3f}")
     fout.write(f'{ts}\t{v1}\t{v2}\n')
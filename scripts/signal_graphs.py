@@ -18,3 +18,15 @@ px.scatter(dft, x=dft.index, y='snr')
 df.dev_id.unique()
 
 # %%
+# SNR of the best gateway, averaged by hour, from the rollups in the Parquet store of decoded
+# readings.
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path.cwd().parent))    # to find the decoder package
+from decoder.rollup import read_rollup
+
+dfr = read_rollup('readings', 'hour', devices=[dev], fields=['snr'])
+dfr['ts'] = pd.to_datetime(dfr.ts, unit='s', utc=True)
+px.scatter(dfr, x='ts', y='mean')
+
+# %%
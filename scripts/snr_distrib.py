@@ -1,17 +1,30 @@
 #!/usr/bin/env python3
 # %%
-import json
+import sys
+from pathlib import Path
 import pandas as pd
 
-snrs = []
-for lin in open('lora.txt'):
-    rec = json.loads(lin.strip())
-    for gtw in rec['metadata']['gateways']:
-        snrs.append(gtw['snr'])
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))    # to find the decoder package
+from decoder.stream import iter_payloads
+from decoder.signal_stats import SignalStats, RunningStats
 
-df = pd.DataFrame({'snr': snrs})
-df.describe()
+stats = SignalStats()
+for rec in iter_payloads('lora.txt'):
+    stats.add_uplink(rec)
+
+# SNR of all the receptions, combined from the statistics of each link
+snr = RunningStats()
+for dev_id, gtw_id in stats.links():
+    snr.merge(stats.link(dev_id, gtw_id).snr)
+print(f'All receptions:  count {snr.count}, mean {snr.mean:.2f}, std {snr.std:.2f}, '
+      f'min {snr.min}, max {snr.max}')
+
+# statistics of the per-link values, one row per (device, gateway) link
+df_links = pd.DataFrame(stats.summary())
+df_links.describe()
 
 # %%
-df.hist(bins=30)
+# SNR of all the receptions, in 1 dB bins
+hist = pd.Series(stats.histogram(), index=stats.bin_edges[:-1])
+hist.plot.bar(title='SNR of All Receptions')
 # %%
@@ -0,0 +1,173 @@
+"""Reads time windows from a large, time-ordered, append-only TSV file like 'gateways.tsv'
+without parsing the whole file.
+
+A sidecar index file ('<file>.idx.json') records the byte offset of the first row of each
+hour, so reading can start right at the requested window.  The index is extended by scanning
+only the rows appended since it was last updated.  The parsed DataFrame is also cached
+('<file>.cache.pkl'), so a later run only needs to parse the rows appended since then.  If the
+file was replaced by one that is not an extension of the indexed file, the index and cache are
+rebuilt.
+"""
+from typing import Dict, Any, Sequence
+from pathlib import Path
+from bisect import bisect_left
+import io
+import json
+import pickle
+import sys
+
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))    # to find the decoder package
+from decoder.decode_utils import append_check
+
+def _hour_key(ts: str) -> str:
+    """Returns the hour part of a timestamp string, e.g. '2020-12-10 13', used as the index key.
+    """
+    return ts[:13].replace('T', ' ')
+
+class IndexedTsv:
+    """A TSV file with a time column, read by time window.
+    """
+
+    def __init__(
+            self,
+            path: str,
+            ts_col: str = 'ts',
+            parse_dates: Sequence[str] = ('ts', 'ts_hour'),
+        ):
+        """'path' is the TSV file, which must have a header row and be in order of the time
+        column 'ts_col'.  That column must hold ISO format times and becomes the index of the
+        DataFrames returned.  'parse_dates' lists the columns converted to datetimes.
+        """
+        self.path = Path(path)
+        self.ts_col = ts_col
+        self.parse_dates = list(parse_dates)
+        self.index_path = self.path.with_name(self.path.name + '.idx.json')
+        self.cache_path = self.path.with_name(self.path.name + '.cache.pkl')
+
+    def update_index(self) -> Dict[str, Any]:
+        """Brings the index up to date with the file, scanning only rows not yet indexed,
+        and returns it.  The index dictionary has the header row, the number of bytes indexed,
+        a check hash, and a list of [hour key, byte offset] pairs.
+        """
+        index = None
+        if self.index_path.exists():
+            index = json.loads(self.index_path.read_text())
+
+        with open(self.path, 'rb') as f:
+            file_size = f.seek(0, io.SEEK_END)
+            if index is None or file_size < index['size'] or \
+                    append_check(f, index['size']) != index['check']:
+                # new file, or not an extension of the indexed file.
+                f.seek(0)
+                header = f.readline().decode().rstrip('\r\n')
+                index = dict(header=header, size=f.tell(), hours=[])
+                self.cache_path.unlink(missing_ok=True)
+
+            ts_ix = index['header'].split('\t').index(self.ts_col)
+            hours = index['hours']
+            last_hour = hours[-1][0] if hours else ''
+            offset = index['size']
+            f.seek(offset)
+            for lin in f:
+                if not lin.endswith(b'\n'):
+                    break           # partial row still being written
+                hour = _hour_key(lin.split(b'\t', ts_ix + 1)[ts_ix].decode())
+                if hour != last_hour:
+                    hours.append([hour, offset])
+                    last_hour = hour
+                offset += len(lin)
+            index['size'] = offset
+            index['check'] = append_check(f, offset)
+
+        self.index_path.write_text(json.dumps(index))
+        return index
+
+    def _parse(self, header: str, f, start: int, end: int) -> pd.DataFrame:
+        """Parses the rows in bytes 'start' up to 'end' of the open file 'f'.
+        """
+        f.seek(start)
+        return pd.read_csv(
+            io.BytesIO(f.read(end - start)),
+            sep='\t',
+            header=None,
+            names=header.split('\t'),
+            parse_dates=self.parse_dates,
+            index_col=self.ts_col,
+            low_memory=False)
+
+    def read(self, start=None) -> pd.DataFrame:
+        """Returns a DataFrame of the rows with a time at or after 'start' (all rows if None).
+        'start' can be a datetime or a string like '2020-12-10 13:00'.
+        """
+        index = self.update_index()
+        keys = [hour for hour, _ in index['hours']]
+        first = 0 if start is None else bisect_left(keys, _hour_key(str(pd.Timestamp(start))))
+        offset = index['hours'][first][1] if first < len(keys) else index['size']
+
+        # The cache holds the parsed rows from byte 'start' up to byte 'end'.  It is deleted
+        # whenever the index is rebuilt, so it always matches the file.
+        cache = None
+        if self.cache_path.exists():
+            with open(self.cache_path, 'rb') as f:
+                cache = pickle.load(f)
+
+        with open(self.path, 'rb') as f:
+            if cache is None:
+                df = self._parse(index['header'], f, offset, index['size'])
+            else:
+                frames = []
+                if offset < cache['start']:
+                    frames.append(self._parse(index['header'], f, offset, cache['start']))
+                frames.append(cache['df'])
+                if cache['end'] < index['size']:
+                    frames.append(self._parse(index['header'], f, cache['end'], index['size']))
+                df = pd.concat(frames)
+                if offset > cache['start']:
+                    # drop the cached rows before the first requested hour
+                    df = df.loc[keys[first]:] if first < len(keys) else df.iloc[:0]
+
+        with open(self.cache_path, 'wb') as f:
+            pickle.dump(dict(start=offset, end=index['size'], df=df), f)
+
+        if start is not None:
+            df = df.loc[str(start):]
+        return df
+
+def test():
+    import tempfile
+    from datetime import datetime, timedelta
+
+    def rows(first_hour, hours):
+        t0 = datetime(2020, 12, 10) + timedelta(hours=first_hour)
+        for h in range(hours):
+            for m in (5, 25, 45):
+                ts = t0 + timedelta(hours=h, minutes=m)
+                yield f'{ts}\t{ts:%Y-%m-%d %H}:00:00\tdev-{m}\tgtw\t{h}\n'
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / 'gateways.tsv'
+        path.write_text('ts\tts_hour\tdev_id\tgateway\tcounter\n' + ''.join(rows(0, 48)))
+        tsv = IndexedTsv(path)
+        full = pd.read_csv(path, sep='\t', parse_dates=['ts', 'ts_hour'], index_col='ts')
+
+        df = tsv.read('2020-12-11 05:30')
+        assert df.equals(full.loc['2020-12-11 05:30':])
+        assert len(tsv.update_index()['hours']) == 48
+
+        # appended rows are picked up, and an earlier start re-parses only the earlier hours
+        with open(path, 'a') as f:
+            f.write(''.join(rows(48, 3)))
+        full = pd.read_csv(path, sep='\t', parse_dates=['ts', 'ts_hour'], index_col='ts')
+        for start in ('2020-12-11 20:00', '2020-12-11 02:10', None):
+            df = tsv.read(start)
+            assert df.equals(full.loc[start:] if start else full), start
+
+        # a replaced file causes a rebuild
+        path.write_text('ts\tts_hour\tdev_id\tgateway\tcounter\n' + ''.join(rows(100, 2)))
+        assert len(tsv.read('2020-12-11')) == 6
+    print('tsv_index tests passed')
+
+if __name__ == '__main__':
+    test()
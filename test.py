@@ -3,8 +3,13 @@ import json
 from pprint import pprint
 from base64 import b64decode
 from decoder.decoder import decode
+from decoder.payload_cache import PayloadCache
+
+cache = PayloadCache()
 
 for lin in open('lora-debug.txt'):
     d = json.loads(lin.strip())
-    pprint(decode(d, raw_payload_priority=True))
-    pprint(decode(d, raw_payload_priority=False))
+    pprint(decode(d, raw_payload_priority=True, payload_cache=cache))
+    pprint(decode(d, raw_payload_priority=False, payload_cache=cache))
+
+print(cache.cache_info())